@@ -0,0 +1,130 @@
+"""
+Compare the LEGACY (whole page, space counting) and TOKEN chunkers on real documents.
+
+Reports the number of chunks (= process-chunks requests), the spread of chunk sizes (connectionsinsights.chunker
+estimateTokens) and an *estimate* of the Bedrock time for the extraction requests, from a simple latency model:
+
+    request seconds = first token latency + (prompt + chunk tokens) / input rate + output tokens / output rate
+
+where output tokens are proportional to the chunk size.  The model parameters can be set on the command line
+from the metrics printed by the Lambda functions.
+
+With --measure N, N chunks of each chunker (spread over the document) are also sent to Amazon Bedrock with an
+extraction prompt, with the credentials and region of the environment.  This reports the measured seconds per
+request, and the tokens of each chunk as counted by Bedrock (usage input_tokens, less those of the prompt
+alone), so the estimateTokens heuristic can be checked against the model tokenizer.
+
+Usage:
+    python benchmarks/chunker_benchmark.py report.pdf [pages.json ...] [--target-tokens 1500] [--overlap-tokens 0] [--boundary-modulus 8] [--measure 5]
+
+Documents can be PDFs (text extracted with pypdf), JSON arrays of page texts (e.g. saved Textract output)
+or text files with one page per form feed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from connectionsinsights.chunker import (
+    splitDocumentLegacy,
+    splitDocumentByTokens
+)
+
+MEASURE_PROMPT = "List the organizations, people, products and locations named in the text below, as a JSON array of names within <entities></entities> tags.\n\n<text>\n{text}\n</text>"
+
+def loadPages(path):
+    if path.lower().endswith(".pdf"):
+        import pypdf
+        return [page.extract_text() or "" for page in pypdf.PdfReader(path).pages]
+    with open(path, "r") as f:
+        if path.lower().endswith(".json"):
+            return json.load(f)
+        return f.read().split("\f")
+
+def requestSeconds(chunk_tokens, args):
+    output_tokens = min(args.max_output_tokens, args.output_ratio * chunk_tokens)
+    return args.first_token_seconds + (args.prompt_tokens + chunk_tokens) / args.input_tokens_per_second + output_tokens / args.output_tokens_per_second
+
+def summarize(name, chunks, args):
+    sizes = [chunk["tokens"] for chunk in chunks]
+    seconds = [requestSeconds(size, args) for size in sizes]
+    return {
+        "chunker": name,
+        "chunks": len(chunks),
+        "mean_tokens": round(statistics.mean(sizes)) if sizes else 0,
+        "stdev_tokens": round(statistics.pstdev(sizes)) if sizes else 0,
+        "max_tokens": max(sizes) if sizes else 0,
+        "input_tokens": sum(sizes) + args.prompt_tokens * len(sizes),
+        "estimated_seconds": round(sum(seconds), 1),
+        "estimated_slowest_seconds": round(max(seconds), 1) if seconds else 0
+    }
+
+def measureRequest(text):
+    """Returns (seconds, usage input_tokens) of one extraction request for text"""
+    from connectionsinsights.bedrock import queryBedrockStreaming, bedrock_metrics
+    messages = [{"role": "user", "content": MEASURE_PROMPT.format(text=text)}]
+    input_tokens = bedrock_metrics.counters["input_tokens"]
+    start = time.time()
+    queryBedrockStreaming(messages, cache=False)
+    return time.time() - start, bedrock_metrics.counters["input_tokens"] - input_tokens
+
+def measure(chunks, count, prompt_input_tokens):
+    sample = [chunks[index * len(chunks) // count] for index in range(count)] if len(chunks) > count else chunks
+    seconds = []
+    errors = []
+    for chunk in sample:
+        elapsed, input_tokens = measureRequest(chunk["text"])
+        seconds.append(elapsed)
+        actual = input_tokens - prompt_input_tokens
+        if actual > 0:
+            errors.append((chunk["tokens"] - actual) / actual)
+    return {
+        "measured_requests": len(sample),
+        "measured_seconds": round(statistics.mean(seconds) * len(chunks), 1) if seconds else 0,
+        "measured_slowest_seconds": round(max(seconds), 1) if seconds else 0,
+        # estimateTokens relative to the tokens counted by Bedrock: mean and worst case
+        "token_estimate_error": f"{round(100 * statistics.mean(errors))}%" if errors else "-",
+        "token_estimate_max_error": f"{round(100 * max(errors, key=abs))}%" if errors else "-"
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chunk counts and estimated (or measured) Bedrock time of the chunkers")
+    parser.add_argument("documents", nargs="+")
+    parser.add_argument("--target-tokens", type=int, default=1500)
+    parser.add_argument("--overlap-tokens", type=int, default=0)
+    parser.add_argument("--boundary-modulus", type=int, default=8, help="content-defined boundaries (0 to disable)")
+    parser.add_argument("--prompt-tokens", type=int, default=1000, help="extraction prompt tokens sent with every chunk")
+    parser.add_argument("--first-token-seconds", type=float, default=1.5)
+    parser.add_argument("--input-tokens-per-second", type=float, default=4000)
+    parser.add_argument("--output-tokens-per-second", type=float, default=60)
+    parser.add_argument("--output-ratio", type=float, default=0.3, help="output tokens per chunk token")
+    parser.add_argument("--max-output-tokens", type=int, default=4000)
+    parser.add_argument("--measure", type=int, default=0, help="chunks per chunker to time with real Bedrock requests")
+    args = parser.parse_args()
+
+    columns = ["chunker", "chunks", "mean_tokens", "stdev_tokens", "max_tokens", "input_tokens", "estimated_seconds", "estimated_slowest_seconds"]
+    if args.measure > 0:
+        columns += ["measured_requests", "measured_seconds", "measured_slowest_seconds", "token_estimate_error", "token_estimate_max_error"]
+        _, prompt_input_tokens = measureRequest("")
+    for path in args.documents:
+        pages = loadPages(path)
+        rows = []
+        for name, chunks in [
+            ("LEGACY", splitDocumentLegacy(pages)),
+            ("TOKEN", splitDocumentByTokens(pages, args.target_tokens, args.overlap_tokens, args.boundary_modulus))
+        ]:
+            row = summarize(name, chunks, args)
+            if args.measure > 0:
+                row.update(measure(chunks, args.measure, prompt_input_tokens))
+            rows.append(row)
+        print(f"\n{path} ({len(pages)} pages)")
+        print("  ".join(f"{column:>26}" for column in columns))
+        for row in rows:
+            print("  ".join(f"{str(row[column]):>26}" for column in columns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Measure the chunk pre-screen (connectionsinsights.prescreen) on a labeled set: the share of chunks it would
+skip, and the recall loss, i.e. the relevant chunks and extracted entities that would have been skipped.
+
+The labeled set is a JSON array of chunks, each {"text": ..., "results": {...}} with the results of the full
+extraction prompt (the COMMERCIAL_PRODUCTS_OR_SERVICES, CUSTOMERS, SUPPLIERS_OR_PARTNERS, COMPETITORS and
+DIRECTORS arrays), or {"text": ..., "relevant": true/false} labeled by hand.  A chunk is relevant when its
+results are not empty.
+
+The EMBEDDING mode calls Amazon Bedrock with the credentials and region of the environment.
+
+Usage:
+    python benchmarks/prescreen_benchmark.py labeled.json [--modes HEURISTIC EMBEDDING] [--thresholds 0.15 0.25 0.35]
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+import connectionsinsights.prescreen as prescreen
+
+RESULT_KEYS = ["COMMERCIAL_PRODUCTS_OR_SERVICES", "CUSTOMERS", "SUPPLIERS_OR_PARTNERS", "COMPETITORS", "DIRECTORS"]
+
+def entityCount(chunk):
+    results = chunk.get("results") or {}
+    return sum(len(results.get(key, [])) for key in RESULT_KEYS)
+
+def isRelevant(chunk):
+    if "relevant" in chunk:
+        return bool(chunk["relevant"])
+    return entityCount(chunk) > 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure pre-screen skip rate and recall loss on labeled chunks")
+    parser.add_argument("labeled")
+    parser.add_argument("--modes", nargs="+", default=[prescreen.PRESCREEN_HEURISTIC])
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[prescreen.PRESCREEN_THRESHOLD])
+    parser.add_argument("--show-missed", action="store_true", help="print the relevant chunks that would be skipped")
+    args = parser.parse_args()
+
+    with open(args.labeled, "r") as f:
+        chunks = json.load(f)
+    relevant = [isRelevant(chunk) for chunk in chunks]
+    entities = sum(entityCount(chunk) for chunk in chunks)
+    print(f"{len(chunks)} chunks, {sum(relevant)} relevant, {entities} entities")
+
+    columns = ["mode", "threshold", "skipped", "skipped_pct", "chunk_recall", "entity_recall", "precision_of_skips"]
+    print("  ".join(f"{column:>18}" for column in columns))
+    for mode in args.modes:
+        for threshold in args.thresholds:
+            prescreen.PRESCREEN_THRESHOLD = threshold
+            kept = [prescreen.screenChunk(chunk["text"], mode=mode.upper())[0] for chunk in chunks]
+            skipped = [index for index, keep in enumerate(kept) if not keep]
+            missed = [index for index in skipped if relevant[index]]
+            missed_entities = sum(entityCount(chunks[index]) for index in missed)
+            row = {
+                "mode": mode.upper(),
+                "threshold": threshold,
+                "skipped": len(skipped),
+                "skipped_pct": round(100 * len(skipped) / max(1, len(chunks)), 1),
+                "chunk_recall": round(1 - len(missed) / max(1, sum(relevant)), 3),
+                "entity_recall": round(1 - missed_entities / max(1, entities), 3),
+                "precision_of_skips": round(1 - len(missed) / max(1, len(skipped)), 3)
+            }
+            print("  ".join(f"{str(row[column]):>18}" for column in columns))
+            if args.show_missed:
+                for index in missed:
+                    print(f"    missed chunk {index} ({entityCount(chunks[index])} entities): {prescreen.screenChunk(chunks[index]['text'], mode=mode.upper())[1]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Measure pypdf text extraction throughput (pages per second) of the serial page loop used before and of
+the page-parallel extractor (connectionsinsights.extraction.iterPDFPages) with different worker counts.
+
+Usage:
+    python benchmarks/pypdf_benchmark.py report.pdf [more.pdf ...] [--workers 2 4 6]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+import pypdf
+from connectionsinsights.extraction import iterPDFPages
+
+def serial(path):
+    with open(path, 'rb') as pdfFileObj:
+        pdfReader = pypdf.PdfReader(pdfFileObj)
+        return [page.extract_text() for page in pdfReader.pages]
+
+def timed(extract):
+    start = time.time()
+    pages = extract()
+    return len(pages), time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare serial and page-parallel pypdf extraction")
+    parser.add_argument("documents", nargs="+")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    for path in args.documents:
+        num_pages, seconds = timed(lambda: serial(path))
+        print(f"\n{path} ({num_pages} pages, {os.cpu_count()} CPUs)")
+        print(f"{'extractor':>14}  {'seconds':>8}  {'pages/s':>8}  {'speed-up':>8}")
+        print(f"{'serial':>14}  {seconds:8.2f}  {num_pages / seconds:8.1f}  {1.0:8.2f}")
+        for workers in sorted(set(args.workers)):
+            parallel_pages, parallel_seconds = timed(lambda: list(iterPDFPages(path, workers=workers)))
+            assert parallel_pages == num_pages
+            print(f"{f'{workers} workers':>14}  {parallel_seconds:8.2f}  {num_pages / parallel_seconds:8.1f}  {seconds / parallel_seconds:8.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare the document summary configurations (connectionsinsights.summary) on real documents: latency, and
+agreement of the MAIN_ENTITY with the SINGLE / FIRST summary used before (same name after clean_name, and the
+Jaccard similarity of INDUSTRY, FOCUS_AREA and REVENUE_GENERATING_INDUSTRIES).
+
+Calls Amazon Bedrock with the credentials and region of the environment (DDBTBL_PROMPTS is optional).
+
+Usage:
+    python benchmarks/summary_benchmark.py report.pdf [pages.json ...] [--configs SINGLE/FIRST MAP_REDUCE/FIRST MAP_REDUCE/CLUSTER]
+
+Documents can be PDFs (text extracted with pypdf), JSON arrays of page texts or text files with one page per
+form feed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from connectionsinsights.chunker import splitDocument, countChunksWithinTokens
+from connectionsinsights.summary import generateDocumentSummary
+from connectionsinsights.utils import clean_name
+
+LIST_ATTRIBUTES = ["INDUSTRY", "FOCUS_AREA", "REVENUE_GENERATING_INDUSTRIES"]
+
+def loadPages(path):
+    if path.lower().endswith(".pdf"):
+        import pypdf
+        return [page.extract_text() or "" for page in pypdf.PdfReader(path).pages]
+    with open(path, "r") as f:
+        if path.lower().endswith(".json"):
+            return json.load(f)
+        return f.read().split("\f")
+
+def attributeValues(summary, key):
+    values = set()
+    for attribute in summary["MAIN_ENTITY"]["ATTRIBUTES"]:
+        value = attribute.get(key)
+        for item in (value if isinstance(value, list) else [value] if value else []):
+            values.add(str(item).strip())
+    return values
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+def agreement(summary, baseline):
+    return {
+        "same_name": clean_name(summary["MAIN_ENTITY"]["NAME"]) == clean_name(baseline["MAIN_ENTITY"]["NAME"]),
+        **{ key.lower(): round(jaccard(attributeValues(summary, key), attributeValues(baseline, key)), 2) for key in LIST_ATTRIBUTES }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare document summary latency and agreement")
+    parser.add_argument("documents", nargs="+")
+    parser.add_argument("--configs", nargs="+", default=["SINGLE/FIRST", "MAP_REDUCE/FIRST", "SINGLE/CLUSTER", "MAP_REDUCE/CLUSTER"])
+    parser.add_argument("--max-summary-tokens", type=int, default=26000)
+    args = parser.parse_args()
+
+    configs = ["SINGLE/FIRST"] + [config for config in args.configs if config != "SINGLE/FIRST"]
+    for path in args.documents:
+        chunks = splitDocument(loadPages(path))
+        summaryChunkCount = max(1, min(countChunksWithinTokens(chunks, args.max_summary_tokens), len(chunks)-1))
+        print(f"\n{path} ({len(chunks)} chunks, {summaryChunkCount} for the summary)")
+        baseline = None
+        for config in configs:
+            mode, selection = config.upper().split("/")
+            start_time = time.time()
+            summary = generateDocumentSummary(chunks, summaryChunkCount, mode=mode, selection=selection)
+            seconds = time.time() - start_time
+            baseline = baseline or summary
+            print(json.dumps({"config": config, "seconds": round(seconds, 1), "name": summary["MAIN_ENTITY"]["NAME"], **agreement(summary, baseline)}))
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ from aws_cdk import (
     aws_s3 as s3,
     CfnOutput,
     aws_sqs as sqs,
+    aws_sns as sns,
+    aws_sns_subscriptions as sns_subscriptions,
     aws_lambda as _lambda,
     aws_iam as iam,
     aws_s3_notifications as s3_notifications,
@@ -192,11 +194,12 @@ class CdkStack(Stack):
         # Output the Cluster Endpoint
         output("Neptune Cluster Endpoint", neptune_cluster.cluster_endpoint.socket_address)
 
-        # Create DynamoDB table for ingestion
-        table_name = f"{project_name}-ingestion"
+        # Create DynamoDB table for ingestion records, keyed by document (processing_id) and "<record type>#<id>"
+        table_name = f"{project_name}-ingestion-records"
         ddbtbl_ingestion = dynamodb.Table(self, id=table_name,
             table_name=table_name,
-            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            partition_key=dynamodb.Attribute(name="pk", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="sk", type=dynamodb.AttributeType.STRING),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             point_in_time_recovery=True,
             time_to_live_attribute="ttl_timestamp",
@@ -249,6 +252,41 @@ class CdkStack(Stack):
         )
         output("DynamoDB table for processing status", ddbtbl_processing_status.table_name)
 
+        # Create DynamoDB table for document registry (content hash deduplication)
+        table_name = f"{project_name}-document-registry"
+        ddbtbl_document_registry = dynamodb.Table(self, id=table_name,
+            table_name=table_name,
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="ttl_timestamp", # cached chunk results
+            point_in_time_recovery=True,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        output("DynamoDB table for document registry", ddbtbl_document_registry.table_name)
+
+        # Create DynamoDB table for the Bedrock rate limiter (shared token buckets)
+        table_name = f"{project_name}-rate-limiter"
+        ddbtbl_rate_limiter = dynamodb.Table(self, id=table_name,
+            table_name=table_name,
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            point_in_time_recovery=True,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        output("DynamoDB table for rate limiter", ddbtbl_rate_limiter.table_name)
+
+        # Create DynamoDB table for cached Bedrock completions
+        table_name = f"{project_name}-bedrock-cache"
+        ddbtbl_bedrock_cache = dynamodb.Table(self, id=table_name,
+            table_name=table_name,
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            point_in_time_recovery=True,
+            time_to_live_attribute="ttl_timestamp",
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        output("DynamoDB table for Bedrock cache", ddbtbl_bedrock_cache.table_name)
+
         # Create S3 Bucket for access logging - ingestion
         s3_server_access_log_bucket_ingestion = s3.Bucket(self, f"{project_name}-server-access-log-bucket-ingestion",
             removal_policy=RemovalPolicy.DESTROY,
@@ -292,6 +330,26 @@ class CdkStack(Stack):
             server_access_logs_bucket=s3_server_access_log_bucket_ingestion,
             enforce_ssl=True,
             versioned=True,
+            lifecycle_rules=[
+                # page text cached by connectionsinsights.extraction
+                s3.LifecycleRule(
+                    prefix="extraction_cache/",
+                    expiration=Duration.days(30),
+                    noncurrent_version_expiration=Duration.days(1)
+                ),
+                # Textract inputs and text layers of the hybrid extractor left behind by failed executions
+                s3.LifecycleRule(
+                    prefix="textract_input/",
+                    expiration=Duration.days(2),
+                    noncurrent_version_expiration=Duration.days(1)
+                ),
+                # Bedrock completions too large for the bedrock-cache table (BEDROCK_CACHE_TTL_SECONDS is 7 days)
+                s3.LifecycleRule(
+                    prefix="bedrock-cache/",
+                    expiration=Duration.days(8),
+                    noncurrent_version_expiration=Duration.days(1)
+                )
+            ],
             cors=[
                 s3.CorsRule(
                     allowed_methods=[s3.HttpMethods.PUT, s3.HttpMethods.POST],
@@ -342,7 +400,7 @@ class CdkStack(Stack):
             visibility_timeout=Duration.minutes(15),
             removal_policy=RemovalPolicy.DESTROY,
             dead_letter_queue=sqs.DeadLetterQueue(
-                max_receive_count=2,
+                max_receive_count=3, # records left unprocessed at the end of a batch are received again
                 queue=news_queue_dlq
             ),
             enforce_ssl=True
@@ -362,6 +420,22 @@ class CdkStack(Stack):
             enforce_ssl=True
         )
 
+        # Create SNS Topic - Textract job completion, so the state machine waits on a task token instead of a
+        # Lambda polling the job
+        textract_topic = sns.Topic(
+            self,
+            f"{project_name}-textract-complete",
+            topic_name=f"{project_name}-textract-complete",
+            enforce_ssl=True
+        )
+        textract_topic.apply_removal_policy(RemovalPolicy.DESTROY)
+        role_textract_sns = iam.Role(self,
+            f"{project_name}-textract_sns_role",
+            assumed_by=iam.ServicePrincipal("textract.amazonaws.com")
+        )
+        textract_topic.grant_publish(role_textract_sns)
+        role_textract_sns.apply_removal_policy(RemovalPolicy.DESTROY)
+
 
 
 
@@ -416,6 +490,7 @@ class CdkStack(Stack):
                                 "dynamodb:Scan",
                                 "dynamodb:Query",
                                 "dynamodb:GetItem",
+                                "dynamodb:BatchGetItem",
                                 "dynamodb:BatchWriteItem",
                             ],
                             resources=[
@@ -423,7 +498,10 @@ class CdkStack(Stack):
                                 ddbtbl_news.table_arn,
                                 ddbtbl_settings.table_arn,
                                 ddbtbl_prompts.table_arn,
-                                ddbtbl_processing_status.table_arn
+                                ddbtbl_processing_status.table_arn,
+                                ddbtbl_document_registry.table_arn,
+                                ddbtbl_rate_limiter.table_arn,
+                                ddbtbl_bedrock_cache.table_arn
                             ]
                         )
                     ]
@@ -438,6 +516,10 @@ class CdkStack(Stack):
                                 f"arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-sonnet-4-6",
                                 f"arn:aws:bedrock:us-east-2::foundation-model/anthropic.claude-sonnet-4-6",
                                 f"arn:aws:bedrock:us-west-2::foundation-model/anthropic.claude-sonnet-4-6",
+                                f"arn:aws:bedrock:{self.region}:{self.account}:inference-profile/us.anthropic.claude-haiku-4-5-20251001-v1:0",
+                                f"arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-haiku-4-5-20251001-v1:0",
+                                f"arn:aws:bedrock:us-east-2::foundation-model/anthropic.claude-haiku-4-5-20251001-v1:0",
+                                f"arn:aws:bedrock:us-west-2::foundation-model/anthropic.claude-haiku-4-5-20251001-v1:0",
                                 f"arn:aws:bedrock:{self.region}::foundation-model/amazon.titan-embed-text-v1"
                             ]
                         )
@@ -533,7 +615,9 @@ class CdkStack(Stack):
                         iam.PolicyStatement(
                             effect=iam.Effect.ALLOW,
                             actions=[
-                                "states:StartExecution"
+                                "states:StartExecution",
+                                "states:SendTaskSuccess",
+                                "states:SendTaskFailure"
                             ],
                             resources=[
                                 f"arn:aws:states:{self.region}:{self.account}:stateMachine:{project_name}-state-machine"
@@ -565,6 +649,15 @@ class CdkStack(Stack):
                             resources=[
                                 f"*"
                             ]
+                        ),
+                        iam.PolicyStatement(
+                            effect=iam.Effect.ALLOW,
+                            actions=[
+                                "iam:PassRole"
+                            ],
+                            resources=[
+                                role_textract_sns.role_arn
+                            ]
                         )
                     ]
                 )             
@@ -585,7 +678,8 @@ class CdkStack(Stack):
             environment={
                 'NEPTUNE_ENDPOINT': neptune_cluster.cluster_endpoint.socket_address,
                 'S3_BUCKET': s3_news_bucket.bucket_name,
-                'DDBTBL_PROMPTS': ddbtbl_prompts.table_name
+                'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
+                'DDBTBL_RATE_LIMITER': ddbtbl_rate_limiter.table_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             vpc=neptune_cluster.vpc,
@@ -749,7 +843,8 @@ class CdkStack(Stack):
             timeout=Duration.minutes(15),
             role=role_lambda,
             environment={
-                'DDBTBL_NEWS': ddbtbl_news.table_name
+                'DDBTBL_NEWS': ddbtbl_news.table_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             memory_size=1024,
@@ -768,7 +863,8 @@ class CdkStack(Stack):
             timeout=Duration.minutes(15),
             role=role_lambda,
             environment={
-                'NEPTUNE_ENDPOINT': neptune_cluster.cluster_endpoint.socket_address
+                'NEPTUNE_ENDPOINT': neptune_cluster.cluster_endpoint.socket_address,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             vpc=neptune_cluster.vpc,
@@ -851,7 +947,9 @@ class CdkStack(Stack):
             role=role_lambda,
             environment={
                 'QUEUE_NAME': reports_queue.queue_name,
-                'DDBTBL_PROMPTS': ddbtbl_prompts.table_name
+                'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name,
+                'CLAIM_STALE_HOURS': '24'
             },
             tracing=_lambda.Tracing.ACTIVE,
             memory_size=1024,
@@ -895,7 +993,15 @@ class CdkStack(Stack):
                 'DDBTBL_SETTINGS': ddbtbl_settings.table_name,
                 'NEPTUNE_ENDPOINT': neptune_cluster.cluster_endpoint.socket_address,
                 'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
-                'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name
+                'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name,
+                'CLAIM_STALE_HOURS': '24',
+                'NEAR_DUPLICATE_THRESHOLD': '0.85',
+                'DDBTBL_RATE_LIMITER': ddbtbl_rate_limiter.table_name,
+                'BEDROCK_PRIORITY': 'INTERACTIVE',
+                'DDBTBL_BEDROCK_CACHE': ddbtbl_bedrock_cache.table_name,
+                'BEDROCK_CACHE_BACKEND': 'DYNAMODB',
+                'BEDROCK_CACHE_S3_BUCKET': s3_ingestion_bucket.bucket_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             vpc=neptune_cluster.vpc,
@@ -939,13 +1045,45 @@ class CdkStack(Stack):
                 'DDBTBL_INGESTION': ddbtbl_ingestion.table_name,
                 'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
                 'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name,
-                'EXTRACTOR': 'TEXTRACT'
+                'EXTRACTOR': 'HYBRID',
+                'TEXTRACT_SNS_TOPIC_ARN': textract_topic.topic_arn,
+                'TEXTRACT_SNS_ROLE_ARN': role_textract_sns.role_arn,
+                'DDBTBL_RATE_LIMITER': ddbtbl_rate_limiter.table_name,
+                'DDBTBL_BEDROCK_CACHE': ddbtbl_bedrock_cache.table_name,
+                'BEDROCK_CACHE_BACKEND': 'DYNAMODB',
+                'BEDROCK_CACHE_S3_BUCKET': s3_ingestion_bucket.bucket_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name,
+                'SUMMARY_MODE': 'MAP_REDUCE',
+                'SUMMARY_SELECTION': 'FIRST',
+                'PRESCREEN': 'HEURISTIC',
+                'PRESCREEN_ACTION': 'SMALL_MODEL',
+                'CHUNK_BATCH_SIZE': '4'
             },
             tracing=_lambda.Tracing.ACTIVE, 
             memory_size=10240
         )
         fn_step_function_chunk_doc.apply_removal_policy(RemovalPolicy.DESTROY)
 
+        # Create Lambda Functions - Step Function - Textract Complete
+        function_name = f"{project_name}-step_function-textract-complete"
+        fn_step_function_textract_complete = _lambda.Function(self, function_name,
+            function_name=function_name,
+            runtime=_lambda.Runtime.PYTHON_3_13,
+            handler="index.lambda_handler",
+            code=_lambda.Code.from_asset("./lambda-ecs/step-function/01.textract-complete"),
+            layers=[layer_lambda],
+            timeout=Duration.minutes(1),
+            role=role_lambda,
+            environment={
+                'DDBTBL_INGESTION': ddbtbl_ingestion.table_name
+            },
+            tracing=_lambda.Tracing.ACTIVE,
+            memory_size=256,
+            architecture=_lambda.Architecture.X86_64 
+        )
+        fn_step_function_textract_complete.apply_removal_policy(RemovalPolicy.DESTROY)
+        textract_topic.add_subscription(sns_subscriptions.LambdaSubscription(fn_step_function_textract_complete))
+
         # Create Lambda Functions - Step Function - Process Chunks
         function_name = f"{project_name}-step_function-process-chunks"
         fn_step_function_process_chunks = _lambda.Function(self, function_name,
@@ -959,6 +1097,12 @@ class CdkStack(Stack):
             environment={
                 'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
                 'DDBTBL_INGESTION': ddbtbl_ingestion.table_name,
+                'DDBTBL_RATE_LIMITER': ddbtbl_rate_limiter.table_name,
+                'DDBTBL_BEDROCK_CACHE': ddbtbl_bedrock_cache.table_name,
+                'BEDROCK_CACHE_BACKEND': 'DYNAMODB',
+                'BEDROCK_CACHE_S3_BUCKET': s3_ingestion_bucket.bucket_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name,
+                'PROCESS_CHUNKS_WORKERS': '4'
             }, 
             tracing=_lambda.Tracing.ACTIVE,
             memory_size=1024,
@@ -999,7 +1143,11 @@ class CdkStack(Stack):
             role=role_lambda,
             environment={
                 'DDBTBL_INGESTION': ddbtbl_ingestion.table_name,
-                'DDBTBL_PROMPTS': ddbtbl_prompts.table_name
+                'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
+                'DDBTBL_RATE_LIMITER': ddbtbl_rate_limiter.table_name,
+                'DDBTBL_BEDROCK_CACHE': ddbtbl_bedrock_cache.table_name,
+                'BEDROCK_CACHE_BACKEND': 'DYNAMODB',
+                'BEDROCK_CACHE_S3_BUCKET': s3_ingestion_bucket.bucket_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             memory_size=1024,
@@ -1022,6 +1170,10 @@ class CdkStack(Stack):
                 'DDBTBL_INGESTION': ddbtbl_ingestion.table_name,
                 'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name,
                 'NEPTUNE_ENDPOINT': neptune_cluster.cluster_endpoint.socket_address,
+                'DDBTBL_RATE_LIMITER': ddbtbl_rate_limiter.table_name,
+                'DDBTBL_BEDROCK_CACHE': ddbtbl_bedrock_cache.table_name,
+                'BEDROCK_CACHE_BACKEND': 'DYNAMODB',
+                'BEDROCK_CACHE_S3_BUCKET': s3_ingestion_bucket.bucket_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             vpc=neptune_cluster.vpc,
@@ -1045,7 +1197,8 @@ class CdkStack(Stack):
             environment={
                 'QUEUE_NAME': reports_queue.queue_name,
                 'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
-                'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name
+                'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             memory_size=1024,
@@ -1066,7 +1219,8 @@ class CdkStack(Stack):
             environment={
                 'QUEUE_NAME': reports_queue.queue_name,
                 'DDBTBL_PROMPTS': ddbtbl_prompts.table_name,
-                'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name
+                'DDBTBL_PROCESSING_STATUS': ddbtbl_processing_status.table_name,
+                'DDBTBL_DOCUMENT_REGISTRY': ddbtbl_document_registry.table_name
             },
             tracing=_lambda.Tracing.ACTIVE,
             memory_size=1024,
@@ -1138,10 +1292,19 @@ class CdkStack(Stack):
                     ddbtbl_ingestion.table_arn,
                     ddbtbl_news.table_arn,
                     ddbtbl_settings.table_arn,
-                    ddbtbl_prompts.table_arn
+                    ddbtbl_prompts.table_arn,
+                    ddbtbl_rate_limiter.table_arn,
+                    ddbtbl_bedrock_cache.table_arn
                 ]
             )
         )
+        taskdef_insert_vertices.add_to_task_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["s3:GetObject", "s3:PutObject"],
+                resources=[s3_ingestion_bucket.arn_for_objects("bedrock-cache/*")]
+            )
+        )
         taskdef_insert_vertices.add_to_task_role_policy(
             iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
@@ -1407,6 +1570,7 @@ class CdkStack(Stack):
                 result_path="$.output",
                 payload=sfn.TaskInput.from_object({
                     "ReceiptHandle.$": "$.StateInfo.ReceiptHandle",
+                    "S3File.$": "$.StateInfo.S3File",
                     "processing_id.$": "$.processing_id",
                     "Error.$": "$.output"
                 }),
@@ -1451,6 +1615,29 @@ class CdkStack(Stack):
             )
             return task
         
+        def sfnInvokeLambdaStartExtraction():
+            task = tasks.LambdaInvoke(
+                self, "StartExtraction",
+                state_name="Start Extraction",
+                integration_pattern=sfn.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                payload=sfn.TaskInput.from_object({
+                    "phase": "START_EXTRACTION",
+                    "StateInfo.$": "$.StateInfo",
+                    "TaskToken": sfn.JsonPath.task_token
+                }),
+                result_path="$.extraction",
+                task_timeout=sfn.Timeout.duration(Duration.hours(2)),
+                lambda_function=fn_step_function_chunk_doc,
+            )
+            task.add_retry(
+                errors=["States.ALL"],
+                interval=Duration.seconds(1),
+                max_attempts=3,
+                backoff_rate=2
+            )
+            task.add_catch(handler=errorHandler, result_path="$.output")
+            return task
+
         def sfnInvokeLambdaChunkDocuments():
             task = tasks.LambdaInvoke(
                 self, "ChunkDocument",
@@ -1480,7 +1667,10 @@ class CdkStack(Stack):
         
         def sfnDynamoGetItem():
             return tasks.DynamoGetItem(self, "Get Item",
-                key={"id": tasks.DynamoAttributeValue.from_string(sfn.JsonPath.string_at("$.id"))},
+                key={
+                    "pk": tasks.DynamoAttributeValue.from_string(sfn.JsonPath.string_at("$.processing_id")),
+                    "sk": tasks.DynamoAttributeValue.from_string(sfn.JsonPath.format("group#{}", sfn.JsonPath.string_at("$.id")))
+                },
                 table=ddbtbl_ingestion,
                 result_path="$.output",
             )
@@ -1490,7 +1680,8 @@ class CdkStack(Stack):
                 self, "ProcessChunks",
                 state_name="Process Chunks",
                 payload=sfn.TaskInput.from_object({
-                    "id.$": "$.id",
+                    "processing_id.$": "$.processing_id",
+                    "ids.$": "$.ids",
                 }),
                 output_path="$.Payload",
                 lambda_function=fn_step_function_process_chunks,
@@ -1504,14 +1695,63 @@ class CdkStack(Stack):
             return task
         
         def sfnMapProcessChunks():
+            # runs in a branch of sfnParallelProcessChunksSummary, which catches its errors
             task = sfn.Map(self, "MapProcessChunks",
                 state_name="Map - Process Chunks",
                 items_path=sfn.JsonPath.string_at("$.output.Payload.uuid"),
                 result_path="$.output",                
             )
+            return task
+
+        def sfnInvokeLambdaGenerateSummary():
+            task = tasks.LambdaInvoke(
+                self, "GenerateSummary",
+                state_name="Generate Summary",
+                payload=sfn.TaskInput.from_object({
+                    "phase": "GENERATE_SUMMARY",
+                    "StateInfo.$": "$.StateInfo",
+                    "MainEntity.$": "$.Summary",
+                    "processing_id.$": "$.processing_id",
+                    "summaryChunkCount.$": "$.output.Payload.summaryChunkCount"
+                }),
+                output_path="$.Payload",
+                lambda_function=fn_step_function_chunk_doc,
+            )
+            task.add_retry(
+                errors=["States.ALL"],
+                interval=Duration.seconds(1),
+                max_attempts=3,
+                backoff_rate=2
+            )
+            return task
+
+        def sfnParallelProcessChunksSummary():
+            # the chunks are extracted with the main entity identified by Chunk Document while the full
+            # summary is generated
+            task = sfn.Parallel(self, "ParallelProcessChunksSummary",
+                state_name="Parallel - Process Chunks & Summary",
+                result_selector={
+                    "output.$": "$[0].output",
+                    "Summary.$": "$[1]"
+                },
+                result_path="$.parallel"
+            )
+            task.branch(sfnMapProcessChunks().item_processor(sfnInvokeLambdaProcessChunks()))
+            task.branch(sfnInvokeLambdaGenerateSummary())
             task.add_catch(handler=errorHandler, result_path="$.output")
             return task
 
+        def sfnPassFormatOutputSummary():
+            return sfn.Pass(self, "FormatOutputSummary",
+                state_name="Format Output Summary",
+                parameters={
+                    "StateInfo.$": "$.StateInfo",
+                    "Summary.$": "$.parallel.Summary",
+                    "processing_id.$": "$.processing_id",
+                    "output.$": "$.parallel.output"
+                }
+            )
+
         def sfnInvokeLambdaConsolidateChunks():
             task = tasks.LambdaInvoke(
                 self, "ConsolidateChunks",
@@ -1608,7 +1848,11 @@ class CdkStack(Stack):
                         ),
                         tasks.TaskEnvironmentVariable(
                             name="uuid",
-                            value=sfn.JsonPath.string_at("$")
+                            value=sfn.JsonPath.string_at("$.id")
+                        ),
+                        tasks.TaskEnvironmentVariable(
+                            name="PROCESSING_ID",
+                            value=sfn.JsonPath.string_at("$.processing_id")
                         ),
                         tasks.TaskEnvironmentVariable(
                             name="TASK_TOKEN",
@@ -1618,6 +1862,22 @@ class CdkStack(Stack):
                             name="DDBTBL_INGESTION",
                             value=ddbtbl_ingestion.table_name
                         ),
+                        tasks.TaskEnvironmentVariable(
+                            name="DDBTBL_RATE_LIMITER",
+                            value=ddbtbl_rate_limiter.table_name
+                        ),
+                        tasks.TaskEnvironmentVariable(
+                            name="DDBTBL_BEDROCK_CACHE",
+                            value=ddbtbl_bedrock_cache.table_name
+                        ),
+                        tasks.TaskEnvironmentVariable(
+                            name="BEDROCK_CACHE_BACKEND",
+                            value="DYNAMODB"
+                        ),
+                        tasks.TaskEnvironmentVariable(
+                            name="BEDROCK_CACHE_S3_BUCKET",
+                            value=s3_ingestion_bucket.bucket_name
+                        ),
                         tasks.TaskEnvironmentVariable(
                             name="DDBTBL_PROMPTS",
                             value=ddbtbl_prompts.table_name
@@ -1642,6 +1902,7 @@ class CdkStack(Stack):
                     "Bucket.$": "$.StateInfo.S3File.S3_BUCKET",
                     "Key.$": "$.StateInfo.S3File.S3_KEY",
                     "ReceiptHandle.$": "$.StateInfo.ReceiptHandle",
+                    "S3File.$": "$.StateInfo.S3File",
                     "processing_id.$": "$.processing_id"
                 }),
                 lambda_function=fn_step_function_clean_up,
@@ -1656,13 +1917,11 @@ class CdkStack(Stack):
 
         def create_state_machine_definition():
             return sfnPassFormatInputS3FileReceiptHandle().next(
-                sfnInvokeLambdaChunkDocuments()
+                sfnInvokeLambdaStartExtraction()
+                .next(sfnInvokeLambdaChunkDocuments())
                 .next(sfnPassFormatInputSummary())
-                .next(sfnMapProcessChunks()
-                        .item_processor(
-                            sfnInvokeLambdaProcessChunks()
-                        )
-                )
+                .next(sfnParallelProcessChunksSummary())
+                .next(sfnPassFormatOutputSummary())
                 .next(sfnInvokeLambdaConsolidateChunks())
                 .next(sfnMapFilterRecords()
                         .item_processor(
@@ -1697,6 +1956,7 @@ class CdkStack(Stack):
             self, f"{project_name}-state-machine",
             state_machine_name=f"{project_name}-state-machine",
             definition_body=sfn.DefinitionBody.from_chainable(create_state_machine_definition()),
+            timeout=Duration.hours(12), # stale document registry claims are reclaimed after CLAIM_STALE_HOURS
             removal_policy=RemovalPolicy.DESTROY,
             tracing_enabled=True,
             logs=sfn.LogOptions(
@@ -1739,7 +1999,11 @@ class CdkStack(Stack):
         )
 
         fn_s3_pipeline_process_news.add_event_source(
-            lambda_event_sources.SqsEventSource(news_queue, batch_size=1)
+            lambda_event_sources.SqsEventSource(news_queue,
+                batch_size=5,
+                max_batching_window=Duration.seconds(30),
+                report_batch_item_failures=True
+            )
         )
 
         # Add S3 Event Notification to Lambda Functions - S3 Pipeline - Ingestion Trigger
@@ -4,7 +4,8 @@ import os
 from connectionsinsights.neptune import (
     getEntities,
     updateEntityInterested,
-    GraphConnect
+    runGraphQuery,
+    reportGraphMetrics
 )
 
 cors_headers = {
@@ -18,9 +19,8 @@ def lambda_handler(event, context):
     httpMethod = event["httpMethod"]
     
     if httpMethod == "GET":
-        g, connection = GraphConnect()
-        entities = getEntities(g)
-        connection.close()
+        entities = runGraphQuery(getEntities)
+        reportGraphMetrics()
         return {
             'statusCode': 200,
             'headers': cors_headers,
@@ -29,10 +29,9 @@ def lambda_handler(event, context):
     # If it's a POST request, update the specified entity's INTERESTED value based on ID
     elif httpMethod == "POST":
         try:
-            g, connection = GraphConnect()
             body = json.loads(event["body"])
-            updateEntityInterested(g, body["ID"], body["INTERESTED"])
-            connection.close()
+            runGraphQuery(lambda g: updateEntityInterested(g, body["ID"], body["INTERESTED"]))
+            reportGraphMetrics()
             return {
                 'statusCode': 200,
                 'headers': cors_headers,
@@ -8,7 +8,8 @@ import os
 
 from connectionsinsights.neptune import (
     getEntities,
-    GraphConnect
+    runGraphQuery,
+    reportGraphMetrics
 )
 
 from connectionsinsights.bedrock import (
@@ -53,8 +54,8 @@ def saveToS3(article):
     s3.put_object(Body=article, Bucket=s3_bucket, Key="news_"+str(uuid.uuid4())+".txt")
 
 def generateNews(num_of_articles):
-    g, connection = GraphConnect()
-    entityList = getEntities(g)
+    entityList = runGraphQuery(getEntities)
+    reportGraphMetrics()
     for i in range(0, num_of_articles):
         entities = []
         date = (datetime.date.today() - datetime.timedelta(days=random.randint(1, 100))).strftime("%d %b %Y")
@@ -72,7 +73,6 @@ def generateNews(num_of_articles):
         article = qb_generateArticle(date, interested, entities)
         saveToS3(article)
     
-    connection.close()
     return None
 
 def lambda_handler(event, context):
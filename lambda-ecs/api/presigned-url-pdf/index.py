@@ -22,6 +22,7 @@ def lambda_handler(event, context):
         # Extract file metadata
         file_name = body.get('fileName')
         file_size = body.get('fileSize', 0)
+        force_reingest = str(body.get('forceReingest', False)).lower() == 'true' # re-ingest even if identical content was processed before
         content_type = body.get('contentType', 'application/pdf')
         
         if not file_name:
@@ -61,6 +62,14 @@ def lambda_handler(event, context):
         # Generate timestamp for metadata
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         
+        metadata = {
+            'original-filename': file_name,
+            'upload-timestamp': timestamp,
+            'file-size': str(file_size)
+        }
+        if force_reingest:
+            metadata['force-reingest'] = 'true'
+        
         # Generate presigned URL for PUT operation
         presigned_url = s3_client.generate_presigned_url(
             'put_object',
@@ -68,11 +77,7 @@ def lambda_handler(event, context):
                 'Bucket': s3_bucket,
                 'Key': s3_key,
                 'ContentType': content_type,
-                'Metadata': {
-                    'original-filename': file_name,
-                    'upload-timestamp': timestamp,
-                    'file-size': str(file_size)
-                }
+                'Metadata': metadata
             },
             ExpiresIn=3600  # URL expires in 1 hour
         )
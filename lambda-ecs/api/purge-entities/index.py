@@ -1,6 +1,7 @@
 import json
 import os
-from connectionsinsights.neptune import GraphConnect
+from connectionsinsights.neptune import getGraph, invalidateGraph, isConnectionError, reportGraphMetrics
+from connectionsinsights.registry import purgeDocuments, FILE_TYPE_CHUNK_RESULT
 
 cors_headers = {
     'Access-Control-Allow-Origin': '*',
@@ -49,14 +50,13 @@ def lambda_handler(event, context):
 def handle_purge_entities():
     """Handle DELETE request to purge all entities and relationships from Neptune"""
     try:
-        g, connection = GraphConnect()
+        g = getGraph()
         
         # Count entities and relationships before deletion
         vertex_count = g.V().count().next()
         edge_count = g.E().count().next()
         
         if vertex_count == 0 and edge_count == 0:
-            connection.close()
             return {
                 'statusCode': 200,
                 'headers': cors_headers,
@@ -80,9 +80,16 @@ def handle_purge_entities():
         remaining_vertices = g.V().count().next()
         remaining_edges = g.E().count().next()
         
-        connection.close()
+        reportGraphMetrics()
         
         if remaining_vertices == 0 and remaining_edges == 0:
+            # Allow previously ingested reports to be ingested again
+            try:
+                purgeDocuments('financial_document')
+                purgeDocuments(FILE_TYPE_CHUNK_RESULT)
+            except Exception as e:
+                print(f"Error purging reports from document registry: {str(e)}")
+            
             return {
                 'statusCode': 200,
                 'headers': cors_headers,
@@ -108,6 +115,8 @@ def handle_purge_entities():
         
     except Exception as e:
         print(f"Error purging entities: {str(e)}")
+        if isConnectionError(e):
+            invalidateGraph()
         return {
             'statusCode': 500,
             'headers': cors_headers,
@@ -3,6 +3,9 @@ import boto3
 import os
 from boto3.dynamodb.conditions import Attr
 
+from connectionsinsights.registry import purgeDocuments
+from connectionsinsights.similarity import SIGNATURE_FILE_TYPE
+
 cors_headers = {
     'Access-Control-Allow-Origin': '*',
     'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
@@ -80,6 +83,13 @@ def handle_purge_news():
                 batch.delete_item(Key={'id': item['id']})
                 deleted_count += 1
         
+        # Allow previously seen news files to be ingested again, and drop the near-duplicate index
+        try:
+            purgeDocuments('news')
+            purgeDocuments(SIGNATURE_FILE_TYPE)
+        except Exception as e:
+            print(f"Error purging news from document registry: {str(e)}")
+        
         return {
             'statusCode': 200,
             'headers': cors_headers,
@@ -4,7 +4,11 @@ import boto3
 from botocore.exceptions import ClientError
 
 from connectionsinsights.neptune import (
-    GraphConnect,
+    getGraph,
+    runGraphQuery,
+    invalidateGraph,
+    isConnectionError,
+    reportGraphMetrics,
     getEntities,
     findVertexByLabelandName,
     formatResultsFindVertex
@@ -29,20 +33,20 @@ def lambda_handler(event, context):
                 search_term = query_params["search"]
                 label = query_params.get("label", None)  # Optional filter by label
                 
-                g, connection = GraphConnect()
-                
-                if label:
-                    # Search within specific label
-                    results = findVertexByLabelandName(g, label, search_term, False)
-                else:
-                    # Search across all entities - case insensitive substring search
-                    from gremlin_python.process.traversal import TextP
-                    # Use case-insensitive regex pattern for substring search
-                    regex_pattern = r'(?i).*' + search_term + r'.*'
-                    results = g.V().has('NAME', TextP.regex(regex_pattern)).elementMap().toList()
-                    results = formatResultsFindVertex(g, results)
-                
-                connection.close()
+                def search(g):
+                    if label:
+                        # Search within specific label
+                        return findVertexByLabelandName(g, label, search_term, False)
+                    else:
+                        # Search across all entities - case insensitive substring search
+                        from gremlin_python.process.traversal import TextP
+                        # Use case-insensitive regex pattern for substring search
+                        regex_pattern = r'(?i).*' + search_term + r'.*'
+                        results = g.V().has('NAME', TextP.regex(regex_pattern)).elementMap().toList()
+                        return formatResultsFindVertex(g, results)
+                
+                results = runGraphQuery(search)
+                reportGraphMetrics()
                 
                 return {
                     'statusCode': 200,
@@ -54,12 +58,11 @@ def lambda_handler(event, context):
                 # Get entity details and its immediate relationships
                 entity_id = query_params["entity_id"]
                 
-                g, connection = GraphConnect()
+                g = getGraph()
                 
                 # Get entity details
                 entity_result = g.V(entity_id).elementMap().toList()
                 if not entity_result:
-                    connection.close()
                     return {
                         'statusCode': 404,
                         'headers': cors_headers,
@@ -118,7 +121,7 @@ def lambda_handler(event, context):
                         "properties": {k: v for k, v in edge.items() if k not in [Direction.OUT, Direction.IN, T.id, T.label]}
                     })
                 
-                connection.close()
+                reportGraphMetrics()
                 
                 # Count unexplored relationships
                 relationship_count = len(relationships)
@@ -142,9 +145,8 @@ def lambda_handler(event, context):
             
             else:
                 # Default: return all entities for initial load
-                g, connection = GraphConnect()
-                entities = getEntities(g)
-                connection.close()
+                entities = runGraphQuery(getEntities)
+                reportGraphMetrics()
                 
                 return {
                     'statusCode': 200,
@@ -161,6 +163,8 @@ def lambda_handler(event, context):
             
     except Exception as e:
         print(f"Error in relationships API: {str(e)}")
+        if isConnectionError(e):
+            invalidateGraph()
         return {
             'statusCode': 500,
             'headers': cors_headers,
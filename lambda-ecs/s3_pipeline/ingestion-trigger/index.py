@@ -1,10 +1,39 @@
 import json
 import boto3
 import os
+import urllib.parse
+
+from connectionsinsights.registry import (
+    hashS3Object,
+    isForceReingest,
+    claimDocument
+)
+
+TEXTRACT_INPUT_PREFIX = "textract_input/" # see connectionsinsights.extraction
 
 def lambda_handler(event, context):
     s3_bucket = event['Records'][0]['s3']['bucket']['name']
     s3_key = event['Records'][0]['s3']['object']['key']
+    s3_key_decoded = urllib.parse.unquote_plus(s3_key)
+
+    # Pages submitted to Textract by the hybrid extractor are not reports to ingest
+    if s3_key_decoded.startswith(TEXTRACT_INPUT_PREFIX):
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Textract input skipped')
+        }
+
+    # Skip exact duplicates (by content hash) before any Textract / Bedrock spend
+    content_hash, metadata = hashS3Object(s3_bucket, s3_key_decoded)
+    claimed, existing = claimDocument(content_hash, 'financial_document', s3_key_decoded, force=isForceReingest(metadata))
+    if not claimed:
+        print(f"Skipping duplicate upload {s3_key_decoded}: identical to {existing['s3_key']} ({existing['status']})")
+        s3 = boto3.client('s3')
+        s3.delete_object(Bucket=s3_bucket, Key=s3_key_decoded)
+        return {
+            'statusCode': 200,
+            'body': json.dumps('Duplicate skipped')
+        }
 
     sqs = boto3.client('sqs', region_name=os.environ["AWS_REGION"])
     queue_url = sqs.get_queue_url(QueueName=os.environ["QUEUE_NAME"])['QueueUrl']
@@ -14,7 +43,8 @@ def lambda_handler(event, context):
         MessageGroupId="ingestion",
         MessageBody=json.dumps({
           "S3_BUCKET": s3_bucket,
-          "S3_KEY": s3_key
+          "S3_KEY": s3_key,
+          "CONTENT_HASH": content_hash
         })
     )
 
@@ -11,6 +11,7 @@ from connectionsinsights.bedrock import (
     getTextWithinTags,
     cleanJSONString,
     uppercase,
+    reportBedrockMetrics
 )
 import botocore.exceptions
 
@@ -20,7 +21,9 @@ from connectionsinsights.dynamodb import (
 
 from connectionsinsights.neptune import (
     findVertexWithinNHops,
-    GraphConnect  
+    getGraph,
+    invalidateGraph,
+    reportGraphMetrics
 )
 
 from connectionsinsights.utils import (
@@ -29,10 +32,28 @@ from connectionsinsights.utils import (
     mark_processing_failed
 )
 
+from connectionsinsights.registry import (
+    hashContent,
+    isForceReingest,
+    claimDocument,
+    updateDocumentStatus,
+    STATUS_COMPLETED,
+    STATUS_FAILED
+)
+
+from connectionsinsights.similarity import (
+    minhashSignature,
+    findNearDuplicate,
+    indexSignature,
+    removeSignature
+)
+
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ["DDBTBL_NEWS"])
 
+MIN_REMAINING_TIME_MS = 5 * 60 * 1000 # an article can take several minutes of Bedrock calls
+
 def qb_extractDataFromArticle(article):
     format = """
 [{
@@ -62,7 +83,7 @@ Print them out in a JSON array in the following format within <entities></entiti
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            completion = queryBedrockStreaming(messages)
+            completion = queryBedrockStreaming(messages, stop_tag="entities", validate=lambda completion: isValidJson(cleanJSONString(getTextWithinTags(completion, "entities"))))
             entities = getTextWithinTags(completion, "entities")
             return cleanJSONString(entities)
         except botocore.exceptions.ClientError as e:
@@ -132,7 +153,7 @@ Based on the impact of the news to <news_entity> and the <path> provided, perfor
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            completion = queryBedrockStreaming(messages)
+            completion = queryBedrockStreaming(messages, stop_tag="impact") # <impact> is printed after <result>
             impact = getTextWithinTags(completion, "impact")
             result = getTextWithinTags(completion, "result")
             return result, impact
@@ -166,13 +187,75 @@ Based on the impact of the news to <news_entity> and the <path> provided, perfor
                 return "Unable to assess impact due to unexpected error", "NEUTRAL"
 
 
-def processArticle(article, processing_id=None):
+def saveArticle(article, entities, paths, interested_entities, **attributes):
+    current_timestamp = time.time()
+    dt_object = datetime.fromtimestamp(current_timestamp)
+    formatted_time = dt_object.strftime("%Y-%m-%d %H:%M")
+    
+    news_id = str(uuid.uuid4())
+    table.put_item(
+        Item={
+            'id': news_id,
+            'date': getTextWithinTags(article, "date"),
+            'title': getTextWithinTags(article, "title"),
+            'text': getTextWithinTags(article, "text"),
+            'url': getTextWithinTags(article, "url"),
+            'timestamp': formatted_time,
+            'interested': "YES" if len(paths) > 0 else "NO",
+            'entities': entities,
+            'paths': paths,
+            'interested_entities': list(interested_entities),
+            **attributes
+        }
+    )
+    return news_id
+
+def articleSignature(article):
+    # signature over the title and body only, as date/url differ between republished copies
+    return minhashSignature(getTextWithinTags(article, "title") + "\n" + getTextWithinTags(article, "text"))
+
+def processNearDuplicate(article, signature, processing_id=None):
+    # Reuse the extracted entities and paths of a near-duplicate (canonical) article without calling Bedrock
+    canonical_id, similarity = findNearDuplicate(signature)
+    if canonical_id is None:
+        return None
+    
+    canonical = table.get_item(Key={"id": canonical_id}).get("Item")
+    if canonical is None:
+        return None # canonical article has since been purged or reprocessed
+    
+    print(f"Near-duplicate of news {canonical_id} (similarity {similarity:.2f}), reusing its entities and paths")
+    if processing_id:
+        increment_processing_status(processing_id)
+    return saveArticle(
+        article,
+        canonical.get("entities", []),
+        canonical.get("paths", []),
+        canonical.get("interested_entities", []),
+        duplicate_of=canonical_id,
+        duplicate_similarity=str(round(similarity, 2))
+    )
+
+class BatchResources:
+    """Settings snapshot shared by all records of an SQS batch; the graph connection is reused across invocations"""
+    def __init__(self):
+        self.value_of_n = None
+    
+    def get(self):
+        if self.value_of_n is None:
+            self.value_of_n = getN()
+        return getGraph(), self.value_of_n
+    
+    def reset(self):
+        # drop a connection that may be broken so the next record reconnects
+        invalidateGraph()
+
+def processArticle(article, resources, processing_id=None):
     # Increment processing status (step 0 -> 1)
     if processing_id:
         increment_processing_status(processing_id)
     
-    g, connection = GraphConnect()
-    value_of_n = getN() 
+    g, value_of_n = resources.get()
     entities = qb_extractDataFromArticle(article)
     entities = uppercase(json.loads(entities))
     paths = []
@@ -203,24 +286,14 @@ def processArticle(article, processing_id=None):
             for path in pathsArray:
                 interested_entities.add(path["interested_entity"])
     
-    current_timestamp = time.time()
-    dt_object = datetime.fromtimestamp(current_timestamp)
-    formatted_time = dt_object.strftime("%Y-%m-%d %H:%M")
+    news_id = saveArticle(article, entities, paths, interested_entities)
     
-    table.put_item(
-        Item={
-            'id': str(uuid.uuid4()),
-            'date': getTextWithinTags(article, "date"),
-            'title': getTextWithinTags(article, "title"),
-            'text': getTextWithinTags(article, "text"),
-            'url': getTextWithinTags(article, "url"),
-            'timestamp': formatted_time,
-            'interested': "YES" if len(paths) > 0 else "NO",
-            'paths': paths,
-            'interested_entities': list(interested_entities)
-        }
-    )
-    connection.close()
+    # Index the article so that later near-duplicates can reuse its results
+    try:
+        indexSignature(news_id, articleSignature(article))
+    except Exception as e:
+        print(f"Failed to index news signature: {str(e)}")
+    return news_id
     
 
 
@@ -231,35 +304,92 @@ def isValidJson(text):
     except:
         return False
 
-def lambda_handler(event, context):
+def processRecord(record, resources):
     processing_id = None
-    try:
-        body = event["Records"][0]["body"]
-        if isValidJson(body):
-            # process news file
-            body = json.loads(body)
-            s3_bucket = body["Records"][0]["s3"]["bucket"]["name"]
-            s3_key = body["Records"][0]["s3"]["object"]["key"]
+    body = record["body"]
+    if isValidJson(body):
+        # process news file
+        body = json.loads(body)
+        if "Records" not in body:
+            print("Ignoring message without S3 records:", body) # e.g. s3:TestEvent
+            return
+        s3_bucket = body["Records"][0]["s3"]["bucket"]["name"]
+        s3_key = body["Records"][0]["s3"]["object"]["key"]
+        
+        s3_key_decoded = urllib.parse.unquote_plus(s3_key)
+        response = s3.get_object(Bucket=s3_bucket, Key=s3_key_decoded)
+        file_bytes = response['Body'].read()
+        file_content = file_bytes.decode('utf-8')
+        
+        # Skip exact duplicates (by content hash) before any Bedrock spend
+        content_hash = hashContent(file_bytes)
+        claimed, existing = claimDocument(content_hash, 'news', s3_key_decoded, force=isForceReingest(response.get('Metadata', {})))
+        if not claimed:
+            print(f"Skipping duplicate news {s3_key_decoded}: identical to {existing['s3_key']} ({existing['status']})")
+            s3.delete_object(Bucket=s3_bucket, Key=s3_key_decoded)
+            return
+        
+        # Extract filename from S3 key
+        file_name = s3_key_decoded.split('/')[-1]
+        
+        # Create processing status record
+        processing_id = create_processing_status(file_name, 'news')
+    
+        try:
+            news_id = processNearDuplicate(file_content, articleSignature(file_content), processing_id)
+            if news_id is None:
+                news_id = processArticle(file_content, resources, processing_id)
             
-            s3_key_decoded = urllib.parse.unquote_plus(s3_key)
-            response = s3.get_object(Bucket=s3_bucket, Key=s3_key_decoded)
-            file_content = response['Body'].read().decode('utf-8')
+            # Increment processing status to completed (step 1 -> 2)
+            increment_processing_status(processing_id, is_final_step=True)
+            updateDocumentStatus(content_hash, STATUS_COMPLETED, news_id=news_id)
             
-            # Extract filename from S3 key
-            file_name = s3_key_decoded.split('/')[-1]
+            s3.delete_object(Bucket=s3_bucket, Key=s3_key_decoded)
+        except Exception as process_error:
+            print(f"Error processing article: {str(process_error)}")
+            try:
+                updateDocumentStatus(content_hash, STATUS_FAILED)
+            except Exception as registry_error:
+                print(f"Failed to update document registry: {str(registry_error)}")
+            # Mark as failed in processing status
+            if processing_id:
+                try:
+                    mark_processing_failed(processing_id, str(process_error))
+                except Exception as status_error:
+                    print(f"Failed to update error status: {str(status_error)}")
+            raise process_error
             
-            # Create processing status record
-            processing_id = create_processing_status(file_name, 'news')
+    else:
+        # re-process existing news article in DynamoDB
+        response = table.get_item(Key={"id": body})
         
+        if 'Item' in response:
+            file_content = """
+            <date>{date}</date>
+            <title>{title}</title>
+            <text>{text}</text>
+            <url>{url}</url>
+            """.format(date=response['Item']['date'] if 'date' in response['Item'] else "", 
+                       title=response['Item']['title'] if 'title' in response['Item'] else "",  
+                       text=response['Item']['text'] if 'text' in response['Item'] else "",
+                       url=response['Item']['url'] if "url" in response['Item'] else "")
+            
+            # Create processing status for reprocessing
+            processing_id = create_processing_status(f"Reprocess: {response['Item'].get('title', 'Unknown')}", 'news')
+            
             try:
-                processArticle(file_content, processing_id)
+                processArticle(file_content, resources, processing_id)
                 
                 # Increment processing status to completed (step 1 -> 2)
                 increment_processing_status(processing_id, is_final_step=True)
                 
-                s3.delete_object(Bucket=s3_bucket, Key=s3_key_decoded)
+                table.delete_item(Key={"id": body})
+                try:
+                    removeSignature(body)
+                except Exception as e:
+                    print(f"Failed to remove news signature: {str(e)}")
             except Exception as process_error:
-                print(f"Error processing article: {str(process_error)}")
+                print(f"Error reprocessing article: {str(process_error)}")
                 # Mark as failed in processing status
                 if processing_id:
                     try:
@@ -267,60 +397,32 @@ def lambda_handler(event, context):
                     except Exception as status_error:
                         print(f"Failed to update error status: {str(status_error)}")
                 raise process_error
-                
         else:
-            # re-process existing news article in DynamoDB
-            response = table.get_item(Key={"id": body})
-            
-            if 'Item' in response:
-                file_content = """
-                <date>{date}</date>
-                <title>{title}</title>
-                <text>{text}</text>
-                <url>{url}</url>
-                """.format(date=response['Item']['date'] if 'date' in response['Item'] else "", 
-                           title=response['Item']['title'] if 'title' in response['Item'] else "",  
-                           text=response['Item']['text'] if 'text' in response['Item'] else "",
-                           url=response['Item']['url'] if "url" in response['Item'] else "")
-                
-                # Create processing status for reprocessing
-                processing_id = create_processing_status(f"Reprocess: {response['Item'].get('title', 'Unknown')}", 'news')
-                
-                try:
-                    processArticle(file_content, processing_id)
-                    
-                    # Increment processing status to completed (step 1 -> 2)
-                    increment_processing_status(processing_id, is_final_step=True)
-                    
-                    table.delete_item(Key={"id": body})
-                except Exception as process_error:
-                    print(f"Error reprocessing article: {str(process_error)}")
-                    # Mark as failed in processing status
-                    if processing_id:
-                        try:
-                            mark_processing_failed(processing_id, str(process_error))
-                        except Exception as status_error:
-                            print(f"Failed to update error status: {str(status_error)}")
-                    raise process_error
-            else:
-                print("Item not found:", body)
-        
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Success!')
-        }
-    except Exception as e:
-        print(f"Lambda handler error: {str(e)}")
-        print(f"Event: {event}")
-        
-        # Mark processing as failed if we have a processing_id
-        if processing_id:
-            try:
-                mark_processing_failed(processing_id, f"Lambda handler error: {str(e)}")
-            except Exception as status_error:
-                print(f"Failed to update error status in final handler: {str(status_error)}")
-        
-        return {
-            'statusCode': 200,
-            'body': json.dumps(f'Error: {str(e)}')
-        }
+            print("Item not found:", body)
+
+def lambda_handler(event, context):
+    # Process every record of the SQS batch, sharing one graph connection and settings snapshot,
+    # and report only the failed records back to SQS for retry
+    resources = BatchResources()
+    batch_item_failures = []
+    records = event.get("Records", [])
+    for index, record in enumerate(records):
+        # leave records we may not have time to finish for a later invocation
+        if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_TIME_MS:
+            print(f"Insufficient time remaining, returning {len(records) - index} records to the queue")
+            batch_item_failures.extend({"itemIdentifier": r["messageId"]} for r in records[index:])
+            break
+        try:
+            processRecord(record, resources)
+        except Exception as e:
+            print(f"Lambda handler error: {str(e)}")
+            print(f"Record: {record}")
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+            resources.reset()
+    
+    print(f"Processed {len(records)} records, {len(batch_item_failures)} failed")
+    reportGraphMetrics()
+    reportBedrockMetrics()
+    return {
+        "batchItemFailures": batch_item_failures
+    }
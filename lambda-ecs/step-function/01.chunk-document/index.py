@@ -1,6 +1,5 @@
 import tempfile
 import json
-import pypdf
 import os
 import boto3
 import uuid
@@ -8,162 +7,132 @@ import time
 import urllib.parse
 
 from connectionsinsights.bedrock import (
-    cleanJSONString,
-    queryBedrockStreaming,
-    getTextWithinTags,
-    uppercase,
-    savePrompt,
-    convertMessagesToTextCompletion
+    reportBedrockMetrics
+)
+from connectionsinsights.summary import (
+    generateDocumentSummary,
+    identifyMainEntity
 )
 
-from connectionsinsights.textract import extract_text
+from connectionsinsights.textract import (
+    extract_text,
+    extract_job_text,
+    start_async_analysis,
+    complete_task
+)
+from connectionsinsights.extraction import (
+    startHybridExtraction,
+    extractHybrid,
+    iterPDFPages,
+    hasCachedPages,
+    withExtractionCache
+)
+from connectionsinsights.registry import (
+    hashS3Object,
+    hashChunk,
+    getChunkResults,
+    chunkResultsWithSource
+)
+from connectionsinsights.records import (
+    newRecord,
+    putRecords,
+    queryRecords,
+    RECORD_CHUNK,
+    RECORD_CHUNK_RESULT
+)
+from connectionsinsights.prescreen import (
+    screenChunk,
+    PRESCREEN,
+    PRESCREEN_ACTION,
+    PRESCREEN_SMALL_MODEL,
+    ACTION_SKIP
+)
+from connectionsinsights.chunker import (
+    splitDocument,
+    countChunksWithinTokens
+)
 from connectionsinsights.utils import (
     create_processing_status,
     increment_processing_status
 )
 
 s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-dynamodb_table_name = os.environ["DDBTBL_INGESTION"]
-table = dynamodb.Table(dynamodb_table_name)
 extractor = os.environ.get("EXTRACTOR", "TEXTRACT")
 
-def qb_generateDocumentSummary(chunks,summaryChunkCount):
-    text = ' '.join([chunks[i]["text"] for i in range(int(summaryChunkCount))])
-    try:
-        sampleJSON = """
-    {
-        "MAIN_ENTITY": {
-            "NAME": "<FULL_NAME>",
-            "ATTRIBUTES" : [
-                { "INDUSTRY": "<ATTRIBUTE_VALUE>" },
-                { "FOCUS_AREA": ["<ATTRIBUTE_VALUE>"] },
-                { "REVENUE_GENERATING_INDUSTRIES": ["<ATTRIBUTE_VALUE>"] },
-                { "SUMMARY_OF_BUSINESS_PERFORMANCE": "<ATTRIBUTE_VALUE>" },
-                { "SUMMARY_OF_BUSINESS_STRATEGY": "<ATTRIBUTE_VALUE>" },
-            ]
-        }
-    }
-    """
-
-        messages = [
-            {"role": "user", "content": """
-    I will provide you with a document that which is a subset of a larger document.  Read it carefully as I will be asking you questions about it.
-
-    Here is the document:
-    <document>
-    {text}
-    </document>
+# The state machine first invokes this function in the START_EXTRACTION phase with a task token, and waits
+# for the Textract job to complete before invoking it again to chunk the extracted pages
+PHASE_START_EXTRACTION = "START_EXTRACTION"
+# ...and runs the GENERATE_SUMMARY phase in parallel with the chunk extraction
+PHASE_GENERATE_SUMMARY = "GENERATE_SUMMARY"
+# chunk ids per process-chunks invocation
+CHUNK_BATCH_SIZE = int(os.environ.get("CHUNK_BATCH_SIZE", "1"))
 
-    1) Identify the full name of the main entity discussed in <document> and any key qualitative attributes mentioned.  Leave array empty if you cannot identify any.
+def get_content_hash(s3_file, s3_bucket, s3_key):
+    # computed by the ingestion trigger; hashed here for messages queued without it
+    return s3_file.get("CONTENT_HASH") or hashS3Object(s3_bucket, s3_key)[0]
 
-    2) Identify the industry that the main entity is operating in.  Leave string value empty if you cannot identify any.
-            
-    3) Identity the focus area that the main entity is focusing on.  Leave array empty if you cannot identify any.
-
-    4) Identify the revenue generating industries that the main entity is operating in.  Leave array empty if you cannot identify any.
-
-    5) Summarize the business performance of the main entity.  Leave string value empty if you cannot identify any.
-
-    6) Summarize the business strategy of the main entity.  Leave string value empty if you cannot identify any.
-
-    7) It is important that you print out the output within <results></results> xml tag using the following JSON format and ensure that the output is a valid JSON format.
-    {sampleJSON}
-    """.format(text=text, sampleJSON=sampleJSON)},
-            {"role":"assistant", "content": ""}
-        ]
-
-        completion = queryBedrockStreaming(messages)
-        
-        results = getTextWithinTags(completion,'results').strip()
-        if results == "":
-            return qb_generateDocumentSummary(chunks,summaryChunkCount)
-        else:
-            results = uppercase( json.loads(cleanJSONString(results)) )
-            savePrompt(convertMessagesToTextCompletion(messages) + "\n\n" + completion, id=results["MAIN_ENTITY"]["NAME"]+"->qb_generateDocumentSummary")
-
-            return json.dumps( results ) 
-    except Exception as e:
-        if "validationException".upper() in str(e).upper() and "Input is too long".upper() in str(e).upper():
-            return qb_generateDocumentSummary(chunks, summaryChunkCount * 0.75)
-        else:
-            raise Exception(e)
-
-        
-    
-def splitDocument(arr_text):
-    maxTokensPerChunk = 500 # estimate 1 space = 1 word = 1 token
-    
-    # get number of pages
-    numPages = len(arr_text)
-    
-    text = ""
-    tokenCount = 0
-    currentPage = 1
-    startPage = 1
-    chunks = []
-    
-    # loop through each page and get text
-    for pageText in arr_text:
-        pageText = pageText.replace("\xa0", " ") # replace special characters with spaces
-        pageText = pageText.replace("\n", " ") # replace new line characters with spaces
-        pageText = pageText.replace("  ", " ") # remove any extra spaces
-        pageText = pageText.replace("\"", "") # remove " character
-        pageToken = pageText.count(" ")
-        if tokenCount + pageToken <= maxTokensPerChunk:
-            text += pageText + "\n"
-            tokenCount += pageToken
-        else:
-            chunks.append(
-                {
-                    'id': str(uuid.uuid4()),
-                    'startPage': startPage,
-                    'endPage': currentPage-1,
-                    'text': text
-                }
-            )        
-            startPage = currentPage
-            text = pageText + "\n"
-            tokenCount = pageToken
-    
-        if currentPage == numPages:
-            chunks.append(
-                {
-                    'id': str(uuid.uuid4()),
-                    'startPage': startPage,
-                    'endPage': currentPage,
-                    'text': text
-                }
-            )
-            break
-        currentPage += 1
-           
-    return chunks
-
-def extract_document(s3_bucket, s3_key):
+def start_extraction(event):
+    S3_BUCKET = event["StateInfo"]["S3File"]["S3_BUCKET"].strip()
+    S3_KEY = urllib.parse.unquote_plus(event["StateInfo"]["S3File"]["S3_KEY"].strip())
+    content_hash = get_content_hash(event["StateInfo"]["S3File"], S3_BUCKET, S3_KEY)
+    if hasCachedPages(S3_BUCKET, content_hash, extractor):
+        # already extracted (retried execution or re-ingested document)
+        complete_task(event["TaskToken"], {"Status": "CACHED"})
+        return {"Status": "CACHED"}
+    if extractor == "HYBRID":
+        return startHybridExtraction(S3_BUCKET, S3_KEY, event["TaskToken"])
+    if extractor != "TEXTRACT":
+        # nothing to wait for; the pages are extracted in the chunking phase
+        complete_task(event["TaskToken"], {"Status": "SKIPPED"})
+        return {"Status": "SKIPPED"}
+    return start_async_analysis(S3_BUCKET, S3_KEY, event["TaskToken"])
+
+def extract_document(s3_bucket, s3_key, extraction=None, content_hash=None):
+    return withExtractionCache(s3_bucket, content_hash, extractor, lambda: extract_uncached(s3_bucket, s3_key, extraction))
+
+def extract_uncached(s3_bucket, s3_key, extraction=None):
     if extractor == "TEXTRACT":
+        if extraction and extraction.get("JobId"):
+            return extract_job_text(extraction, s3_bucket)
         return extract_text(s3_bucket, s3_key)
+    elif extractor == "HYBRID":
+        return extractHybrid(s3_bucket, s3_key, extraction)
     elif extractor == "PYPDF":
         # Download the file from S3
         local_file_path = os.path.join(tempfile.gettempdir(), s3_key.split("/")[-1])
         s3.download_file(s3_bucket, s3_key, local_file_path)
-        
-        # read in PDF file using pypdf
-        pdfFileObj = open(local_file_path, 'rb')
-        pdfReader = pypdf.PdfReader(pdfFileObj)
-        
-        arr_text = []
-        for page in pdfReader.pages:
-            arr_text.append(page.extract_text())
-        
-        # close PDF file
-        pdfFileObj.close()
-        os.remove(local_file_path)
-        return arr_text
+
+        # read in PDF file using pypdf, extracting page ranges in parallel; pages are streamed to the chunker
+        def iterPages():
+            try:
+                yield from iterPDFPages(local_file_path)
+            finally:
+                os.remove(local_file_path)
+        return iterPages()
     else:
         raise Exception("Invalid extractor")
 
+def get_chunks(processing_id):
+    # chunks saved by the chunking phase, in document order
+    items = queryRecords(processing_id, RECORD_CHUNK, ProjectionExpression="id, #index, #text, tokens", ExpressionAttributeNames={'#index': "index", '#text': "text"})
+    return [ {"id": item["id"], "text": item["text"], "tokens": int(item["tokens"])} for item in sorted(items, key=lambda item: item["index"]) ]
+
+def generate_summary(event):
+    S3_KEY = urllib.parse.unquote_plus(event["StateInfo"]["S3File"]["S3_KEY"].strip())
+    main_entity = event["MainEntity"]["MAIN_ENTITY"]
+    summary = generateDocumentSummary(get_chunks(event["processing_id"]), event["summaryChunkCount"])
+    # chunks were extracted for the main entity identified first, so the vertex keeps its name
+    summary["MAIN_ENTITY"]["NAME"] = main_entity["NAME"]
+    summary["MAIN_ENTITY"]["ATTRIBUTES"] = summary["MAIN_ENTITY"]["ATTRIBUTES"] + [{ "SOURCE":  S3_KEY.split("/")[-1].upper() }]
+    reportBedrockMetrics()
+    return summary
+
 def lambda_handler(event, context):
+    if event.get("phase") == PHASE_START_EXTRACTION:
+        return start_extraction(event)
+    if event.get("phase") == PHASE_GENERATE_SUMMARY:
+        return generate_summary(event)
+
     uuids = []
     
     S3_BUCKET = event["StateInfo"]["S3File"]["S3_BUCKET"].strip()
@@ -177,39 +146,58 @@ def lambda_handler(event, context):
     # Increment processing status for chunk-document step (0 -> 1)
     increment_processing_status(processing_id)
     
-    arr_text = extract_document(S3_BUCKET, S3_KEY)
+    content_hash = get_content_hash(event["StateInfo"]["S3File"], S3_BUCKET, S3_KEY)
+    arr_text = extract_document(S3_BUCKET, S3_KEY, event.get("extraction"), content_hash)
     chunks = splitDocument(arr_text)
-    maxSummaryChunkCount = 40 # max number of chunks to use for summary; 1 chunk ~ 1 page
-    summary = json.loads(qb_generateDocumentSummary(chunks,min(maxSummaryChunkCount,len(chunks)-1)))
-    summary["MAIN_ENTITY"]["ATTRIBUTES"] = summary["MAIN_ENTITY"]["ATTRIBUTES"] + [{ "SOURCE":  S3_KEY.split("/")[-1].upper() }]
-    
-    #make a shorter copy of summary json object for use in process chunks only
-    summaryShort = json.loads(json.dumps(summary))
-    # delete SUMMARY_OF_BUSINESS_PERFORMANCE and SUMMARY_OF_BUSINESS_STRATEGY from summaryShort 
-    def deleteAttribute(array, key):
-        i = 0
-        for attribute in array["MAIN_ENTITY"]["ATTRIBUTES"]:
-            if key in attribute:
-                del array["MAIN_ENTITY"]["ATTRIBUTES"][i]
-            i = i + 1
-    deleteAttribute(summaryShort, "SUMMARY_OF_BUSINESS_PERFORMANCE")
-    deleteAttribute(summaryShort, "SUMMARY_OF_BUSINESS_STRATEGY")
-    for chunk in chunks:
-        uuids.append({
-            "id": chunk["id"]
-            
-        })
-        table.put_item(Item={
-            'id': str(chunk['id']),
-            'startPage': int(chunk['startPage']),
-            'endPage': int(chunk['endPage']),
-            "summary": summaryShort,
-            "source": "{file}".format(file=S3_KEY.split("/")[-1]),
-            'text': str(chunk['text']),
-            'ttl_timestamp': int(time.time()) + 7200
-        })
+    maxSummaryTokens = 26000 # max document tokens to use for summary; ~40 pages
+    summaryChunkCount = max(1, min(countChunksWithinTokens(chunks, maxSummaryTokens), len(chunks)-1))
+
+    # process-chunks only needs the main entity, identified here from the opening pages; the full summary is
+    # generated by the GENERATE_SUMMARY phase while the chunks are processed
+    summaryShort = identifyMainEntity(chunks)
+    summaryShort["MAIN_ENTITY"]["ATTRIBUTES"] = summaryShort["MAIN_ENTITY"]["ATTRIBUTES"] + [{ "SOURCE":  S3_KEY.split("/")[-1].upper() }]
+
+    # Chunks already processed for this main entity (e.g. the unchanged pages of an amended filing) reuse their
+    # cached results and skip process-chunks; consolidate-chunks queries them with the processed ones
+    source = "{file}".format(file=S3_KEY.split("/")[-1])
+    chunk_hashes = [hashChunk(chunk['text'], summaryShort["MAIN_ENTITY"]["NAME"]) for chunk in chunks]
+    cached_results = getChunkResults(chunk_hashes)
+    records = []
+    cached_count = 0
+    screened_out = []
+    for index, (chunk, chunk_hash) in enumerate(zip(chunks, chunk_hashes)):
+        chunk_item = newRecord(processing_id, RECORD_CHUNK, str(chunk['id']),
+            index=index,
+            startPage=int(chunk['startPage']),
+            endPage=int(chunk['endPage']),
+            summary=summaryShort,
+            source=source,
+            text=str(chunk['text']),
+            tokens=int(chunk['tokens']),
+            chunk_hash=chunk_hash
+        )
+        if chunk_hash in cached_results:
+            records.append(newRecord(processing_id, RECORD_CHUNK_RESULT, str(chunk['id']), **chunkResultsWithSource(cached_results[chunk_hash], source)))
+            cached_count += 1
+        else:
+            # skip (or extract with a smaller model) chunks unlikely to name any relationships
+            relevant, reason = screenChunk(chunk['text'])
+            if not relevant:
+                screened_out.append(f"pg{chunk['startPage']}-{chunk['endPage']}: {reason}")
+                if PRESCREEN_ACTION != ACTION_SKIP:
+                    chunk_item['model'] = PRESCREEN_SMALL_MODEL
+            if relevant or PRESCREEN_ACTION != ACTION_SKIP:
+                uuids.append(chunk["id"])
+        # every chunk is saved for the GENERATE_SUMMARY phase
+        records.append(chunk_item)
+    putRecords(records)
+    print(f"{len(chunks)} chunks: {len(uuids)} to process, {cached_count} reused from previous ingestions")
+    if screened_out:
+        action = "skipped" if PRESCREEN_ACTION == ACTION_SKIP else f"routed to {PRESCREEN_SMALL_MODEL}"
+        print(f"Pre-screen ({PRESCREEN}) {action} {len(screened_out)} of {len(chunks)} chunks:\n" + "\n".join(screened_out))
     return {
-        "uuid": uuids,
-        "summary": summary,
+        "uuid": [ {"processing_id": processing_id, "ids": uuids[index:index + CHUNK_BATCH_SIZE]} for index in range(0, len(uuids), CHUNK_BATCH_SIZE) ],
+        "summary": summaryShort,
+        "summaryChunkCount": summaryChunkCount,
         "processing_id": processing_id
     }
\ No newline at end of file
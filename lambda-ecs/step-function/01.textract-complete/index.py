@@ -0,0 +1,16 @@
+import json
+
+from connectionsinsights.textract import (
+    handle_completion_message
+)
+
+def lambda_handler(event, context):
+    # Textract job completion notifications, delivered by the SNS topic
+    for record in event["Records"]:
+        message = json.loads(record["Sns"]["Message"])
+        print(f"Textract job {message['JobId']} {message['Status']}")
+        handle_completion_message(message)
+
+    return {
+        "message": "Textract completion handled",
+    }
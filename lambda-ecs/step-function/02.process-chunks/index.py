@@ -3,21 +3,124 @@ import boto3
 import os
 import uuid
 import time
-import traceback
+import concurrent.futures
 
 from connectionsinsights.bedrock import (
-    cleanJSONString,
-    queryBedrockStreaming,
-    getTextWithinTags,
+    queryBedrockJSON,
+    resultSchema,
     savePrompt,
-    convertMessagesToTextCompletion
+    convertMessagesToTextCompletion,
+    buildPromptContent,
+    reportBedrockMetrics,
+    estimateTokens,
+    maxOutputTokens,
+    default_model_id
+)
+from connectionsinsights.chunker import (
+    NAME_PATTERN,
+    NUMBER_PATTERN
+)
+from connectionsinsights.registry import (
+    putChunkResults,
+    chunkResultsWithSource
+)
+from connectionsinsights.records import (
+    newRecord,
+    getRecords,
+    putRecord,
+    existingRecordIds,
+    RECORD_CHUNK,
+    RECORD_CHUNK_RESULT
 )
 
-dynamodb = boto3.resource('dynamodb')
-dynamodb_table_name = os.environ["DDBTBL_INGESTION"]
-table = dynamodb.Table(dynamodb_table_name)
-
-def qb_extractChunkData(text, summary, main_entity_name, id):
+# chunks of a batch are extracted concurrently; Bedrock requests are still paced by the shared rate limiter
+PROCESS_CHUNKS_WORKERS = int(os.environ.get("PROCESS_CHUNKS_WORKERS", "4"))
+
+# Pre-flight sizing: names in the prose of a chunk can become entries of the output JSON, so chunks whose
+# expected output would not fit in the max_tokens of one request are split (at page boundaries) ahead of time.
+# Table rows, headings and acronyms (line items, IFRS, EBITDA, USD...) are not counted: they are rarely extracted.
+OUTPUT_TOKENS_PER_NAME = int(os.environ.get("OUTPUT_TOKENS_PER_NAME", "30"))
+OUTPUT_TOKENS_OVERHEAD = 500 # thoughts and JSON structure
+MIN_PROSE_WORDS = 8
+MIN_SPLIT_TOKENS = 500
+MAX_SPLIT_DEPTH = 3 # at most 8 parts per chunk
+
+def isProse(line):
+    words = line.split()
+    if len(words) < MIN_PROSE_WORDS:
+        return False
+    lowercase = sum(1 for word in words if word[0].islower())
+    numeric = sum(1 for word in words if NUMBER_PATTERN.match(word))
+    return lowercase >= len(words) * 0.4 and numeric < len(words) * 0.3
+
+def extractionCandidates(text):
+    return set(name for line in text.split("\n") if isProse(line) for name in NAME_PATTERN.findall(line) if not name.isupper())
+
+def estimateOutputTokens(text):
+    return OUTPUT_TOKENS_OVERHEAD + OUTPUT_TOKENS_PER_NAME * len(extractionCandidates(text))
+
+def splitText(text):
+    # split at the page (line) boundary nearest the middle, falling back to a sentence boundary
+    middle = len(text) // 2
+    for separator in ["\n", ". "]:
+        before = text.rfind(separator, 0, middle)
+        after = text.find(separator, middle)
+        candidates = [index for index in [before, after] if index > 0 and index + len(separator) < len(text)]
+        if candidates:
+            index = min(candidates, key=lambda index: abs(index - middle)) + len(separator)
+            return [text[:index], text[index:]]
+    return [text[:middle], text[middle:]]
+
+def splitForOutput(text, max_tokens, depth=0):
+    if depth >= MAX_SPLIT_DEPTH or estimateTokens(text) < MIN_SPLIT_TOKENS or estimateOutputTokens(text) <= max_tokens * 0.8:
+        return [text]
+    return [part for half in splitText(text) for part in splitForOutput(half, max_tokens, depth + 1)]
+
+def mergeChunkData(results):
+    return { key: [entry for result in results for entry in result.get(key, [])] for key in CHUNK_DATA_KEYS }
+
+def entitySchema(*properties):
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": { name: {"type": "string"} for name in ["NAME", *properties] },
+            "required": ["NAME"]
+        }
+    }
+
+CHUNK_DATA_KEYS = ["COMMERCIAL_PRODUCTS_OR_SERVICES", "CUSTOMERS", "SUPPLIERS_OR_PARTNERS", "COMPETITORS", "DIRECTORS"]
+
+CHUNK_DATA_SCHEMA = resultSchema("results", {
+    "type": "object",
+    "properties": {
+        "COMMERCIAL_PRODUCTS_OR_SERVICES": entitySchema(),
+        "CUSTOMERS": entitySchema("PRODUCTS_USED", "FOCUS_AREA", "INDUSTRY"),
+        "SUPPLIERS_OR_PARTNERS": entitySchema("RELATIONSHIP", "FOCUS_AREA", "INDUSTRY"),
+        "COMPETITORS": entitySchema("COMPETING_IN", "FOCUS_AREA", "INDUSTRY"),
+        "DIRECTORS": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "NAME": {"type": "string"},
+                    "ROLE": {"type": "string"},
+                    "OTHER_ASSOCIATIONS": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": { name: {"type": "string"} for name in ["ROLE", "COMPANY_NAME", "FOCUS_AREA", "INDUSTRY"] }
+                        }
+                    }
+                },
+                "required": ["NAME"]
+            }
+        }
+    },
+    "required": CHUNK_DATA_KEYS
+}, explanation="Your thought process explaining the relationship of each entity to the main entity")
+
+def qb_extractChunkData(text, summary, main_entity_name, id, modelId=default_model_id):
     responses = []
     prompt_history = ""
     completion = ""
@@ -41,20 +144,14 @@ def qb_extractChunkData(text, summary, main_entity_name, id):
 }
 """
 
-    messages = [
-        {"role":"user", "content":"""
+    # The instructions and main entity summary are identical for every chunk of a document, so they form a
+    # prompt-cache prefix; only the chunk text varies.
+    static_prompt = """
 I will provide you with a document that which is a subset of a larger document which discusses about the main entity provided in <main_entity></main_entity> tags.
 <main_entity>
 {main_entity}
 </main_entity>
 
-Read this document carefully as I will be asking you questions about it.
-
-Here is the document:
-<document>
-{text}
-</document>
-
 Using the text enclosed within <document></document> tag, perform the following steps:
 1) Identify named commercial products or services provided by {main_entity_name}. Leave array empty if you cannot identify any. For any values that you cannot determine, return empty string.
 
@@ -74,47 +171,77 @@ Using the text enclosed within <document></document> tag, perform the following
 
 9) It is important that you print out the output within <results></results> xml tag using the following JSON format and ensure that the output is a valid JSON format.
 {sampleJSON}
-         """.format(main_entity=summary,main_entity_name=main_entity_name, text=text,sampleJSON=sampleJSON)},
+""".format(main_entity=summary,main_entity_name=main_entity_name,sampleJSON=sampleJSON)
+
+    variable_prompt = """
+Read this document carefully and perform the steps above.
+
+Here is the document:
+<document>
+{text}
+</document>
+""".format(text=text)
+
+    messages = [
+        {"role":"user", "content": buildPromptContent(static_prompt, variable_prompt)},
          {"role":"assistant", "content": """"""}
     ]
 
     
-    completion = queryBedrockStreaming(messages)
+    results, completion = queryBedrockJSON(messages, "results", schema=CHUNK_DATA_SCHEMA, modelId=modelId)
     prompt_history = convertMessagesToTextCompletion(messages) + "\n\n" + completion + "\n"
 
     savePrompt(prompt_history, id=id)
 
-    results = cleanJSONString(getTextWithinTags(completion,"results"))
-    try:
-        json.loads(results)
-        return results
-    except Exception as e:
-        print(f"Failed to parse JSON: {e}\nRaw results: {results}\n{traceback.format_exc()}")
-        return qb_extractChunkData(text, summary, main_entity_name, id)
+    return json.dumps(results)
 
-def lambda_handler(event, context):
-    id = event["id"]
-    item = table.get_item(Key={'id': id})
-    summary = item["Item"]["summary"]
-    source = item["Item"]["source"]
-    startPage = str(item["Item"]["startPage"])
-    endPage = str(item["Item"]["endPage"])
-    text = item["Item"]["text"]
+def processChunk(item):
+    summary = item["summary"]
+    source = item["source"]
+    startPage = str(item["startPage"])
+    endPage = str(item["endPage"])
+    text = item["text"]
+    # chunks the pre-screen found unlikely to name any relationships may be routed to a smaller model
+    modelId = item.get("model", default_model_id)
     
-    results = qb_extractChunkData(text, json.dumps(summary), summary["MAIN_ENTITY"]["NAME"], summary["MAIN_ENTITY"]["NAME"]+"->qb_extractChunkData->"+"(pg"+startPage+"-"+endPage+")->" )
-
-    results = json.loads(results)
+    prompt_id = summary["MAIN_ENTITY"]["NAME"]+"->qb_extractChunkData->"+"(pg"+startPage+"-"+endPage+")->"
+    # sized against the max_tokens the request will get, which grows after truncated tool calls
+    max_tokens = maxOutputTokens(modelId, CHUNK_DATA_SCHEMA)
+    parts = splitForOutput(text, max_tokens)
+    if len(parts) > 1:
+        print(f"Splitting chunk pg{startPage}-{endPage} into {len(parts)} parts (estimated {estimateOutputTokens(text)} output tokens, max_tokens {max_tokens})")
+    results = mergeChunkData([
+        json.loads(qb_extractChunkData(part, json.dumps(summary), summary["MAIN_ENTITY"]["NAME"], prompt_id + (f"(part{index+1})->" if len(parts) > 1 else ""), modelId))
+        for index, part in enumerate(parts)
+    ])
+
+    # reused when the chunk reappears unchanged, e.g. in an amended filing
+    if modelId == default_model_id:
+        putChunkResults(item.get("chunk_hash"), results)
+
+    # keyed by the chunk id, so a retried batch skips the chunks it already has results for
+    return newRecord(item["pk"], RECORD_CHUNK_RESULT, item["id"], **chunkResultsWithSource(results, source))
 
-    id = str(uuid.uuid4())
-    
-    table.put_item(Item={
-        'id': id,
-        'COMMERCIAL_PRODUCTS_OR_SERVICES': [ {**x, "SOURCE": source} for x in results["COMMERCIAL_PRODUCTS_OR_SERVICES"] ],
-        'CUSTOMERS': [ {**x, "SOURCE": source} for x in results["CUSTOMERS"] ],
-        'SUPPLIERS_OR_PARTNERS': [ {**x, "SOURCE": source} for x in results["SUPPLIERS_OR_PARTNERS"] ],
-        'COMPETITORS': [ {**x, "SOURCE": source} for x in results["COMPETITORS"] ],
-        'DIRECTORS': [ {**x, "SOURCE": source} for x in results["DIRECTORS"] ],
-        'ttl_timestamp': int(time.time()) + 7200
-    })
-    
-    return id
+def lambda_handler(event, context):
+    # a batch of chunk ids (CHUNK_BATCH_SIZE in chunk-document) of one document
+    ids = event["ids"]
+    done = existingRecordIds(event["processing_id"], RECORD_CHUNK_RESULT, ids)
+    if done:
+        print(f"Skipping {len(done)} chunks already processed by an earlier attempt")
+    items = getRecords(event["processing_id"], RECORD_CHUNK, [id for id in ids if id not in done])
+
+    # each result is saved as soon as its chunk is done, so a failed chunk does not lose the others
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(PROCESS_CHUNKS_WORKERS, len(items)))) as executor:
+        futures = { executor.submit(processChunk, item): item["id"] for item in items }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                putRecord(future.result())
+            except Exception as e:
+                print(f"Error processing chunk {futures[future]}: {str(e)}")
+                errors.append(e)
+
+    reportBedrockMetrics()
+    if errors:
+        raise errors[0]
+    return ids
@@ -1,4 +1,5 @@
 import json
+import math
 import os
 import boto3
 import uuid
@@ -10,10 +11,13 @@ from connectionsinsights.bedrock import (
 from connectionsinsights.utils import (
     increment_processing_status
 )
-
-dynamodb = boto3.resource('dynamodb')
-dynamodb_table_name = os.environ["DDBTBL_INGESTION"]
-table = dynamodb.Table(dynamodb_table_name)
+from connectionsinsights.records import (
+    newRecord,
+    putRecord,
+    queryRecords,
+    RECORD_CHUNK_RESULT,
+    RECORD_RAW
+)
 
 def convertToArray(data):
     if isinstance(data, str):
@@ -23,106 +27,83 @@ def convertToArray(data):
     else:
         raise Exception("consolidate-chunks: convertToArray: unknown data type:", data)
     
+# (key of the chunk results, id and type of the raw record)
+CATEGORIES = [
+    ("CUSTOMERS", "raw_customers"),
+    ("SUPPLIERS_OR_PARTNERS", "raw_suppliers_or_partners"),
+    ("COMPETITORS", "raw_competitors"),
+    ("DIRECTORS", "raw_directors")
+]
+CONCATENATED_ATTRIBUTES = ["OTHER_ASSOCIATIONS"] # concat instead of union as its a list of dicts
+
+def normalizeName(name):
+    """Merge key of an entity, so "ACME  CORP." and "ACME CORP" are consolidated together"""
+    return " ".join(name.upper().replace("\"", " ").split()).strip(" .,")
+
+def mergeEntity(entities, names, row):
+    """
+    Merges an extracted row into entities (name -> attribute arrays), under the first name seen for its
+    normalized name.  Returns the approximate size in bytes added to the record.
+    """
+    merge_key = normalizeName(row['NAME'])
+    if len(merge_key) == 0:
+        return 0
+    name = names.setdefault(merge_key, row['NAME'].strip())
+    attributes = { key : convertToArray(row[key]) for key in row.keys() if key not in ["NAME"] }
+    if name not in entities:
+        entities[name] = attributes
+        return len(json.dumps({ name: attributes }))
+    for key, values in attributes.items():
+        if key in CONCATENATED_ATTRIBUTES:
+            entities[name][key] = entities[name].get(key, []) + values
+        else:
+            entities[name][key] = list(set( entities[name].get(key, []) ) | set( values ) )
+    return 0
+
 def lambda_handler(event, context):
-    chunks = event["output"]
     summary = event["Summary"]
     main_entity = summary['MAIN_ENTITY']
     
     # Get processing_id from previous step and increment status (1 -> 2)
-    processing_id = event.get("processing_id")
-    if processing_id:
-        increment_processing_status(processing_id)
+    processing_id = event["processing_id"]
+    increment_processing_status(processing_id)
     
     products = set()
-    raw_customers = {}
-    raw_suppliers_or_partners = {}
-    raw_competitors = {}
-    raw_directors = {}
+    raw = { raw_id: {} for _, raw_id in CATEGORIES }
+    names = { raw_id: {} for _, raw_id in CATEGORIES }
+    capacity = { 'read': 0, 'write': 0 }
+    # the records used to be rewritten after every chunk with results in their category: estimate those writes
+    # (1 WCU per started KB of the record at the time, counting only the size of newly added entities)
+    raw_sizes = { raw_id: 0 for _, raw_id in CATEGORIES }
+    per_chunk_write_estimate = 0
+    chunk_count = 0
     
-    for chunk in chunks:
+    # every chunk result of the document (processed, or reused from previous ingestions) in one paginated Query,
+    # merged in memory; each raw record is written once at the end
+    for chunk in queryRecords(processing_id, RECORD_CHUNK_RESULT, capacity=capacity):
+        chunk_count += 1
         try:
-            item = table.get_item(Key={"id": chunk})
-            results = uppercase(item["Item"])
+            results = uppercase(chunk)
             if "COMMERCIAL_PRODUCTS_OR_SERVICES" in results:
                 products = products | set([x['NAME'] for x in results['COMMERCIAL_PRODUCTS_OR_SERVICES']])        
             
-            if "CUSTOMERS" in results:
-                for x in [row for row in results['CUSTOMERS'] if len(row['NAME']) > 0]:
-                    if x['NAME'] not in raw_customers:
-                        raw_customers[x['NAME']] = { key : convertToArray(x[key]) for key in x.keys() if key not in ["NAME"] }
-                    else:
-                        for key in raw_customers[x['NAME']].keys():
-                            raw_customers[x['NAME']][key] = list(set( raw_customers[x['NAME']][key] ) | set( convertToArray(x[key]) ) )
-                
-                raw_customers_id = str(uuid.uuid4())
-                table.put_item(Item={
-                    "id": raw_customers_id,
-                    "type": "raw_customers",
-                    "data": json.dumps(raw_customers),
-                    'ttl_timestamp': int(time.time()) + 7200
-                })
-            if "SUPPLIERS_OR_PARTNERS" in results:
-                for x in [row for row in results['SUPPLIERS_OR_PARTNERS'] if len(row['NAME']) > 0]:
-                    if x['NAME'] not in raw_suppliers_or_partners:
-                        raw_suppliers_or_partners[x['NAME']] = { key : convertToArray(x[key]) for key in x.keys() if key not in ["NAME"] }
-                    else:
-                        for key in raw_suppliers_or_partners[x['NAME']].keys():
-                            raw_suppliers_or_partners[x['NAME']][key] = list(set( raw_suppliers_or_partners[x['NAME']][key] ) | set( convertToArray(x[key]) ) )
-
-                raw_suppliers_or_partners_id = str(uuid.uuid4())
-                table.put_item(Item={
-                    "id": raw_suppliers_or_partners_id,
-                    "type": "raw_suppliers_or_partners",
-                    "data": json.dumps(raw_suppliers_or_partners),
-                    'ttl_timestamp': int(time.time()) + 7200
-                })
-
-            if "COMPETITORS" in results:
-                for x in [row for row in results['COMPETITORS'] if len(row['NAME']) > 0]:
-                    if x['NAME'] not in raw_competitors:
-                        raw_competitors[x['NAME']] = { key : convertToArray(x[key]) for key in x.keys() if key not in ["NAME"] }
-                    else:
-                        for key in raw_competitors[x['NAME']].keys():
-                            raw_competitors[x['NAME']][key] = list(set( raw_competitors[x['NAME']][key] ) | set( convertToArray(x[key]) ) )
-
-                raw_competitors_id = str(uuid.uuid4())
-                table.put_item(Item={
-                    "id": raw_competitors_id,
-                    "type": "raw_competitors",
-                    "data": json.dumps(raw_competitors),
-                    'ttl_timestamp': int(time.time()) + 7200
-                })
-
-            if "DIRECTORS" in results:
-                for x in [row for row in results['DIRECTORS'] if len(row['NAME']) > 0]:
-                    if x['NAME'] not in raw_directors:
-                        raw_directors[x['NAME']] = { key : convertToArray(x[key]) for key in x.keys() if key not in ["NAME"] }
-                    else:
-                        for key in raw_directors[x['NAME']].keys():
-                            if key in ["OTHER_ASSOCIATIONS"]:
-                                raw_directors[x['NAME']][key] = raw_directors[x['NAME']][key] +  x[key] # concat instead of union as its a dict
-                            else:
-                                raw_directors[x['NAME']][key] = list(set( raw_directors[x['NAME']][key] ) | set( convertToArray(x[key]) ) )   
-
-                raw_directors_id = str(uuid.uuid4())
-                table.put_item(Item={
-                    "id": raw_directors_id,
-                    "type": "raw_directors",
-                    "data": json.dumps(raw_directors),
-                    'ttl_timestamp': int(time.time()) + 7200
-                })
+            for category, raw_id in CATEGORIES:
+                if category in results:
+                    for x in results[category]:
+                        raw_sizes[raw_id] += mergeEntity(raw[raw_id], names[raw_id], x)
+                    per_chunk_write_estimate += max(1, math.ceil(raw_sizes[raw_id] / 1024))
     
         except Exception as e:
             print("for chunk in chunks:", e) 
             print( chunk )
 
-    return [
-        {"bodyType": "raw_customers", "jsonID": raw_customers_id, "summary" : summary, "processing_id": processing_id},
-        {"bodyType": "raw_suppliers_or_partners", "jsonID": raw_suppliers_or_partners_id, "summary" : summary, "processing_id": processing_id},
-        {"bodyType": "raw_competitors", "jsonID": raw_competitors_id, "summary" : summary, "processing_id": processing_id},
-        {"bodyType": "raw_directors", "jsonID": raw_directors_id, "summary" : summary, "processing_id": processing_id}
-    ]
-    
-
+    for _, raw_id in CATEGORIES:
+        putRecord(newRecord(processing_id, RECORD_RAW, raw_id, type=raw_id, data=json.dumps(raw[raw_id])), capacity=capacity)
 
+    print(f"consolidate-chunks: {chunk_count} chunk results, {', '.join(f'{len(raw[raw_id])} {raw_id}' for _, raw_id in CATEGORIES)}")
+    print(f"consolidate-chunks: consumed {capacity['read']} RCU and {capacity['write']} WCU (writing after every chunk: {per_chunk_write_estimate} WCU or more)")
 
+    return [
+        {"bodyType": raw_id, "jsonID": raw_id, "summary" : summary, "processing_id": processing_id}
+        for _, raw_id in CATEGORIES
+    ]
@@ -5,22 +5,35 @@ import uuid
 import time
 
 from connectionsinsights.bedrock import (
-    cleanJSONString,
-    queryBedrockStreaming,
-    getTextWithinTags,
+    queryBedrockJSON,
+    resultSchema,
     savePrompt,
-    convertMessagesToTextCompletion
+    convertMessagesToTextCompletion,
+    buildPromptContent
 )
 
 from connectionsinsights.utils import (
     clean_name
 )
+from connectionsinsights.records import (
+    newRecord,
+    getRecord,
+    putRecord,
+    RECORD_RAW,
+    RECORD_FINAL
+)
 
   
-dynamodb_resource = boto3.resource('dynamodb')
-dynamodb = boto3.client("dynamodb")
 split_json_count = 50
 
+def namesSchema(tag):
+    return resultSchema(tag, {"type": "array", "items": {"type": "string"}}, explanation="Your assessment of each item")
+
+NAMES_SCHEMA_CUSTOMERS = namesSchema("customers")
+NAMES_SCHEMA_SUPPLIERS_OR_PARTNERS = namesSchema("suppliers_or_partners")
+NAMES_SCHEMA_COMPETITORS = namesSchema("competitors")
+NAMES_SCHEMA_PEOPLE = namesSchema("people")
+
 def qb_filterCustomers(customers, main_entity_name):
     if customers.strip() == "{}":
         return "[]"
@@ -32,17 +45,11 @@ def qb_filterCustomers(customers, main_entity_name):
 	...
 }"""
 
-    messages = [
-        {"role":"user", "content": """
+    static_prompt = """
 I will provide you with a JSON object of companies who are customers of {main_entity_name}.
 The JSON object is in this format:
 {jsonFormat}
 
-Here is the JSON object of companies:
-<customers>
-{customers}
-</customers>
-
 Perform the following steps:
 1. Categorise each item in <customers> into companies/conglomerates/organisations vs others.
 2. Keep only companies/conglomerates/organisations and remove every other categories.
@@ -51,23 +58,26 @@ Perform the following steps:
 5. If there are some indication that an item is a company/conglomerate/organisation even though there are limited information, you may include it as an company/conglomerate/organisation.
 6. Assess each item individually and print your explanation within <explanation> tags.
 7. After printing the explanation, print an array containing only names of companies/conglomerates/organisations between <customers></customers> tags.  E.g. [ "COMPANY" ]
-""".format(main_entity_name=main_entity_name,customers=customers,jsonFormat=jsonFormat)},
+""".format(main_entity_name=main_entity_name,jsonFormat=jsonFormat)
+
+    variable_prompt = """
+Here is the JSON object of companies:
+<customers>
+{customers}
+</customers>
+""".format(customers=customers)
+
+    messages = [
+        {"role":"user", "content": buildPromptContent(static_prompt, variable_prompt)},
          {"role":"assistant", "content": """"""}
     ]
 
-    completion = queryBedrockStreaming(messages)
+    results, completion = queryBedrockJSON(messages, "customers", schema=NAMES_SCHEMA_CUSTOMERS)
     prompt_history = convertMessagesToTextCompletion(messages) + "\n\n" + completion + "\n"
 
     savePrompt(prompt_history, id=main_entity_name+"->qb_filterCustomers")
 
-    # get results from the final completion
-    response = getTextWithinTags(completion,"customers").strip()
-    response = cleanJSONString(response)
-    try:
-        json.loads(response)
-        return response
-    except:
-        return qb_filterCustomers(customers, main_entity_name)
+    return json.dumps(results)
 
 
 def qb_filterSuppliers(suppliers_or_partners, main_entity_name):
@@ -81,17 +91,11 @@ def qb_filterSuppliers(suppliers_or_partners, main_entity_name):
 	...
 }"""
 
-    messages = [
-        {"role":"user", "content": """
+    static_prompt = """
 I will provide you with a JSON object of companies who are suppliers or partners of {main_entity_name}.
 The JSON object is in this format:
 {jsonFormat}
 
-Here is the JSON object of companies:
-<suppliers_or_partners>
-{suppliers_or_partners}
-</suppliers_or_partners>
-
 Perform the following steps:
 1. Categorise each item in <suppliers_or_partners> into companies/conglomerates/organisations vs others.
 2. Keep only companies/conglomerates/organisations and remove every other categories.
@@ -100,23 +104,26 @@ Perform the following steps:
 5. If there are some indication that an item is a company/conglomerate/organisation even though there are limited information, you may include it as an company/conglomerate/organisation.
 6. Assess each item individually and print your explanation within <explanation> tags.
 7. After printing the explanation, print an array containing only names of companies/conglomerates/organisations between <suppliers_or_partners></suppliers_or_partners> tags.  E.g. [ "COMPANY" ]
-""".format(main_entity_name=main_entity_name,suppliers_or_partners=suppliers_or_partners,jsonFormat=jsonFormat)},
+""".format(main_entity_name=main_entity_name,jsonFormat=jsonFormat)
+
+    variable_prompt = """
+Here is the JSON object of companies:
+<suppliers_or_partners>
+{suppliers_or_partners}
+</suppliers_or_partners>
+""".format(suppliers_or_partners=suppliers_or_partners)
+
+    messages = [
+        {"role":"user", "content": buildPromptContent(static_prompt, variable_prompt)},
          {"role":"assistant", "content": """"""}
     ]
         
-    completion = queryBedrockStreaming(messages)
+    results, completion = queryBedrockJSON(messages, "suppliers_or_partners", schema=NAMES_SCHEMA_SUPPLIERS_OR_PARTNERS)
     prompt_history = convertMessagesToTextCompletion(messages) + "\n\n" + completion + "\n"
 
     savePrompt(prompt_history, id=main_entity_name+"->qb_filterSuppliers")
 
-    # get results from the final completion
-    response = getTextWithinTags(completion,"suppliers_or_partners").strip()
-    response = cleanJSONString(response)
-    try:
-        json.loads(response)
-        return response
-    except:
-        return qb_filterSuppliers(suppliers_or_partners, main_entity_name)
+    return json.dumps(results)
 
 def qb_filterCompetitors(competitors, main_entity_name):
     if competitors.strip() == "{}":
@@ -129,17 +136,11 @@ def qb_filterCompetitors(competitors, main_entity_name):
 	...
 }"""
 
-    messages = [
-        {"role":"user", "content": """
+    static_prompt = """
 I will provide you with a JSON object of companies who are competitors of {main_entity_name}.
 The JSON object is in this format:
 {jsonFormat}
 
-Here is the JSON object of companies:
-<competitors>
-{competitors}
-</competitors>
-
 Perform the following steps:
 1. Categorise each item in <competitors> into companies/conglomerates/organisations vs others.
 2. Keep only companies/conglomerates/organisations and remove every other categories.
@@ -148,23 +149,26 @@ Perform the following steps:
 5. If there are some indication that an item is a company/conglomerate/organisation even though there are limited information, you may include it as an company/conglomerate/organisation.
 6. Assess each item individually and print your explanation within <explanation> tags.
 7. After printing the explanation, print an array containing only names of companies/conglomerates/organisations between <competitors></competitors> tags.  E.g. [ "COMPANY" ]
-""".format(main_entity_name=main_entity_name,competitors=competitors,jsonFormat=jsonFormat)},
+""".format(main_entity_name=main_entity_name,jsonFormat=jsonFormat)
+
+    variable_prompt = """
+Here is the JSON object of companies:
+<competitors>
+{competitors}
+</competitors>
+""".format(competitors=competitors)
+
+    messages = [
+        {"role":"user", "content": buildPromptContent(static_prompt, variable_prompt)},
          {"role":"assistant", "content": """"""}
     ]
 
-    completion = queryBedrockStreaming(messages)
+    results, completion = queryBedrockJSON(messages, "competitors", schema=NAMES_SCHEMA_COMPETITORS)
     prompt_history = convertMessagesToTextCompletion(messages) + "\n\n" + completion + "\n"
 
     savePrompt(prompt_history, id=main_entity_name+"->qb_filterCompetitors")
 
-    # get results from the final completion
-    response = getTextWithinTags(completion,"competitors").strip()
-    response = cleanJSONString(response)
-    try:
-        json.loads(response)
-        return response
-    except:
-        return qb_filterCompetitors(competitors, main_entity_name)
+    return json.dumps(results)
 
 def qb_filterDirectors(directors, main_entity_name):
     if directors.strip() == "{}":
@@ -177,41 +181,37 @@ def qb_filterDirectors(directors, main_entity_name):
     ...
 }"""
 
-    messages = [
-        {"role":"user", "content": """
+    static_prompt = """
 I will provide you with a JSON object of people who works for {main_entity_name}.
 The JSON object is in this format:
 {jsonFormat}
 
-Here is the JSON object of people:
-<people>
-{directors}
-</people>
-
 1. For each item in <people>, identify whether it has a first name and a last name and print them.
 2. Print names that have at least a first name and a last name.  Remove all other items.
 3. If a person's name have multiple variations, make sure you keep the different versions for step 4.
 4. Next, print an array containing only names of actual people between <people></people> tags.  E.g. <people>[ "PERSON_NAME1", "PERSON_NAME2", ... ]</people>
 5. You are to work with only the information provided in the context.
 6. Do not print codes.
-""".format(main_entity_name=main_entity_name,directors=json.dumps(json.loads(directors)),jsonFormat=jsonFormat)},
+""".format(main_entity_name=main_entity_name,jsonFormat=jsonFormat)
+
+    variable_prompt = """
+Here is the JSON object of people:
+<people>
+{directors}
+</people>
+""".format(directors=json.dumps(json.loads(directors)))
+
+    messages = [
+        {"role":"user", "content": buildPromptContent(static_prompt, variable_prompt)},
         {"role":"assistant", "content": """"""}
     ]
 
-    completion = queryBedrockStreaming(messages)    
+    results, completion = queryBedrockJSON(messages, "people", schema=NAMES_SCHEMA_PEOPLE)
     prompt_history = convertMessagesToTextCompletion(messages) + "\n\n" + completion + "\n\n"
 
     savePrompt(prompt_history, id=main_entity_name+"->qb_filterDirectors")
 
-    # get results from the final completion
-    response = getTextWithinTags(completion,"people").strip()
-    response = cleanJSONString(response)
-    try:
-        json.loads(response)
-        return response
-    except Exception as e:
-        print("qb_filterDirectors:", e)
-        return qb_filterDirectors(directors, main_entity_name)
+    return json.dumps(results)
 
 def split_json(json_obj, max_size):
     smaller_objs = []
@@ -233,14 +233,12 @@ def lambda_handler(event, context):
     summary = event["summary"]
     bodyType = event["bodyType"]
     jsonID = event["jsonID"]
+    processing_id = event["processing_id"]
 
     main_entity_name = summary["MAIN_ENTITY"]["NAME"]
-    dynamodb_table_name = os.environ["DDBTBL_INGESTION"]    
-    table = dynamodb_resource.Table(dynamodb_table_name)
 
     if "raw_customers" == bodyType:
-        response = dynamodb.get_item(TableName=dynamodb_table_name, Key={"id": {"S": jsonID}})
-        raw_customers = json.loads(response["Item"]["data"]["S"])
+        raw_customers = json.loads(getRecord(processing_id, RECORD_RAW, jsonID)["data"])
         raw_customers = { clean_name(key): value for key, value in raw_customers.items() } # clean key values
         filteredCustomersArray = []
         arr_json_objects = split_json(raw_customers,split_json_count)
@@ -252,19 +250,12 @@ def lambda_handler(event, context):
                 finalCustomers[key] = { **raw_customers[key], "TYPE": "CUSTOMER" }
             except Exception as e:
                 print(e, key) #intentionally skip so if LLM hallucinates and introduces a key not previously available, it will skip.
-        id = str(uuid.uuid4())
-        table.put_item(
-            Item={
-            "id": id,
-            "type": "finalCustomers",
-            "data": json.dumps(finalCustomers),
-            'ttl_timestamp': int(time.time()) + 7200
-        })
+        id = "finalCustomers"
+        putRecord(newRecord(processing_id, RECORD_FINAL, id, type="finalCustomers", data=json.dumps(finalCustomers)))
         return { "finalCustomers" : id }
         
     elif "raw_suppliers_or_partners" == bodyType:
-        response = dynamodb.get_item(TableName=dynamodb_table_name, Key={"id": {"S": jsonID}})
-        raw_suppliers_or_partners = json.loads(response["Item"]["data"]["S"])
+        raw_suppliers_or_partners = json.loads(getRecord(processing_id, RECORD_RAW, jsonID)["data"])
         raw_suppliers_or_partners = { clean_name(key): value for key, value in raw_suppliers_or_partners.items() } # clean key values
         filteredSuppliersArray = []
         arr_json_objects = split_json(raw_suppliers_or_partners,split_json_count)
@@ -276,19 +267,12 @@ def lambda_handler(event, context):
                 finalSuppliers[key] = { **raw_suppliers_or_partners[key], "TYPE": "SUPPLIER" }
             except Exception as e:
                 print(e, key) #intentionally skip so if LLM hallucinates and introduces a key not previously available, it will skip.
-        id = str(uuid.uuid4())
-        table.put_item(
-            Item={
-            "id": id,
-            "type": "finalSuppliers",
-            "data": json.dumps(finalSuppliers),
-            'ttl_timestamp': int(time.time()) + 7200
-        })
+        id = "finalSuppliers"
+        putRecord(newRecord(processing_id, RECORD_FINAL, id, type="finalSuppliers", data=json.dumps(finalSuppliers)))
         return { "finalSuppliers" : id }
         
     elif "raw_competitors" == bodyType:
-        response = dynamodb.get_item(TableName=dynamodb_table_name, Key={"id": {"S": jsonID}})
-        raw_competitors = json.loads(response["Item"]["data"]["S"])
+        raw_competitors = json.loads(getRecord(processing_id, RECORD_RAW, jsonID)["data"])
         raw_competitors = { clean_name(key): value for key, value in raw_competitors.items() } # clean key values
         arr_json_objects = split_json(raw_competitors,split_json_count)
         filteredCompetitorsArray = []
@@ -300,20 +284,13 @@ def lambda_handler(event, context):
                 finalCompetitors[key] = { **raw_competitors[key], "TYPE": "COMPETITOR" }
             except Exception as e:
                 print(e, key) #intentionally skip so if LLM hallucinates and introduces a key not previously available, it will skip.
-        id = str(uuid.uuid4())
-        table.put_item(
-            Item={
-            "id": id,
-            "type": "finalCompetitors",
-            "data": json.dumps(finalCompetitors),
-            'ttl_timestamp': int(time.time()) + 7200
-        })
+        id = "finalCompetitors"
+        putRecord(newRecord(processing_id, RECORD_FINAL, id, type="finalCompetitors", data=json.dumps(finalCompetitors)))
         return { "finalCompetitors" : id }
     
         
     elif "raw_directors" == bodyType:
-        response = dynamodb.get_item(TableName=dynamodb_table_name, Key={"id": {"S": jsonID}})
-        raw_directors = json.loads(response["Item"]["data"]["S"])
+        raw_directors = json.loads(getRecord(processing_id, RECORD_RAW, jsonID)["data"])
         raw_directors = { clean_name(key): value for key, value in raw_directors.items() } # clean key values
         arr_json_objects = split_json(raw_directors,split_json_count)
         filteredDirectorsArray = []
@@ -325,12 +302,6 @@ def lambda_handler(event, context):
                 finalDirectors[key] = { **raw_directors[key], "TYPE": "DIRECTOR" }
             except Exception as e:
                 print(e, key) #intentionally skip so if LLM hallucinates and introduces a key not previously available, it will skip.
-        id = str(uuid.uuid4())
-        table.put_item(
-            Item={
-            "id": id,
-            "type": "finalDirectors",
-            "data": json.dumps(finalDirectors),
-            'ttl_timestamp': int(time.time()) + 7200
-        })
+        id = "finalDirectors"
+        putRecord(newRecord(processing_id, RECORD_FINAL, id, type="finalDirectors", data=json.dumps(finalDirectors)))
         return { "finalDirectors" : id }
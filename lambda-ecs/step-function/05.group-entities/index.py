@@ -11,10 +11,13 @@ from connectionsinsights.neptune import (
 from connectionsinsights.utils import (
     increment_processing_status
 )
-
-dynamodb = boto3.resource('dynamodb')
-dynamodb_table_name = os.environ["DDBTBL_INGESTION"]
-table = dynamodb.Table(dynamodb_table_name)
+from connectionsinsights.records import (
+    newRecord,
+    putRecords,
+    queryRecords,
+    RECORD_FINAL,
+    RECORD_GROUP
+)
 
 def lambda_handler(event, context):
     summary = event["Summary"]
@@ -22,15 +25,14 @@ def lambda_handler(event, context):
     attributes = summary["MAIN_ENTITY"]["ATTRIBUTES"]
     
     # Get processing_id from step function payload and increment status (2 -> 3)
-    processing_id = event.get("processing_id")
-    if processing_id:
-        increment_processing_status(processing_id)
+    processing_id = event["processing_id"]
+    increment_processing_status(processing_id)
 
     allEdges = []
     results = {}
-    for obj in event["output"]:
-        item = table.get_item(Key={'id': obj[list(obj.keys())[0]]})    
-        data = json.loads(item["Item"]["data"])
+    # the filtered records of every category in one Query
+    for item in queryRecords(processing_id, RECORD_FINAL):
+        data = json.loads(item["data"])
         for key in data:
             if key == "":
                 continue
@@ -70,21 +72,18 @@ def lambda_handler(event, context):
     main_entity_id = getOrCreateID(g,"COMPANY", main_entity_name, attributes, allEdges)
     connection.close()
     
-    uuids = []
-    for key in results:
-        id = str(uuid.uuid4())
-        table.put_item(
-            Item={
-            "id": id,
-            "main_entity": summary["MAIN_ENTITY"]["NAME"],
-            "key": key,
-            "data": json.dumps(results[key]),
-            "summary": json.dumps(summary),
-            "main_entity_all_edges": json.dumps(allEdges),
-            "main_entity_id": main_entity_id,
-            "processing_id": processing_id,
-            'ttl_timestamp': int(time.time()) + 7200
-        })
-        uuids.append(id)
+    records = [
+        newRecord(processing_id, RECORD_GROUP, key,
+            main_entity=summary["MAIN_ENTITY"]["NAME"],
+            key=key,
+            data=json.dumps(results[key]),
+            summary=json.dumps(summary),
+            main_entity_all_edges=json.dumps(allEdges),
+            main_entity_id=main_entity_id,
+            processing_id=processing_id
+        )
+        for key in results
+    ]
+    putRecords(records)
 
-    return uuids
\ No newline at end of file
+    return [ {"processing_id": processing_id, "id": key} for key in results ]
\ No newline at end of file
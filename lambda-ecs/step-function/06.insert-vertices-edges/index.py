@@ -8,10 +8,10 @@ from connectionsinsights.neptune import (
     addOrUpdateEdge,
     GraphConnect
 )
-
-dynamodb = boto3.resource('dynamodb')
-dynamodb_table_name = os.environ["DDBTBL_INGESTION"]
-table = dynamodb.Table(dynamodb_table_name)
+from connectionsinsights.records import (
+    getRecord,
+    RECORD_GROUP
+)
 stepfunction = boto3.client('stepfunctions')
 
 def getAttributesArray(datadict, exclusionarray):
@@ -123,7 +123,7 @@ def main():
     directorKeys = []
 
     uuid = os.environ["uuid"]
-    item = table.get_item(Key={'id': uuid})['Item']
+    item = getRecord(os.environ["PROCESSING_ID"], RECORD_GROUP, uuid)
     array = json.loads(item["data"])
     summary = json.loads(item["summary"])
     main_entity_id = item["main_entity_id"]
@@ -5,6 +5,10 @@ import urllib.parse
 from connectionsinsights.utils import (
     increment_processing_status
 )
+from connectionsinsights.registry import (
+    updateDocumentStatus,
+    STATUS_COMPLETED
+)
 
 sqs = boto3.client('sqs')
 s3 = boto3.client('s3')
@@ -15,6 +19,12 @@ def lambda_handler(event, context):
     if processing_id:
         increment_processing_status(processing_id, is_final_step=True)
 
+    # Mark the document as completed in the registry so identical re-uploads are skipped
+    try:
+        updateDocumentStatus(event.get("S3File", {}).get("CONTENT_HASH"), STATUS_COMPLETED, processing_id=processing_id)
+    except Exception as e:
+        print(e)
+
     queue_url = sqs.get_queue_url(QueueName=os.environ["QUEUE_NAME"])['QueueUrl']
 
     try:
@@ -4,6 +4,10 @@ import os
 from connectionsinsights.utils import (
     mark_processing_failed
 )
+from connectionsinsights.registry import (
+    updateDocumentStatus,
+    STATUS_FAILED
+)
 
 sqs = boto3.client('sqs')
 
@@ -14,6 +18,12 @@ def lambda_handler(event, context):
         error_message = event.get("Error", {}).get("Cause", "Step function execution failed")
         mark_processing_failed(processing_id, error_message)
 
+    # Release the registry entry so the same document can be uploaded again
+    try:
+        updateDocumentStatus(event.get("S3File", {}).get("CONTENT_HASH"), STATUS_FAILED)
+    except Exception as e:
+        print(e)
+
     queue_url = sqs.get_queue_url(QueueName=os.environ["QUEUE_NAME"])['QueueUrl']
 
     try:
@@ -5,10 +5,26 @@ import random
 import time
 import re 
 import uuid
+import threading
+import concurrent.futures
 from math import sqrt, pow
 import botocore
 from datetime import datetime
 
+from connectionsinsights.ratelimiter import (
+    acquireBedrockCapacity,
+    estimateRequestTokens
+)
+
+from connectionsinsights.chunker import (
+    estimateTokens
+)
+
+from connectionsinsights.cache import (
+    bedrock_cache,
+    cacheKey
+)
+
 
 # ██████  ███████ ██████  ██████   ██████   ██████ ██   ██ 
 # ██   ██ ██      ██   ██ ██   ██ ██    ██ ██      ██  ██  
@@ -17,12 +33,74 @@ from datetime import datetime
 # ██████  ███████ ██████  ██   ██  ██████   ██████ ██   ██ 
 
 CLAUDE_SONNET_4_6 = "us.anthropic.claude-sonnet-4-6"
+CLAUDE_HAIKU_4_5 = "us.anthropic.claude-haiku-4-5-20251001-v1:0"
 CLAUDE_3_SONNET = "anthropic.claude-3-sonnet-20240229-v1:0"
 CLAUDE_2_1 = "anthropic.claude-v2:1"
 
 
 default_model_id = CLAUDE_SONNET_4_6
 
+# Mark the static prefix of prompts as a prompt-cache checkpoint, so repeated instructions are read from
+# Bedrock's prompt cache instead of being processed again.  Prefixes (tools included) estimated to be under the
+# model minimum are not cached by Bedrock, so their checkpoint is dropped before the request is sent.
+BEDROCK_PROMPT_CACHING = os.environ.get("BEDROCK_PROMPT_CACHING", "true").lower() == "true"
+PROMPT_CACHE_MIN_TOKENS = {CLAUDE_HAIKU_4_5: 4096}
+PROMPT_CACHE_DEFAULT_MIN_TOKENS = 1024
+
+# Where the model writes its explanation relative to the answer: BEFORE (reason first), AFTER (answer first;
+# the stream is closed once the answer tag is complete, so the explanation is not generated) or SKIP.  A tool
+# call cannot be stopped early, so structured-output schemas have no explanation in AFTER mode, as with SKIP.
+EXPLANATION_BEFORE = "BEFORE"
+EXPLANATION_AFTER = "AFTER"
+EXPLANATION_SKIP = "SKIP"
+BEDROCK_EXPLANATION_MODE = os.environ.get("BEDROCK_EXPLANATION_MODE", EXPLANATION_BEFORE).upper()
+
+def explanationInstruction(tag):
+    if BEDROCK_EXPLANATION_MODE == EXPLANATION_SKIP:
+        return f"Do not provide an explanation; only print the <{tag}></{tag}> tag."
+    elif BEDROCK_EXPLANATION_MODE == EXPLANATION_AFTER:
+        return f"Print the <{tag}></{tag}> tag first, then provide your explanation within <explanation> tags."
+    return f"Provide your explanation within <explanation> tags before the <{tag}></{tag}> tag."
+
+def buildPromptContent(static, variable):
+    """User message content blocks: the static prefix (cache checkpoint) followed by the variable part"""
+    static_block = {"type": "text", "text": static}
+    if BEDROCK_PROMPT_CACHING:
+        static_block["cache_control"] = {"type": "ephemeral"}
+    return [static_block, {"type": "text", "text": variable}]
+
+def promptCacheMinTokens(modelId):
+    return int(os.environ.get("BEDROCK_PROMPT_CACHE_MIN_TOKENS", PROMPT_CACHE_MIN_TOKENS.get(modelId, PROMPT_CACHE_DEFAULT_MIN_TOKENS)))
+
+def withoutShortCacheCheckpoints(messages, tools=None, modelId=default_model_id):
+    """Messages without the cache_control of checkpoints whose prefix is under the model's minimum"""
+    min_tokens = promptCacheMinTokens(modelId)
+    prefix_tokens = estimateTokens(json.dumps(tools)) if tools else 0
+    result = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            blocks = []
+            for block in content:
+                prefix_tokens += estimateTokens(block.get("text", ""))
+                if "cache_control" in block:
+                    if prefix_tokens < min_tokens:
+                        block = {key: value for key, value in block.items() if key != "cache_control"}
+                        bedrock_metrics.add("cache_checkpoints_skipped")
+                    else:
+                        bedrock_metrics.add("cache_checkpoints")
+                blocks.append(block)
+            message = {**message, "content": blocks}
+        else:
+            prefix_tokens += estimateTokens(content)
+        result.append(message)
+    return result
+
+def getMessageText(content):
+    if isinstance(content, list):
+        return "".join(block.get("text", "") for block in content)
+    return content
+
 def convertMessagesToTextCompletion(messages):
     def convertRole(role):
         if role == "user":
@@ -31,107 +109,617 @@ def convertMessagesToTextCompletion(messages):
             return "Assistant"
 
     return "".join(
-        [convertRole(message["role"]) +": "+ message["content"] +"\n\n" for message in messages]
+        [convertRole(message["role"]) +": "+ getMessageText(message["content"]) +"\n\n" for message in messages]
     )
 
-def queryBedrockTextCompletion(prompt, temperature=0, top_p=0):
-    bedrock = boto3.client(
-        service_name='bedrock-runtime', 
-        endpoint_url = "https://bedrock-runtime."+os.environ["AWS_REGION"]+".amazonaws.com",
-        config = botocore.config.Config(
-            read_timeout=900,
-            connect_timeout=900
-        )
-    )
+# Process-wide Bedrock runtime client.  boto3 clients are thread-safe, so a single client (and its connection
+# pool) is shared by every caller and thread in the container instead of being built per request.
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+
+# Throttling retries: exponential backoff with full jitter, bounded by attempts and total sleep per call
+BEDROCK_MAX_RETRIES = int(os.environ.get("BEDROCK_MAX_RETRIES", "8"))
+BEDROCK_RETRY_BASE_SECONDS = float(os.environ.get("BEDROCK_RETRY_BASE_SECONDS", "2"))
+BEDROCK_RETRY_MAX_SECONDS = float(os.environ.get("BEDROCK_RETRY_MAX_SECONDS", "60"))
+BEDROCK_RETRY_BUDGET_SECONDS = float(os.environ.get("BEDROCK_RETRY_BUDGET_SECONDS", "300"))
+
+# Requests per second allowed by the in-container token bucket; 0 disables the limiter
+BEDROCK_MAX_REQUESTS_PER_SECOND = float(os.environ.get("BEDROCK_MAX_REQUESTS_PER_SECOND", "5"))
+
+# Stream timeouts: the client timeouts bound connecting and each socket read, while the first-token and stall
+# timeouts bound the streaming loop, so a stalled stream is abandoned and retried instead of holding the function
+BEDROCK_CONNECT_TIMEOUT = int(os.environ.get("BEDROCK_CONNECT_TIMEOUT", "10"))
+BEDROCK_READ_TIMEOUT = int(os.environ.get("BEDROCK_READ_TIMEOUT", "120"))
+BEDROCK_FIRST_TOKEN_TIMEOUT = float(os.environ.get("BEDROCK_FIRST_TOKEN_TIMEOUT", "60"))
+BEDROCK_STALL_TIMEOUT = float(os.environ.get("BEDROCK_STALL_TIMEOUT", "30"))
+BEDROCK_STREAM_TIMEOUT_RETRIES = int(os.environ.get("BEDROCK_STREAM_TIMEOUT_RETRIES", "2"))
+
+# Hedged requests: a request still running after the recent p95 latency of its kind is sent a second time and
+# the first to complete wins (the other stream is closed).  Off by default, as hedges spend extra tokens.
+BEDROCK_HEDGING = os.environ.get("BEDROCK_HEDGING", "false").lower() == "true"
+BEDROCK_HEDGE_PERCENTILE = float(os.environ.get("BEDROCK_HEDGE_PERCENTILE", "95"))
+BEDROCK_HEDGE_MIN_SAMPLES = int(os.environ.get("BEDROCK_HEDGE_MIN_SAMPLES", "20"))
+
+# Output limits: requests start at BEDROCK_MAX_TOKENS; truncated text completions are continued up to
+# BEDROCK_MAX_CONTINUATIONS times, and truncated tool calls are retried with a larger limit up to the ceiling
+BEDROCK_MAX_TOKENS = int(os.environ.get("BEDROCK_MAX_TOKENS", "4000"))
+BEDROCK_MAX_TOKENS_CEILING = int(os.environ.get("BEDROCK_MAX_TOKENS_CEILING", "16000"))
+BEDROCK_MAX_CONTINUATIONS = int(os.environ.get("BEDROCK_MAX_CONTINUATIONS", "3"))
+
+THROTTLING_ERROR_MARKERS = ["THROTTLINGEXCEPTION", "TOOMANYREQUESTS", "SERVICEUNAVAILABLE", "RATE EXCEEDED"]
+
+_bedrock_client = None
+_bedrock_client_lock = threading.Lock()
+
+def getBedrockClient():
+    global _bedrock_client
+    if _bedrock_client is None:
+        with _bedrock_client_lock:
+            if _bedrock_client is None:
+                _bedrock_client = boto3.client(
+                    service_name='bedrock-runtime', 
+                    endpoint_url = "https://bedrock-runtime."+os.environ["AWS_REGION"]+".amazonaws.com",
+                    config = botocore.config.Config(
+                        read_timeout=BEDROCK_READ_TIMEOUT,
+                        connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+                        max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+                        retries={"max_attempts": 1} # throttling is retried (and counted) by invokeWithRetry
+                    )
+                )
+    return _bedrock_client
+
+class BedrockMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "throttles": 0,
+            "retries": 0,
+            "sleep_seconds": 0.0,
+            "limiter_wait_seconds": 0.0,
+            "quota_wait_seconds": 0.0,
+            "early_stops": 0,
+            "first_token_seconds": 0.0,
+            "stream_timeouts": 0,
+            "hedged_requests": 0,
+            "hedge_wins": 0,
+            "truncations": 0,
+            "continuations": 0,
+            "json_repairs": 0,
+            "json_regenerations": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "cache_write_input_tokens": 0,
+            "cache_checkpoints": 0,
+            "cache_checkpoints_skipped": 0,
+            # usage of the hedged requests whose result was not used
+            "hedge_input_tokens": 0,
+            "hedge_output_tokens": 0,
+            "hedge_cache_read_input_tokens": 0,
+            "hedge_cache_write_input_tokens": 0
+        }
+
+    def add(self, key, value=1):
+        with self.lock:
+            self.counters[key] += value
+
+    def report(self):
+        with self.lock:
+            # share of the prompt tokens read from the prompt cache
+            prompt_tokens = self.counters["input_tokens"] + self.counters["cache_read_input_tokens"] + self.counters["cache_write_input_tokens"]
+            cache_read_rate = self.counters["cache_read_input_tokens"] / prompt_tokens if prompt_tokens > 0 else 0
+            print("Bedrock metrics: " + ", ".join(
+                f"{key}={round(value, 3) if isinstance(value, float) else value}" for key, value in self.counters.items()
+            ) + f", cache_read_rate={round(cache_read_rate, 3)}")
+
+bedrock_metrics = BedrockMetrics()
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all threads in the container.  The refill rate backs off
+    multiplicatively when Bedrock throttles and recovers additively on success, up to max_rate.
+    """
+    def __init__(self, max_rate, min_rate=0.2):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.capacity = max(1.0, max_rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+bedrock_limiter = TokenBucket(BEDROCK_MAX_REQUESTS_PER_SECOND) if BEDROCK_MAX_REQUESTS_PER_SECOND > 0 else None
+
+class BedrockStreamTimeout(Exception):
+    pass
+
+class StreamCancelled(Exception):
+    pass
+
+class LatencyTracker:
+    """
+    Rolling window of successful request latencies per kind of request.  Each Lambda function runs one
+    pipeline stage, so the window in a container reflects the latency of that stage's prompts.
+    """
+    def __init__(self, window=200):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self.lock:
+            samples = self.samples.setdefault(key, [])
+            samples.append(seconds)
+            if len(samples) > self.window:
+                del samples[0]
+
+    def percentile(self, key, percentile):
+        with self.lock:
+            samples = sorted(self.samples.get(key, []))
+        if len(samples) < BEDROCK_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+bedrock_latencies = LatencyTracker()
+
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+_hedge_attempt = threading.local()
+
+def addUsage(key, value):
+    """Token usage of a request; while a hedged request runs it is held until the request wins or loses"""
+    usage = getattr(_hedge_attempt, "usage", None)
+    if usage is None:
+        bedrock_metrics.add(key, value)
+    else:
+        usage[key] = usage.get(key, 0) + value
+
+def reportUsage(usage, hedge_loser):
+    for key, value in usage.items():
+        bedrock_metrics.add("hedge_" + key if hedge_loser else key, value)
+
+def getHedgeExecutor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BEDROCK_MAX_POOL_CONNECTIONS)
+    return _hedge_executor
+
+def invokeHedged(invoke, latency_key, acquire=None):
+    """
+    Call invoke(cancel) and, when hedging is enabled and it has not completed within the p95 latency for
+    latency_key, a second invoke(cancel); returns the first result and sets the other request's cancel event.
+    acquire() is called before the second request, which needs its own quota.
+    """
+    delay = bedrock_latencies.percentile(latency_key, BEDROCK_HEDGE_PERCENTILE) if BEDROCK_HEDGING and latency_key else None
+
+    def attempt(cancel, usage=None):
+        start = time.monotonic()
+        _hedge_attempt.usage = usage
+        try:
+            result = invoke(cancel)
+        finally:
+            _hedge_attempt.usage = None
+        return result, time.monotonic() - start
+
+    if delay is None:
+        result, latency = attempt(None)
+        if latency_key:
+            bedrock_latencies.record(latency_key, latency)
+        return result
+
+    # usage is counted for the request whose result is used; the other's goes to the hedge_* counters
+    usages = [{}]
+    cancels = [threading.Event()]
+    futures = [getHedgeExecutor().submit(attempt, cancels[0], usages[0])]
+    done, _ = concurrent.futures.wait(futures, timeout=delay)
+    if not done:
+        bedrock_metrics.add("hedged_requests")
+        if acquire is not None:
+            acquire()
+        usages.append({})
+        cancels.append(threading.Event())
+        futures.append(getHedgeExecutor().submit(attempt, cancels[1], usages[1]))
+
+    error = None
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            try:
+                result, latency = future.result()
+            except Exception as e:
+                error = e # the other request may still succeed
+                continue
+            for index, other in enumerate(futures):
+                if other is future:
+                    reportUsage(usages[index], False)
+                else:
+                    cancels[index].set()
+                    other.add_done_callback(lambda _, usage=usages[index]: reportUsage(usage, True))
+            if future is not futures[0]:
+                bedrock_metrics.add("hedge_wins")
+            bedrock_latencies.record(latency_key, latency)
+            return result
+    for index, usage in enumerate(usages):
+        reportUsage(usage, index > 0)
+    raise error
+
+def readStream(stream, onChunk, cancel=None):
+    """
+    Iterate over a Bedrock response stream, calling onChunk(chunk_obj) for each chunk until it returns True.
+    A watchdog closes the stream and raises BedrockStreamTimeout when no token arrives within
+    BEDROCK_FIRST_TOKEN_TIMEOUT, or no chunk within BEDROCK_STALL_TIMEOUT after that; it raises
+    StreamCancelled when `cancel` is set (the other request of a hedge completed first).
+    """
+    start = time.monotonic()
+    state = {"last_chunk": start, "first_token": False, "finished": False, "aborted": None}
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def watchdog():
+        while not finished.wait(0.5):
+            now = time.monotonic()
+            with lock:
+                if state["finished"]:
+                    return
+                if cancel is not None and cancel.is_set():
+                    state["aborted"] = "cancelled"
+                elif not state["first_token"] and now - start > BEDROCK_FIRST_TOKEN_TIMEOUT:
+                    state["aborted"] = f"no first token within {BEDROCK_FIRST_TOKEN_TIMEOUT}s"
+                elif state["first_token"] and now - state["last_chunk"] > BEDROCK_STALL_TIMEOUT:
+                    state["aborted"] = f"stream stalled for {BEDROCK_STALL_TIMEOUT}s"
+                else:
+                    continue
+            try:
+                stream.close()
+            except Exception:
+                pass
+            return
+
+    threading.Thread(target=watchdog, daemon=True).start()
     try:
-        # queries bedrock (streaming mode)
-        output = []
-
-        body = json.dumps({
-            "prompt": prompt,
-            "max_tokens_to_sample": 4000,
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": 250
-        })
-
-        modelId = 'anthropic.claude-v2:1'
-        accept = '*/*'
-        contentType = 'application/json'
-
-        response = bedrock.invoke_model_with_response_stream(body=body, modelId=modelId, accept=accept, contentType=contentType)
-        stream = response.get('body')
-        if stream:
-            for event in stream:
-                chunk = event.get('chunk')
-                if chunk:
-                    chunk_obj = json.loads(chunk.get('bytes').decode())
-                    text = chunk_obj['completion']
-                    output.append(text)
-
-        return ''.join(output)
-
+        for event in stream:
+            chunk = event.get('chunk')
+            if chunk:
+                chunk_obj = json.loads(chunk.get('bytes').decode())
+                now = time.monotonic()
+                with lock:
+                    if not state["first_token"] and (chunk_obj.get("type") == 'content_block_delta' or 'completion' in chunk_obj):
+                        state["first_token"] = True
+                        bedrock_metrics.add("first_token_seconds", now - start)
+                    state["last_chunk"] = now
+                if onChunk(chunk_obj):
+                    closeStream(stream)
+                    break
     except Exception as e:
-        if "throttlingException".upper() in str(e).upper():
-            time.sleep(random.randint(10,30))
-            return queryBedrockTextCompletion(prompt, temperature, top_p)
-        else:
-            raise Exception(e)
-
-def queryBedrockMessages(messages, temperature=0, top_p=0, modelId=default_model_id, retry=3):
-    bedrock = boto3.client(
-        service_name='bedrock-runtime', 
-        endpoint_url = "https://bedrock-runtime."+os.environ["AWS_REGION"]+".amazonaws.com",
-        config = botocore.config.Config(
-            read_timeout=900,
-            connect_timeout=900
-        )
-    )
+        if state["aborted"] is None:
+            raise e
+    finally:
+        with lock:
+            state["finished"] = True
+        finished.set()
+
+    if state["aborted"] == "cancelled":
+        raise StreamCancelled()
+    elif state["aborted"] is not None:
+        bedrock_metrics.add("stream_timeouts")
+        raise BedrockStreamTimeout(f"Bedrock stream timeout: {state['aborted']}")
+
+def isThrottlingError(e):
+    message = str(e).upper()
+    return any(marker in message for marker in THROTTLING_ERROR_MARKERS)
+
+def backoffSeconds(attempt):
+    # full jitter: uniform over [0, min(cap, base * 2^attempt)]
+    return random.uniform(0, min(BEDROCK_RETRY_MAX_SECONDS, BEDROCK_RETRY_BASE_SECONDS * pow(2, attempt)))
+
+def invokeWithRetry(invoke, retry=3, latency_key=None, quota=None):
+    """
+    Call invoke(cancel) (a complete Bedrock request, including reading the stream), hedged when enabled,
+    retrying throttling with exponential backoff and full jitter within the retry budget, stream timeouts
+    up to BEDROCK_STREAM_TIMEOUT_RETRIES times, and other errors up to `retry` times.  With quota=(modelId,
+    tokens, priority), every request sent (retries and hedges included) first waits for capacity in the
+    Bedrock quota shared by all functions (see connectionsinsights.ratelimiter).
+    """
+    def acquireQuota():
+        if quota is not None:
+            bedrock_metrics.add("quota_wait_seconds", acquireBedrockCapacity(*quota))
+
+    throttle_attempts = 0
+    timeout_retries = 0
+    slept = 0.0
+    while True:
+        if bedrock_limiter is not None:
+            bedrock_metrics.add("limiter_wait_seconds", bedrock_limiter.acquire())
+        acquireQuota()
+        bedrock_metrics.add("requests")
+        try:
+            result = invokeHedged(invoke, latency_key, acquireQuota)
+            if bedrock_limiter is not None:
+                bedrock_limiter.succeeded()
+            return result
+        except Exception as e:
+            if isThrottlingError(e):
+                bedrock_metrics.add("throttles")
+                if bedrock_limiter is not None:
+                    bedrock_limiter.throttled()
+                delay = backoffSeconds(throttle_attempts)
+                if throttle_attempts >= BEDROCK_MAX_RETRIES or slept + delay > BEDROCK_RETRY_BUDGET_SECONDS:
+                    print(f"Bedrock retry budget exhausted after {throttle_attempts} throttling retries ({round(slept, 1)}s)")
+                    raise Exception(e)
+                throttle_attempts += 1
+            elif isinstance(e, BedrockStreamTimeout) and timeout_retries < BEDROCK_STREAM_TIMEOUT_RETRIES:
+                print(f"Retrying Bedrock request: {str(e)}")
+                timeout_retries += 1
+                delay = backoffSeconds(0)
+            elif retry > 0:
+                retry -= 1
+                delay = backoffSeconds(0)
+            else:
+                raise Exception(e)
+            bedrock_metrics.add("retries")
+            bedrock_metrics.add("sleep_seconds", delay)
+            slept += delay
+            time.sleep(delay)
+
+def reportBedrockMetrics():
+    bedrock_metrics.report()
+    if bedrock_cache is not None:
+        bedrock_cache.report()
+
+class StopTagScanner:
+    """Incrementally scans streamed text for a non-empty <tag>...</tag>, so the stream can be closed early"""
+    def __init__(self, tag):
+        self.open_tag = "<" + tag + ">"
+        self.close_tag = "</" + tag + ">"
+        self.text = ""
+        self.scanned = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        position = self.text.find(self.close_tag, max(0, self.scanned - len(self.close_tag)))
+        while position > -1:
+            start = self.text.rfind(self.open_tag, 0, position)
+            if start > -1 and self.text[start+len(self.open_tag):position].strip():
+                return True
+            position = self.text.find(self.close_tag, position + len(self.close_tag))
+        self.scanned = len(self.text)
+        return False
+
+def closeStream(stream):
+    bedrock_metrics.add("early_stops")
     try:
-        # queries bedrock (streaming mode)
-        output = []
-
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "messages": messages,
-            "max_tokens": 4000,
-            "temperature": temperature,
-            # "top_p": top_p, # To provide only either temperature or top_p in newer Claude versions
-            "top_k": 250
-        })
-
-        accept = '*/*'
-        contentType = 'application/json'
-
-        response = bedrock.invoke_model_with_response_stream(body=body, modelId=modelId, accept=accept, contentType=contentType)
-        
-        stream = response.get('body')
-        if stream:
-            for event in stream:
-                chunk = event.get('chunk')
-                if chunk:
-                    chunk_obj = json.loads(chunk.get('bytes').decode())
-                    if chunk_obj["type"] == 'content_block_delta':
+        stream.close()
+    except Exception as e:
+        print(f"Error closing Bedrock stream: {str(e)}")
+
+def continuationMessages(messages, generated):
+    """Messages that resume a truncated completion: the generated text becomes (or extends) the assistant prefill"""
+    if messages and messages[-1]["role"] == "assistant":
+        prefill = getMessageText(messages[-1]["content"])
+        return messages[:-1] + [{"role": "assistant", "content": (prefill + generated).rstrip()}]
+    # the final assistant content cannot end with whitespace
+    return messages + [{"role": "assistant", "content": generated.rstrip()}]
+
+class MaxTokensTracker:
+    """
+    max_tokens per kind of request, starting at BEDROCK_MAX_TOKENS and doubled (up to the ceiling) whenever a
+    request that cannot be continued is truncated, so later requests of that kind ask for enough from the start
+    """
+    def __init__(self):
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.limits.get(key, BEDROCK_MAX_TOKENS)
+
+    def raiseLimit(self, key, current):
+        with self.lock:
+            self.limits[key] = max(self.limits.get(key, BEDROCK_MAX_TOKENS), min(BEDROCK_MAX_TOKENS_CEILING, current * 2))
+            return self.limits[key]
+
+bedrock_max_tokens = MaxTokensTracker()
+
+def queryBedrockTextCompletion(prompt, temperature=0, top_p=0, stop_tag=None, priority=None):
+    def request(request_prompt):
+        def invoke(cancel=None):
+            # queries bedrock (streaming mode)
+            output = []
+            stop_reason = []
+
+            body = json.dumps({
+                "prompt": request_prompt,
+                "max_tokens_to_sample": BEDROCK_MAX_TOKENS,
+                "temperature": temperature,
+                "top_p": top_p,
+                "top_k": 250
+            })
+
+            modelId = 'anthropic.claude-v2:1'
+            accept = '*/*'
+            contentType = 'application/json'
+
+            response = getBedrockClient().invoke_model_with_response_stream(body=body, modelId=modelId, accept=accept, contentType=contentType)
+            stream = response.get('body')
+            scanner = StopTagScanner(stop_tag) if stop_tag else None
+
+            def onChunk(chunk_obj):
+                text = chunk_obj['completion']
+                output.append(text)
+                if chunk_obj.get('stop_reason'):
+                    stop_reason.append(chunk_obj['stop_reason'])
+                return scanner is not None and scanner.feed(text)
+
+            if stream:
+                readStream(stream, onChunk, cancel)
+
+            return ''.join(output), (stop_reason or [None])[-1]
+
+        quota = (CLAUDE_2_1, estimateRequestTokens(len(request_prompt), BEDROCK_MAX_TOKENS), priority)
+        return invokeWithRetry(invoke, retry=0, latency_key=CLAUDE_2_1, quota=quota)
+
+    completion, stop_reason = request(prompt)
+    continuations = 0
+    while stop_reason == "max_tokens" and continuations < BEDROCK_MAX_CONTINUATIONS:
+        # resume the completion from where it was cut off
+        bedrock_metrics.add("truncations")
+        bedrock_metrics.add("continuations")
+        continuations += 1
+        completion = completion.rstrip()
+        more, stop_reason = request(prompt + completion)
+        completion += more
+    if stop_reason == "max_tokens":
+        bedrock_metrics.add("truncations")
+        print(f"Bedrock completion still truncated after {continuations} continuations")
+    return completion, stop_reason
+
+def requestKind(modelId, tools=None):
+    # tool (JSON) and free-text requests take very different times, so their latencies are tracked apart
+    return modelId + ("#tools" if tools else "#text")
+
+def queryBedrockMessages(messages, temperature=0, top_p=0, modelId=default_model_id, retry=3, tools=None, tool_choice=None, stop_tag=None, priority=None):
+    kind = requestKind(modelId, tools)
+    messages = withoutShortCacheCheckpoints(messages, tools, modelId)
+
+    def request(request_messages, max_tokens):
+        def invoke(cancel=None):
+            # queries bedrock (streaming mode)
+            output = []
+            tool_input = []
+            stop_reason = []
+            usage_reported = []
+
+            request = {
+                "anthropic_version": "bedrock-2023-05-31",
+                "messages": request_messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                # "top_p": top_p, # To provide only either temperature or top_p in newer Claude versions
+                "top_k": 250
+            }
+            if tools:
+                request["tools"] = tools
+                if tool_choice:
+                    request["tool_choice"] = tool_choice
+            body = json.dumps(request)
+
+            accept = '*/*'
+            contentType = 'application/json'
+
+            response = getBedrockClient().invoke_model_with_response_stream(body=body, modelId=modelId, accept=accept, contentType=contentType)
+            
+            stream = response.get('body')
+            # stop reading (and generating) as soon as the answer tag is complete, e.g. before a trailing explanation
+            scanner = StopTagScanner(stop_tag) if stop_tag and not tools else None
+
+            def onChunk(chunk_obj):
+                if chunk_obj["type"] == 'content_block_delta':
+                    if chunk_obj['delta']['type'] == 'input_json_delta':
+                        tool_input.append(chunk_obj['delta']['partial_json'])
+                    else:
                         text = chunk_obj['delta']['text']
                         output.append(text)
-
-        return ''.join(output)
-
-    except Exception as e:
-        if "throttlingException".upper() in str(e).upper():
-            time.sleep(random.randint(10,30))
-            return queryBedrockMessages(messages, temperature, top_p, modelId, retry)
-        elif retry > 0:
-            return queryBedrockMessages(messages, temperature, top_p, modelId, retry-1)
+                        return scanner is not None and scanner.feed(text)
+                elif chunk_obj["type"] == 'message_start':
+                    usage = chunk_obj['message'].get('usage', {})
+                    addUsage("input_tokens", usage.get('input_tokens', 0))
+                    addUsage("cache_read_input_tokens", usage.get('cache_read_input_tokens', 0))
+                    addUsage("cache_write_input_tokens", usage.get('cache_creation_input_tokens', 0))
+                elif chunk_obj["type"] == 'message_delta':
+                    usage_reported.append(True)
+                    addUsage("output_tokens", chunk_obj.get('usage', {}).get('output_tokens', 0))
+                    if chunk_obj.get('delta', {}).get('stop_reason'):
+                        stop_reason.append(chunk_obj['delta']['stop_reason'])
+                return False
+
+            if stream:
+                readStream(stream, onChunk, cancel)
+            if not usage_reported:
+                # a stream closed early never gets its message_delta usage: count what was received
+                addUsage("output_tokens", estimateTokens(''.join(tool_input) + ''.join(output)))
+
+            # with tools, the completion is the (JSON) input of the tool call
+            return ''.join(tool_input) if tools else ''.join(output), (stop_reason or [None])[-1]
+
+        quota = (modelId, estimateRequestTokens(len(json.dumps(request_messages)) + len(json.dumps(tools or [])), max_tokens), priority)
+        return invokeWithRetry(invoke, retry, latency_key=kind, quota=quota)
+
+    max_tokens = bedrock_max_tokens.get(kind)
+    completion, stop_reason = request(messages, max_tokens)
+    continuations = 0
+    while stop_reason == "max_tokens":
+        bedrock_metrics.add("truncations")
+        if tools:
+            # a tool call cannot be resumed, so ask again with a larger limit
+            if max_tokens >= BEDROCK_MAX_TOKENS_CEILING:
+                break
+            max_tokens = bedrock_max_tokens.raiseLimit(kind, max_tokens)
+            print(f"Bedrock tool call truncated, retrying with max_tokens={max_tokens}")
+            completion, stop_reason = request(messages, max_tokens)
         else:
-            raise Exception(e)
+            # resume the text from where it was cut off, with the text so far as the assistant prefill
+            if continuations >= BEDROCK_MAX_CONTINUATIONS:
+                break
+            bedrock_metrics.add("continuations")
+            continuations += 1
+            completion = completion.rstrip()
+            more, stop_reason = request(continuationMessages(messages, completion), max_tokens)
+            completion += more
+    if stop_reason == "max_tokens":
+        print(f"Bedrock completion still truncated (max_tokens={max_tokens}, continuations={continuations})")
+    return completion, stop_reason
         
-def queryBedrockStreaming(messages, temperature=0, top_p=0, modelId=default_model_id):
+def queryBedrockStreaming(messages, temperature=0, top_p=0, modelId=default_model_id, priority=None, cache=True, refresh_cache=False, tools=None, tool_choice=None, stop_tag=None, validate=None):
+    # identical deterministic (temperature 0) requests are served from the completion cache when one is configured;
+    # refresh_cache skips the lookup but still stores the new completion (e.g. to replace an unusable one).
+    # Truncated completions are never stored, nor those rejected by validate(completion), e.g. unparseable JSON.
+    use_cache = cache and bedrock_cache is not None and temperature == 0
+    if use_cache:
+        # keyed by the max_tokens the request is sent with, which grows for kinds of request that were truncated
+        max_tokens = BEDROCK_MAX_TOKENS if modelId == CLAUDE_2_1 else bedrock_max_tokens.get(requestKind(modelId, tools))
+        key = cacheKey(modelId, messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens, tools=tools, tool_choice=tool_choice, stop_tag=stop_tag)
+        completion = None if refresh_cache else bedrock_cache.get(key)
+        if completion is not None:
+            return completion
+
+    start = time.time()
     if modelId == "anthropic.claude-v2:1":
         prompt = convertMessagesToTextCompletion(messages)
-        return queryBedrockTextCompletion(prompt, temperature, top_p)
+        completion, stop_reason = queryBedrockTextCompletion(prompt, temperature, top_p, stop_tag=stop_tag, priority=priority)
     else:
-        return queryBedrockMessages(messages, temperature, top_p, modelId)
+        completion, stop_reason = queryBedrockMessages(messages, temperature, top_p, modelId, tools=tools, tool_choice=tool_choice, stop_tag=stop_tag, priority=priority)
+
+    if use_cache and stop_reason != "max_tokens" and (validate is None or validate(completion)):
+        bedrock_cache.put(key, completion, time.time() - start)
+    return completion
 
 
 def disambiguate(entity, combined_matches):
@@ -141,8 +729,7 @@ def disambiguate(entity, combined_matches):
         potential_entity_matches += json.dumps(match) + "\n"
         potential_entity_matches += f"</potential-entity-match>\n\n"
 
-    messages = [
-        {"role":"user", "content":"""
+    static_prompt = """
 You are an expert in disambiguating entities and determining if they are the same entity when given limited information.
 
 You are to review through the list of potential entities, and reason through the given information to determine if any of them are the same as the entity provided within <entity> tags.
@@ -155,6 +742,14 @@ You are to follow these rules strictly:
 5. As the amount of information provided may be different for each potential entity and the provided entity, the potential entity does not need to fully match the provided entity to be considered the same.  It is sufficient if there are enough similarities without much conflicting differences.
 6. Companies with the same name and operating in the same industry or focus area have a strong likelihood to be the same entity.
 
+If you determined that a potential entity is likely to be the same as the entity provided, then reply with the ID of the potential entity within <results></results> tag.  You should only return a maximum of 1 ID.
+
+If you determined that none of the potential entities are the same as the entity provided, reply with "NO MATCH FOUND" within <results></results> tag.
+
+{explanation}
+""".format(explanation=explanationInstruction("results"))
+
+    variable_prompt = """
 Here is the entity:
 
 <entity>
@@ -165,18 +760,15 @@ Here are the list of potential entities that may be the same as the above entity
 
 {potential_entity_matches}
 
-If you determined that a potential entity is likely to be the same as the entity provided, then reply with the ID of the potential entity within <results></results> tag.  You should only return a maximum of 1 ID.
-
-If you determined that none of the potential entities are the same as the entity provided, reply with "NO MATCH FOUND" within <results></results> tag.
-
-Provide your explanation within <explanation> tags.
-
 Think step by step.
-""".format(entity=json.dumps(entity), potential_entity_matches=potential_entity_matches)},
+""".format(entity=json.dumps(entity), potential_entity_matches=potential_entity_matches)
+
+    messages = [
+        {"role":"user", "content": buildPromptContent(static_prompt, variable_prompt)},
             {"role":"assistant", "content":""""""}
     ]
     
-    completion = queryBedrockStreaming(messages, temperature=0, top_p=0)
+    completion = queryBedrockStreaming(messages, temperature=0, top_p=0, stop_tag="results")
     results = getTextWithinTags(completion, "results").strip()
     
     prompt_history = convertMessagesToTextCompletion(messages) + "\n\n" + completion
@@ -212,17 +804,141 @@ def cleanJSONString(text):
     cleaned_text = re.sub(r'\bNULL\b', '""', cleaned_text, flags=re.IGNORECASE)
     return cleaned_text
 
+def repairJSONString(text):
+    """
+    Tolerant local repair of almost-valid JSON from a completion: strips surrounding prose, comments,
+    trailing commas, smart quotes and Python literals, and closes brackets left open by truncated output.
+    Returns the repaired string, or None if it still does not parse.
+    """
+    cleaned_text = cleanJSONString(text)
+    starts = [index for index in [cleaned_text.find("{"), cleaned_text.find("[")] if index > -1]
+    if not starts:
+        return None
+    cleaned_text = cleaned_text[min(starts):]
+    end = max(cleaned_text.rfind("}"), cleaned_text.rfind("]"))
+    if end > -1 and not re.search(r'["{\[:,]', cleaned_text[end+1:]):
+        cleaned_text = cleaned_text[:end+1] # trailing prose, not truncated JSON
+
+    cleaned_text = cleaned_text.replace("\u201c", '"').replace("\u201d", '"')
+
+    def repairOutsideStrings(segment):
+        segment = re.sub(r'^\s*//.*$', '', segment, flags=re.MULTILINE)
+        segment = re.sub(r'\bTrue\b', 'true', segment)
+        segment = re.sub(r'\bFalse\b', 'false', segment)
+        segment = re.sub(r'\bNone\b', 'null', segment)
+        return re.sub(r',(\s*)(?=[}\]])', r'\1', segment)
+
+    # only touch the parts of the text outside of string literals
+    parts = re.split(r'("(?:\\.|[^"\\])*")', cleaned_text)
+    cleaned_text = "".join(part if index % 2 == 1 else repairOutsideStrings(part) for index, part in enumerate(parts))
+
+    # close brackets and strings left open by truncated output
+    stack = []
+    in_string = False
+    escaped = False
+    for char in cleaned_text:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = in_string
+        elif char == '"':
+            in_string = not in_string
+        elif not in_string and char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif not in_string and char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        cleaned_text += '"'
+    cleaned_text = re.sub(r',\s*$', '', cleaned_text) + "".join(reversed(stack))
+
+    try:
+        json.loads(cleaned_text)
+        return cleaned_text
+    except ValueError:
+        return None
+
+# Structured output: the JSON is requested through a forced tool call whose input schema describes the
+# result, falling back to scraping <tag></tag> from the text completion (e.g. for text completion models)
+BEDROCK_STRUCTURED_OUTPUT = os.environ.get("BEDROCK_STRUCTURED_OUTPUT", "true").lower() == "true"
+BEDROCK_JSON_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_JSON_MAX_ATTEMPTS", "3"))
+STRUCTURED_OUTPUT_TOOL = "record_results"
+
+def resultSchema(tag, schema, explanation=None):
+    """Tool input schema with the result under `tag`, optionally preceded by a free-text reasoning field"""
+    properties = {}
+    required = []
+    if explanation and BEDROCK_EXPLANATION_MODE == EXPLANATION_BEFORE:
+        properties["explanation"] = {"type": "string", "description": explanation}
+        required.append("explanation")
+    properties[tag] = schema
+    required.append(tag)
+    return {"type": "object", "properties": properties, "required": required}
+
+def maxOutputTokens(modelId=default_model_id, schema=None):
+    """max_tokens the next queryBedrockJSON request to modelId (with or without a schema) starts with"""
+    if modelId == CLAUDE_2_1:
+        return BEDROCK_MAX_TOKENS
+    return bedrock_max_tokens.get(requestKind(modelId, tools=BEDROCK_STRUCTURED_OUTPUT and schema is not None))
+
+def queryBedrockJSON(messages, tag, schema=None, modelId=default_model_id, max_attempts=BEDROCK_JSON_MAX_ATTEMPTS, **kwargs):
+    """
+    Query Bedrock for a JSON result and return (result, completion).  With a schema (see resultSchema) the
+    model is forced to answer through a tool call; otherwise the JSON is read from within <tag></tag>.
+    Invalid JSON is repaired locally where possible, and regenerated at most max_attempts times in total.
+    """
+    structured = BEDROCK_STRUCTURED_OUTPUT and schema is not None and modelId != CLAUDE_2_1
+    tool_kwargs = {}
+    if structured:
+        tool_kwargs = {
+            "tools": [{"name": STRUCTURED_OUTPUT_TOOL, "description": "Record the results in the required format", "input_schema": schema}],
+            "tool_choice": {"type": "tool", "name": STRUCTURED_OUTPUT_TOOL}
+        }
+
+    def parse(completion):
+        # (result, repaired), or None when the completion holds no usable JSON
+        text = completion if structured else getTextWithinTags(completion, tag)
+        try:
+            result, repaired = json.loads(cleanJSONString(text)), False
+        except ValueError:
+            text = repairJSONString(text)
+            if text is None:
+                return None
+            result, repaired = json.loads(text), True
+        if structured and isinstance(result, dict) and tag in result:
+            result = result[tag]
+        return result, repaired
+
+    completion = ""
+    for attempt in range(max_attempts):
+        if not structured:
+            tool_kwargs["stop_tag"] = tag
+        # only completions that parse are cached, so a failed attempt is regenerated rather than served again
+        completion = queryBedrockStreaming(messages, modelId=modelId, refresh_cache=attempt > 0, validate=lambda completion: parse(completion) is not None, **tool_kwargs, **kwargs)
+        parsed = parse(completion)
+        if parsed is None:
+            bedrock_metrics.add("json_regenerations")
+            print(f"Unable to parse JSON ({tag}) on attempt {attempt + 1}: {completion[:500]}")
+            continue
+        result, repaired = parsed
+        if repaired:
+            bedrock_metrics.add("json_repairs")
+        return result, completion
+
+    raise ValueError(f"Unable to get valid JSON ({tag}) from Bedrock after {max_attempts} attempts")
+
 def generateEmbeddings(prompt):
     prompt = " ".join(prompt.split()[0:min(2500,len( prompt.split() ))])
-    bedrock = boto3.client(service_name='bedrock-runtime', endpoint_url = "https://bedrock-runtime."+os.environ["AWS_REGION"]+".amazonaws.com")
     body = json.dumps({"inputText": prompt})
 
     modelId = 'amazon.titan-embed-text-v1'
     accept = '*/*'
     contentType = 'application/json'
 
-    response = bedrock.invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
-    response_body = json.loads(response['body'].read())
+    def invoke(cancel=None):
+        response = getBedrockClient().invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
+        return json.loads(response['body'].read())
+
+    response_body = invokeWithRetry(invoke, retry=0)
     embedding = response_body['embedding']
     return embedding
 
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import boto3
+from collections import OrderedDict
+from decimal import Decimal
+
+
+#  ██████  █████   ██████ ██   ██ ███████
+# ██      ██   ██ ██      ██   ██ ██
+# ██      ███████ ██      ███████ █████
+# ██      ██   ██ ██      ██   ██ ██
+#  ██████ ██   ██  ██████ ██   ██ ███████
+
+# Content-addressed cache of Bedrock completions, keyed by a hash of the model id, messages and sampling
+# parameters.  Opt-in through BEDROCK_CACHE_BACKEND (NONE, MEMORY, DISK, DYNAMODB or S3).
+
+BACKEND_NONE = "NONE"
+BACKEND_MEMORY = "MEMORY"
+BACKEND_DISK = "DISK"
+BACKEND_DYNAMODB = "DYNAMODB"
+BACKEND_S3 = "S3"
+
+CACHE_VERSION = 1 # bump to invalidate all cached completions
+
+BEDROCK_CACHE_TTL_SECONDS = int(os.environ.get("BEDROCK_CACHE_TTL_SECONDS", str(7 * 86400)))
+BEDROCK_CACHE_MAX_ENTRIES = int(os.environ.get("BEDROCK_CACHE_MAX_ENTRIES", "256")) # memory backend
+BEDROCK_CACHE_MAX_BYTES = int(os.environ.get("BEDROCK_CACHE_MAX_BYTES", str(256 * 1024 * 1024))) # disk backend
+BEDROCK_CACHE_DIR = os.environ.get("BEDROCK_CACHE_DIR", "/tmp/bedrock-cache")
+BEDROCK_CACHE_S3_PREFIX = "bedrock-cache/"
+DYNAMODB_MAX_VALUE_BYTES = 350 * 1024 # larger completions spill to S3 (DynamoDB items are limited to 400 KB)
+
+def cacheKey(modelId, messages, **params):
+    payload = json.dumps({
+        "version": CACHE_VERSION,
+        "model": modelId,
+        "messages": messages,
+        "params": params
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def newEntry(value, latency):
+    return {"value": value, "latency": latency, "expires_at": time.time() + BEDROCK_CACHE_TTL_SECONDS}
+
+def isExpired(entry):
+    return entry is None or float(entry["expires_at"]) < time.time()
+
+class MemoryCache:
+    """LRU bounded by number of entries, per container"""
+    def __init__(self, max_entries=BEDROCK_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if isExpired(entry):
+                self.entries.pop(key, None)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class DiskCache:
+    """One JSON file per entry on local disk (e.g. Lambda /tmp), evicting least recently used files past max_bytes"""
+    def __init__(self, directory=BEDROCK_CACHE_DIR, max_bytes=BEDROCK_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if isExpired(entry):
+            self.delete(key)
+            return None
+        os.utime(self.path(key)) # mark as recently used
+        return entry
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def put(self, key, entry):
+        with self.lock:
+            temp_path = self.path(key) + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, self.path(key))
+            self.evict()
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self.delete(name[:-len(".json")])
+            total -= size
+
+class S3Cache:
+    """One object per entry; expiry is checked on read, and a bucket lifecycle rule can bound storage"""
+    def __init__(self, bucket, prefix=BEDROCK_CACHE_S3_PREFIX):
+        self.s3 = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key + ".json")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        entry = json.loads(response['Body'].read())
+        return None if isExpired(entry) else entry
+
+    def put(self, key, entry):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key + ".json", Body=json.dumps(entry))
+
+class DynamoDBCache:
+    """One item per entry, expired by DynamoDB TTL on ttl_timestamp; completions too large for an item spill to S3"""
+    def __init__(self, table_name, s3_bucket=None):
+        self.table = boto3.resource('dynamodb').Table(table_name)
+        self.spill = S3Cache(s3_bucket) if s3_bucket else None
+
+    def get(self, key):
+        item = self.table.get_item(Key={'id': key}).get('Item')
+        if item is None:
+            return None
+        if "s3_key" in item:
+            return self.spill.get(key) if self.spill else None
+        entry = {"value": item["value"], "latency": float(item["latency"]), "expires_at": float(item["ttl_timestamp"])}
+        return None if isExpired(entry) else entry
+
+    def put(self, key, entry):
+        item = {
+            'id': key,
+            'latency': Decimal(str(round(entry["latency"], 3))),
+            'ttl_timestamp': int(entry["expires_at"])
+        }
+        if len(entry["value"].encode('utf-8')) > DYNAMODB_MAX_VALUE_BYTES:
+            if self.spill is None:
+                print(f"Bedrock completion of {len(entry['value'])} characters not cached: set BEDROCK_CACHE_S3_BUCKET for large completions")
+                return
+            self.spill.put(key, entry)
+            item['s3_key'] = self.spill.prefix + key + ".json"
+        else:
+            item['value'] = entry["value"]
+        self.table.put_item(Item=item)
+
+class BedrockCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "errors": 0, "latency_saved_seconds": 0.0}
+
+    def add(self, key, value=1):
+        with self.lock:
+            self.metrics[key] += value
+
+    def get(self, key):
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f"Bedrock cache read error: {str(e)}")
+            self.add("errors")
+            return None
+        if entry is None:
+            self.add("misses")
+            return None
+        self.add("hits")
+        self.add("latency_saved_seconds", float(entry["latency"]))
+        return entry["value"]
+
+    def put(self, key, value, latency):
+        try:
+            self.backend.put(key, newEntry(value, latency))
+        except Exception as e:
+            print(f"Bedrock cache write error: {str(e)}")
+            self.add("errors")
+
+    def report(self):
+        with self.lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            hit_rate = self.metrics["hits"] / lookups if lookups > 0 else 0
+            print(f"Bedrock cache metrics: backend={type(self.backend).__name__}, hit_rate={round(hit_rate, 3)}, " + ", ".join(
+                f"{key}={round(value, 3) if isinstance(value, float) else value}" for key, value in self.metrics.items()
+            ))
+
+def createBedrockCache():
+    backend = os.environ.get("BEDROCK_CACHE_BACKEND", BACKEND_NONE).upper()
+    if backend == BACKEND_MEMORY:
+        return BedrockCache(MemoryCache())
+    elif backend == BACKEND_DISK:
+        return BedrockCache(DiskCache())
+    elif backend == BACKEND_DYNAMODB and os.environ.get("DDBTBL_BEDROCK_CACHE"):
+        return BedrockCache(DynamoDBCache(os.environ["DDBTBL_BEDROCK_CACHE"], os.environ.get("BEDROCK_CACHE_S3_BUCKET")))
+    elif backend == BACKEND_S3 and os.environ.get("BEDROCK_CACHE_S3_BUCKET"):
+        return BedrockCache(S3Cache(os.environ["BEDROCK_CACHE_S3_BUCKET"]))
+    return None
+
+bedrock_cache = createBedrockCache()
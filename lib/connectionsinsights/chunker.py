@@ -0,0 +1,205 @@
+import os
+import re
+import uuid
+import zlib
+
+
+#  ██████ ██   ██ ██    ██ ███    ██ ██   ██ ███████ ██████
+# ██      ██   ██ ██    ██ ████   ██ ██  ██  ██      ██   ██
+# ██      ███████ ██    ██ ██ ██  ██ █████   █████   ██████
+# ██      ██   ██ ██    ██ ██  ██ ██ ██  ██  ██      ██   ██
+#  ██████ ██   ██  ██████  ██   ████ ██   ██ ███████ ██   ██
+
+# Splits the pages of a document into chunks for entity extraction.  The TOKEN chunker packs paragraphs
+# (Textract layout blocks, or lines from pypdf) up to a target token count, splitting dense pages at paragraph
+# and sentence boundaries, with an optional overlap.  LEGACY keeps the original whole-page, space-counting split.
+# Past 3/4 of the target, TOKEN chunks also end after any paragraph whose hash is a multiple of
+# CHUNK_BOUNDARY_MODULUS, so chunk boundaries depend on the local text rather than on everything before it: an
+# amended document re-chunks into the same chunks away from its changes, and their cached results are reused.
+
+CHUNKER_TOKEN = "TOKEN"
+CHUNKER_LEGACY = "LEGACY"
+
+CHUNKER = os.environ.get("CHUNKER", CHUNKER_TOKEN).upper()
+# ~1,500 tokens of document next to the ~1,000 token extraction prompt keeps each request small enough for the
+# extracted JSON to fit in one completion, while using far fewer requests than 500-word chunks
+CHUNK_TARGET_TOKENS = int(os.environ.get("CHUNK_TARGET_TOKENS", "1500"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "0"))
+CHUNK_BOUNDARY_MODULUS = int(os.environ.get("CHUNK_BOUNDARY_MODULUS", "8")) # 0 packs every chunk to the target
+LEGACY_MAX_WORDS_PER_CHUNK = 500
+
+# multi-word capitalised names and acronyms: companies, people, products
+NAME_PATTERN = re.compile(r"\b[A-Z][\w&.'-]*(?:\s+(?:of\s+|and\s+|&\s+)?[A-Z][\w&.'-]*)+|\b[A-Z]{2,}\b")
+NUMBER_PATTERN = re.compile(r"^[(\-$€£]*[\d.,]+%?\)?$")
+
+_TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|_")
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;:])\s+")
+
+def estimateTokens(text):
+    """
+    Estimate the number of model tokens in text without a tokenizer: common words are one token, long words
+    one per ~8 characters, numbers one per 3 digits, punctuation one each and non-Latin script one per character.
+    benchmarks/chunker_benchmark.py --measure compares it with the input tokens counted by Bedrock.
+    """
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        if piece.isdigit():
+            tokens += (len(piece) + 2) // 3
+        elif not piece.isascii():
+            tokens += len(piece)
+        elif piece[0].isalpha():
+            tokens += 1 + (len(piece) - 1) // 8
+        else:
+            tokens += 1
+    return tokens
+
+def cleanText(text):
+    text = text.replace("\xa0", " ") # replace special characters with spaces
+    text = text.replace("\"", "") # remove " character
+    return re.sub(r"[ \t]+", " ", text).strip() # remove any extra spaces
+
+def splitParagraphs(pageText):
+    # Textract layout blocks (and pypdf lines) are separated by new lines
+    return [paragraph for paragraph in (cleanText(line) for line in (pageText or "").split("\n")) if paragraph]
+
+def splitLongText(text, maxTokens):
+    """Split text over maxTokens at sentence boundaries, and sentences still over maxTokens between words"""
+    if estimateTokens(text) <= maxTokens:
+        return [text]
+    pieces = []
+    for sentence in _SENTENCE_BOUNDARY.split(text):
+        if estimateTokens(sentence) <= maxTokens:
+            pieces.append(sentence)
+            continue
+        words = sentence.split(" ")
+        current = []
+        for word in words:
+            if current and estimateTokens(" ".join(current + [word])) > maxTokens:
+                pieces.append(" ".join(current))
+                current = []
+            current.append(word)
+        if current:
+            pieces.append(" ".join(current))
+
+    # pack the sentences back together up to maxTokens
+    packed = []
+    for piece in pieces:
+        if packed and estimateTokens(packed[-1] + " " + piece) <= maxTokens:
+            packed[-1] += " " + piece
+        else:
+            packed.append(piece)
+    return packed
+
+def isContentBoundary(text, modulus):
+    return modulus > 0 and zlib.crc32(text.encode('utf-8')) % modulus == 0
+
+def newChunk(units):
+    return {
+        'id': str(uuid.uuid4()),
+        'startPage': units[0]["page"],
+        'endPage': units[-1]["page"],
+        'text': "\n".join(unit["text"] for unit in units) + "\n",
+        'tokens': sum(unit["tokens"] for unit in units)
+    }
+
+def splitDocumentByTokens(arr_text, targetTokens=CHUNK_TARGET_TOKENS, overlapTokens=CHUNK_OVERLAP_TOKENS, boundaryModulus=CHUNK_BOUNDARY_MODULUS):
+    units = []
+    numPages = 0
+    for page, pageText in enumerate(arr_text, start=1): # may be a generator streaming pages
+        numPages = page
+        for paragraph in splitParagraphs(pageText):
+            for text in splitLongText(paragraph, targetTokens):
+                units.append({"page": page, "text": text, "tokens": estimateTokens(text)})
+
+    chunks = []
+    current = []
+    overlapped = 0 # leading units of current repeated from the previous chunk
+    tokens = 0
+    for unit in units:
+        contentBoundary = len(current) > overlapped and tokens >= targetTokens * 3 // 4 and isContentBoundary(current[-1]["text"], boundaryModulus)
+        if current and (tokens + unit["tokens"] > targetTokens or contentBoundary):
+            chunks.append(newChunk(current))
+            # repeat the trailing paragraphs of the previous chunk, up to overlapTokens
+            overlap = []
+            for previous in reversed(current):
+                if sum(item["tokens"] for item in overlap) + previous["tokens"] > overlapTokens:
+                    break
+                overlap.insert(0, previous)
+            while overlap and sum(item["tokens"] for item in overlap) + unit["tokens"] > targetTokens:
+                overlap.pop(0)
+            current = overlap
+            overlapped = len(overlap)
+            tokens = sum(item["tokens"] for item in current)
+        current.append(unit)
+        tokens += unit["tokens"]
+    if current:
+        chunks.append(newChunk(current))
+    elif numPages > 0:
+        chunks.append(newChunk([{"page": 1, "text": "", "tokens": 0}, {"page": numPages, "text": "", "tokens": 0}]))
+    return chunks
+
+def splitDocumentLegacy(arr_text):
+    maxTokensPerChunk = LEGACY_MAX_WORDS_PER_CHUNK # estimate 1 space = 1 word = 1 token
+
+    # get number of pages
+    numPages = len(arr_text)
+
+    text = ""
+    tokenCount = 0
+    currentPage = 1
+    startPage = 1
+    chunks = []
+
+    # loop through each page and get text
+    for pageText in arr_text:
+        pageText = pageText.replace("\xa0", " ") # replace special characters with spaces
+        pageText = pageText.replace("\n", " ") # replace new line characters with spaces
+        pageText = pageText.replace("  ", " ") # remove any extra spaces
+        pageText = pageText.replace("\"", "") # remove " character
+        pageToken = pageText.count(" ")
+        if tokenCount + pageToken <= maxTokensPerChunk:
+            text += pageText + "\n"
+            tokenCount += pageToken
+        else:
+            chunks.append(
+                {
+                    'id': str(uuid.uuid4()),
+                    'startPage': startPage,
+                    'endPage': currentPage-1,
+                    'text': text,
+                    'tokens': estimateTokens(text)
+                }
+            )
+            startPage = currentPage
+            text = pageText + "\n"
+            tokenCount = pageToken
+
+        if currentPage == numPages:
+            chunks.append(
+                {
+                    'id': str(uuid.uuid4()),
+                    'startPage': startPage,
+                    'endPage': currentPage,
+                    'text': text,
+                    'tokens': estimateTokens(text)
+                }
+            )
+            break
+        currentPage += 1
+
+    return chunks
+
+def splitDocument(arr_text, chunker=None):
+    """Split the text of each page into chunks of {id, startPage, endPage, text, tokens}"""
+    if (chunker or CHUNKER) == CHUNKER_LEGACY:
+        return splitDocumentLegacy(list(arr_text))
+    return splitDocumentByTokens(arr_text)
+
+def countChunksWithinTokens(chunks, maxTokens):
+    """Number of leading chunks whose combined text fits in maxTokens (at least 1)"""
+    total = 0
+    for index, chunk in enumerate(chunks):
+        total += chunk["tokens"]
+        if total > maxTokens:
+            return max(1, index)
+    return len(chunks)
@@ -8,6 +8,22 @@ import boto3
 # ██   ██    ██    ██  ██ ██ ██   ██ ██  ██  ██ ██    ██ ██   ██ ██   ██ 
 # ██████     ██    ██   ████ ██   ██ ██      ██  ██████  ██████  ██████  
 
+BATCH_GET_MAX_KEYS = 100 # BatchGetItem limit per request
+
+# Helper function to read many items by key with BatchGetItem, 100 keys per request, retrying unprocessed keys
+def batchGetItems(table_name, keys, projection=None):
+    dynamodb = boto3.resource('dynamodb')
+    items = []
+    for index in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request = {table_name: {'Keys': keys[index:index + BATCH_GET_MAX_KEYS]}}
+        if projection:
+            request[table_name]['ProjectionExpression'] = projection
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request = response.get('UnprocessedKeys') or None
+    return items
+
 # Helper function to retrieve the value of N from DynamoDB
 def getN():
     dynamodb = boto3.resource('dynamodb')
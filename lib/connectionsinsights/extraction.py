@@ -0,0 +1,340 @@
+import os
+import re
+import json
+import gzip
+import time
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import hashlib
+import tempfile
+import boto3
+import pypdf
+
+from connectionsinsights.textract import (
+    start_document_analysis,
+    start_async_analysis,
+    complete_task,
+    iter_pages
+)
+
+
+# ███████ ██   ██ ████████ ██████   █████   ██████ ████████ ██  ██████  ███    ██
+# ██       ██ ██     ██    ██   ██ ██   ██ ██         ██    ██ ██    ██ ████   ██
+# █████     ███      ██    ██████  ███████ ██         ██    ██ ██    ██ ██ ██  ██
+# ██       ██ ██     ██    ██   ██ ██   ██ ██         ██    ██ ██    ██ ██  ██ ██
+# ███████ ██   ██    ██    ██   ██ ██   ██  ██████    ██    ██  ██████  ██   ████
+
+# Hybrid text extraction: a fast pass over the PDF text layer with pypdf, scoring the text of each page, and
+# Amazon Textract only for the pages whose text layer is missing or unusable (e.g. scanned pages).  Those pages
+# are copied into a smaller PDF under TEXTRACT_INPUT_PREFIX (ignored by the ingestion trigger) for Textract.
+
+PAGE_QUALITY_THRESHOLD = float(os.environ.get("PAGE_QUALITY_THRESHOLD", "0.5"))
+MIN_PAGE_CHARACTERS = 100 # pages with less text score proportionally lower
+TEXTRACT_SECONDS_PER_PAGE = float(os.environ.get("TEXTRACT_SECONDS_PER_PAGE", "0.5")) # for the savings report
+TEXTRACT_INPUT_PREFIX = "textract_input/"
+
+# Page-parallel pypdf extraction: worker processes each read a contiguous page range from the memory-mapped PDF.
+# Lambda has no /dev/shm, so workers are plain processes with pipes rather than a multiprocessing Pool.
+PYPDF_WORKERS = int(os.environ.get("PYPDF_WORKERS", str(os.cpu_count() or 1)))
+PYPDF_MIN_PAGES_PER_WORKER = 8
+
+# Extracted page text is normalized (see normalizePageText) and cached in S3 by document content hash and
+# extractor version (gzipped JSON), so retried executions and re-ingested documents skip OCR.  Bump an
+# extractor's version when its output, or the normalization, changes.
+EXTRACTION_CACHE = os.environ.get("EXTRACTION_CACHE", "true").lower() == "true"
+EXTRACTION_CACHE_PREFIX = "extraction_cache/"
+EXTRACTOR_VERSIONS = {"TEXTRACT": 3, "PYPDF": 3, "HYBRID": 3}
+
+s3_client = boto3.client('s3')
+
+_WORD = re.compile(r"^[(\[\"']?(?:[^\W\d_]{1,25}|[\d.,%$€£]+)(?:[-'][^\W\d_]+)*[)\]\"'.,;:!?%]*$")
+
+def pageQuality(text):
+    """
+    Score (0 to 1) of how usable the text layer of a page is: how much text there is, the fraction of
+    whitespace-separated tokens that look like words or numbers, and the absence of unmapped glyphs.
+    """
+    text = (text or "").strip()
+    if not text:
+        return 0.0
+    tokens = text.split()
+    word_ratio = sum(1 for token in tokens if _WORD.match(token)) / len(tokens)
+    garbage = text.count("\ufffd") + 5 * text.count("(cid:") + sum(1 for c in text if ord(c) < 32 and c not in "\n\t\r")
+    garbage_penalty = max(0.0, 1 - 10 * garbage / len(text))
+    return min(1.0, len(text) / MIN_PAGE_CHARACTERS) * word_ratio * garbage_penalty
+
+# a hyphen at a line break may belong to the word ("well-known", "Coca-Cola"), so only the line break is dropped;
+# soft hyphens only mark where a word was broken and are removed
+_HYPHENATED_LINE_BREAK = re.compile(r"(?<=[^\W\d_])(-|\u00ad)[ \t]*\n[ \t]*(?=[^\W\d_])")
+_SPACES = re.compile(r"[ \t\xa0\u2007\u202f]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+def normalizePageText(text):
+    """
+    Page text as returned by every extractor (and cached): line breaks as \n (form feeds and carriage returns
+    included), words hyphenated across a line break joined (keeping the hyphen, except for soft hyphens), runs
+    of spaces and tabs collapsed, lines trimmed and at most one blank line in a row
+    """
+    text = (text or "").replace("\r\n", "\n").replace("\r", "\n").replace("\f", "\n").replace("\v", "\n")
+    text = _HYPHENATED_LINE_BREAK.sub(lambda match: "-" if match.group(1) == "-" else "", text).replace("\u00ad", "")
+    text = "\n".join(_SPACES.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+def extractionCacheKey(content_hash, extractor):
+    return f"{EXTRACTION_CACHE_PREFIX}{content_hash}/{extractor.lower()}-v{EXTRACTOR_VERSIONS.get(extractor, 1)}.json.gz"
+
+def getCachedPages(s3_bucket, content_hash, extractor):
+    """Cached page texts of a document, or None"""
+    if not EXTRACTION_CACHE or not content_hash:
+        return None
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=extractionCacheKey(content_hash, extractor))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"Extraction cache read error: {str(e)}")
+        return None
+    return json.loads(gzip.decompress(response['Body'].read()))["pages"]
+
+def hasCachedPages(s3_bucket, content_hash, extractor):
+    """Whether the page texts of a document are cached, without downloading them"""
+    if not EXTRACTION_CACHE or not content_hash:
+        return False
+    try:
+        s3_client.head_object(Bucket=s3_bucket, Key=extractionCacheKey(content_hash, extractor))
+        return True
+    except s3_client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            print(f"Extraction cache read error: {str(e)}")
+        return False
+
+def putCachedPages(s3_bucket, content_hash, extractor, pages):
+    if not EXTRACTION_CACHE or not content_hash:
+        return
+    body = gzip.compress(json.dumps({"pages": pages}, separators=(',', ':')).encode('utf-8'))
+    try:
+        s3_client.put_object(Bucket=s3_bucket, Key=extractionCacheKey(content_hash, extractor), Body=body, ContentType="application/gzip")
+    except Exception as e:
+        print(f"Extraction cache write error: {str(e)}")
+
+def withExtractionCache(s3_bucket, content_hash, extractor, extract):
+    """
+    Page texts from the cache, or from extract() (a list or a generator, passed through as it streams),
+    caching them once every page has been read
+    """
+    pages = getCachedPages(s3_bucket, content_hash, extractor)
+    if pages is not None:
+        print(f"Extraction cache hit for {content_hash} ({extractor}, {len(pages)} pages)")
+        return pages
+    pages = extract()
+    if pages is None:
+        return None
+
+    def cacheAsRead():
+        read = []
+        for page in pages:
+            page = normalizePageText(page)
+            read.append(page)
+            yield page
+        putCachedPages(s3_bucket, content_hash, extractor, read)
+    return cacheAsRead()
+
+def openMappedPDF(local_file_path):
+    with open(local_file_path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped, pypdf.PdfReader(mapped)
+
+def extractPageRange(local_file_path, start, end, connection):
+    # runs in a worker process
+    try:
+        mapped, reader = openMappedPDF(local_file_path)
+        for index in range(start, end):
+            connection.send((index, reader.pages[index].extract_text() or "", None))
+        mapped.close()
+    except Exception as e:
+        connection.send((None, None, f"pages {start}-{end}: {str(e)}"))
+    finally:
+        connection.close()
+
+def iterPDFPages(local_file_path, workers=None, reader=None):
+    """
+    Yields the text of each page of a local PDF, in page order, extracting page ranges in parallel worker
+    processes (PYPDF_WORKERS) and yielding each page as soon as all the pages before it are done.  Pass the
+    reader of the file when the caller already parsed it.
+    """
+    workers = workers or PYPDF_WORKERS
+    mapped = None
+    if reader is None:
+        mapped, reader = openMappedPDF(local_file_path)
+    try:
+        num_pages = len(reader.pages)
+        workers = max(1, min(workers, num_pages // PYPDF_MIN_PAGES_PER_WORKER))
+        if workers == 1:
+            for page in reader.pages:
+                yield page.extract_text() or ""
+            return
+    finally:
+        if mapped is not None:
+            mapped.close()
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+    connections = []
+    for worker in range(workers):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=extractPageRange,
+            args=(local_file_path, num_pages * worker // workers, num_pages * (worker + 1) // workers, sender)
+        )
+        process.start()
+        sender.close() # the worker holds the only sending end, so its pipe reports EOF when it exits
+        processes.append(process)
+        connections.append(receiver)
+
+    try:
+        pending = {}
+        next_index = 0
+        open_connections = list(connections)
+        while open_connections:
+            for connection in multiprocessing.connection.wait(open_connections):
+                try:
+                    index, text, error = connection.recv()
+                except EOFError:
+                    open_connections.remove(connection)
+                    continue
+                if error is not None:
+                    raise Exception(f"PDF text extraction failed for {error}")
+                pending[index] = text
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+        if next_index != num_pages:
+            raise Exception(f"PDF text extraction returned {next_index} of {num_pages} pages")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for connection in connections:
+            connection.close()
+
+def textLayerPass(local_file_path):
+    # one parse of the file: its reader counts the pages, extracts them when there is a single worker and is
+    # kept (with its memory map) to copy the low-quality pages into the Textract input
+    _, reader = openMappedPDF(local_file_path)
+    pages = list(iterPDFPages(local_file_path, reader=reader))
+    low_quality = [index for index, text in enumerate(pages) if pageQuality(text) < PAGE_QUALITY_THRESHOLD]
+    return reader, pages, low_quality
+
+def textractInputKey(s3_key):
+    return TEXTRACT_INPUT_PREFIX + hashlib.sha256(s3_key.encode('utf-8')).hexdigest()[:32] + ".pdf"
+
+def textLayerKey(s3_key):
+    # the START_EXTRACTION text layer, next to the Textract input (both ignored by the ingestion trigger)
+    return textractInputKey(s3_key)[:-len(".pdf")] + "-text-layer.json.gz"
+
+def putTextLayer(s3_bucket, s3_key, pages, low_quality):
+    body = gzip.compress(json.dumps({"pages": pages, "low_quality": low_quality}, separators=(',', ':')).encode('utf-8'))
+    s3_client.put_object(Bucket=s3_bucket, Key=textLayerKey(s3_key), Body=body, ContentType="application/gzip")
+
+def getTextLayer(s3_bucket, s3_key):
+    """(pages, low_quality) saved by startHybridExtraction, or None"""
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=textLayerKey(s3_key))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    entry = json.loads(gzip.decompress(response['Body'].read()))
+    return entry["pages"], entry["low_quality"]
+
+def uploadTextractInput(reader, page_indexes, s3_bucket, s3_key):
+    """Upload a PDF of only the given pages for Textract; returns its key"""
+    writer = pypdf.PdfWriter()
+    for index in page_indexes:
+        writer.add_page(reader.pages[index])
+    local_file_path = os.path.join(tempfile.gettempdir(), "textract-input.pdf")
+    with open(local_file_path, "wb") as f:
+        writer.write(f)
+    key = textractInputKey(s3_key)
+    s3_client.upload_file(local_file_path, s3_bucket, key)
+    os.remove(local_file_path)
+    return key
+
+def downloadDocument(s3_bucket, s3_key):
+    local_file_path = os.path.join(tempfile.gettempdir(), s3_key.split("/")[-1])
+    s3_client.download_file(s3_bucket, s3_key, local_file_path)
+    return local_file_path
+
+def startHybridExtraction(s3_bucket, s3_key, task_token):
+    """
+    START_EXTRACTION phase: starts an asynchronous Textract job for the low-quality pages only, or completes
+    the task straight away when the text layer of every page is usable
+    """
+    local_file_path = downloadDocument(s3_bucket, s3_key)
+    try:
+        reader, pages, low_quality = textLayerPass(local_file_path)
+        # the chunk phase reuses these pages, and maps the Textract pages back through this low_quality list
+        putTextLayer(s3_bucket, s3_key, pages, low_quality)
+        if not low_quality:
+            complete_task(task_token, {"Status": "SKIPPED"})
+            return {"Status": "SKIPPED"}
+        key = uploadTextractInput(reader, low_quality, s3_bucket, s3_key)
+        return start_async_analysis(s3_bucket, key, task_token)
+    finally:
+        os.remove(local_file_path)
+
+def extractHybrid(s3_bucket, s3_key, extraction=None):
+    """
+    Text of each page: the pypdf text layer, replaced by Textract for low-quality pages.  With `extraction`
+    (the output of the task completed for startHybridExtraction) the finished job is read, otherwise the
+    low-quality pages are submitted to Textract and polled here.
+    """
+    start_time = time.time()
+    text_layer = getTextLayer(s3_bucket, s3_key) if extraction else None
+    local_file_path = None
+    if text_layer is not None:
+        pages, low_quality = text_layer
+    else:
+        # no START_EXTRACTION phase (or its text layer is gone): read the text layer here
+        local_file_path = downloadDocument(s3_bucket, s3_key)
+    try:
+        if local_file_path is not None:
+            reader, pages, low_quality = textLayerPass(local_file_path)
+        text_layer_seconds = time.time() - start_time
+        textract_seconds = 0.0
+        if low_quality:
+            textract_start_time = time.time()
+            key = textractInputKey(s3_key)
+            try:
+                if extraction and extraction.get("JobId"):
+                    if extraction["Status"] not in ['SUCCEEDED', 'PARTIAL_SUCCESS']:
+                        raise Exception(f"Textract job {extraction['JobId']} {extraction['Status']}")
+                    if text_layer is None:
+                        raise Exception(f"Text layer of {s3_key} not found; the Textract pages cannot be mapped back")
+                    output_id = extraction["OutputId"]
+                else:
+                    uploadTextractInput(reader, low_quality, s3_bucket, s3_key)
+                    status, output_id = start_document_analysis(s3_bucket, key)
+                    if status != "SUCCEEDED":
+                        raise Exception(f"Textract job for {key} {status}")
+                # pages of the Textract input are numbered from 1, in the order of low_quality
+                for page, text in iter_pages(output_id, s3_bucket):
+                    pages[low_quality[page - 1]] = text
+            finally:
+                s3_client.delete_object(Bucket=s3_bucket, Key=key)
+            textract_seconds = time.time() - textract_start_time
+        if text_layer is not None:
+            s3_client.delete_object(Bucket=s3_bucket, Key=textLayerKey(s3_key))
+    finally:
+        if local_file_path is not None:
+            os.remove(local_file_path)
+
+    pages_saved = len(pages) - len(low_quality)
+    polled = low_quality and not (extraction and extraction.get("JobId"))
+    seconds_per_page = textract_seconds / len(low_quality) if polled else TEXTRACT_SECONDS_PER_PAGE
+    print(
+        f"Hybrid extraction of {s3_key}: {len(pages)} pages, {len(low_quality)} sent to Textract, "
+        f"{pages_saved} pages saved (~{round(pages_saved * seconds_per_page, 1)}s of Textract time); "
+        f"text layer {round(text_layer_seconds, 1)}s, Textract {round(textract_seconds, 1)}s"
+    )
+    return pages
@@ -1,6 +1,9 @@
 import os
 import random
 import time
+import asyncio
+import concurrent.futures
+import aiohttp
 
 from gremlin_python import statics
 from gremlin_python.process.anonymous_traversal import traversal
@@ -69,6 +72,127 @@ def GraphConnect(retry=3):
             raise e
             
 
+# Connection reused across warm Lambda invocations.  The SigV4 signature is only checked on the websocket
+# upgrade, so a live connection stays valid; it is re-signed once it reaches NEPTUNE_CONNECTION_MAX_AGE and
+# probed with a trivial traversal after NEPTUNE_IDLE_PROBE_SECONDS of inactivity to detect dead sockets.
+NEPTUNE_CONNECTION_MAX_AGE = int(os.environ.get("NEPTUNE_CONNECTION_MAX_AGE", "3000")) # seconds
+NEPTUNE_IDLE_PROBE_SECONDS = int(os.environ.get("NEPTUNE_IDLE_PROBE_SECONDS", "60"))
+
+# errors of the websocket transport; Gremlin query errors (GremlinServerError) are never retried on a new connection
+CONNECTION_ERROR_TYPES = (ConnectionError, OSError, TimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError, aiohttp.ClientError)
+# gremlin_python's aiohttp transport raises a bare RuntimeError with these messages
+CONNECTION_CLOSED_MESSAGES = ["Connection was already closed.", "Connection was closed by server."]
+
+def isConnectionError(e):
+    if isinstance(e, CONNECTION_ERROR_TYPES):
+        return True
+    return type(e) is RuntimeError and str(e).strip() in CONNECTION_CLOSED_MESSAGES
+
+class GraphConnectionManager:
+    def __init__(self, max_age=NEPTUNE_CONNECTION_MAX_AGE, idle_probe_seconds=NEPTUNE_IDLE_PROBE_SECONDS):
+        self.max_age = max_age
+        self.idle_probe_seconds = idle_probe_seconds
+        self.g = None
+        self.connection = None
+        self.connected_at = 0
+        self.last_used = 0
+        self.resetMetrics()
+
+    def resetMetrics(self):
+        self.metrics = {
+            "connects": 0,
+            "reuses": 0,
+            "reconnects": 0,
+            "connect_seconds": 0.0,
+            "queries": 0,
+            "query_retries": 0,
+            "query_seconds": 0.0
+        }
+
+    def connect(self):
+        start = time.time()
+        self.g, self.connection = GraphConnect()
+        self.connected_at = time.time()
+        self.last_used = self.connected_at
+        self.metrics["connects"] += 1
+        self.metrics["connect_seconds"] += self.connected_at - start
+
+    def invalidate(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception as e:
+                print(f"Error closing graph connection: {str(e)}")
+        self.g = None
+        self.connection = None
+
+    def isHealthy(self):
+        try:
+            return self.g.inject(1).next() == 1
+        except Exception as e:
+            print(f"Graph connection health check failed: {str(e)}")
+            return False
+
+    def getGraph(self):
+        now = time.time()
+        if self.g is not None and now - self.connected_at > self.max_age:
+            print("Graph connection reached max age, re-signing")
+            self.invalidate()
+            self.metrics["reconnects"] += 1
+        elif self.g is not None and now - self.last_used > self.idle_probe_seconds and not self.isHealthy():
+            self.invalidate()
+            self.metrics["reconnects"] += 1
+
+        if self.g is None:
+            self.connect()
+        else:
+            self.metrics["reuses"] += 1
+        self.last_used = time.time()
+        return self.g
+
+    def run(self, query, retry=1):
+        """Run query(g) on the shared connection, reconnecting once if the connection turns out to be dead"""
+        self.metrics["queries"] += 1
+        while True:
+            g = self.getGraph()
+            start = time.time()
+            try:
+                return query(g)
+            except Exception as e:
+                if retry > 0 and isConnectionError(e):
+                    print(f"Graph query failed on a dead connection, reconnecting: {str(e)}")
+                    self.invalidate()
+                    self.metrics["reconnects"] += 1
+                    self.metrics["query_retries"] += 1
+                    retry -= 1
+                    continue
+                raise e
+            finally:
+                self.metrics["query_seconds"] += time.time() - start
+                self.last_used = time.time()
+
+    def reportMetrics(self):
+        """Print the metrics since the last report (one invocation) and start counting again"""
+        print("Graph connection metrics: " + ", ".join(
+            f"{key}={round(value, 3) if isinstance(value, float) else value}" for key, value in self.metrics.items()
+        ))
+        self.resetMetrics()
+
+graph_connection_manager = GraphConnectionManager()
+
+def getGraph():
+    return graph_connection_manager.getGraph()
+
+def runGraphQuery(query):
+    return graph_connection_manager.run(query)
+
+def invalidateGraph():
+    graph_connection_manager.invalidate()
+
+def reportGraphMetrics():
+    graph_connection_manager.reportMetrics()
+
+
 def getEntities(g):
     results = g.V().elementMap().toList()
     entities = [{ "ID": row[T.id], "LABEL": row[T.label], "NAME": row["NAME"], "INTERESTED": row["INTERESTED"] if "INTERESTED" in row else "NO" } for row in results]
@@ -0,0 +1,109 @@
+import os
+import re
+
+from connectionsinsights.bedrock import (
+    generateEmbeddings,
+    cosine_similarity,
+    CLAUDE_HAIKU_4_5
+)
+from connectionsinsights.chunker import (
+    estimateTokens,
+    NAME_PATTERN,
+    NUMBER_PATTERN
+)
+
+
+# ██████  ██████  ███████ ███████  ██████ ██████  ███████ ███████ ███    ██
+# ██   ██ ██   ██ ██      ██      ██      ██   ██ ██      ██      ████   ██
+# ██████  ██████  █████   ███████ ██      ██████  █████   █████   ██ ██  ██
+# ██      ██   ██ ██           ██ ██      ██   ██ ██      ██      ██  ██ ██
+# ██      ██   ██ ███████ ███████  ██████ ██   ██ ███████ ███████ ██   ████
+
+# Cheap relevance pre-screen of chunks before the entity extraction prompt.  Financial tables, legal
+# boilerplate and exhibit indexes rarely name customers, suppliers, partners, competitors or directors, so
+# chunks with no relationship keywords, few names or mostly numbers are skipped (PRESCREEN_ACTION=SKIP) or
+# extracted with a smaller model (SMALL_MODEL).  With PRESCREEN=EMBEDDING, chunks failing the heuristics are
+# kept when their embedding is similar to a prototype of one of the extracted categories.
+
+PRESCREEN_OFF = "OFF"
+PRESCREEN_HEURISTIC = "HEURISTIC"
+PRESCREEN_EMBEDDING = "EMBEDDING"
+ACTION_SKIP = "SKIP"
+ACTION_SMALL_MODEL = "SMALL_MODEL"
+
+PRESCREEN = os.environ.get("PRESCREEN", PRESCREEN_OFF).upper()
+PRESCREEN_ACTION = os.environ.get("PRESCREEN_ACTION", ACTION_SKIP).upper()
+PRESCREEN_THRESHOLD = float(os.environ.get("PRESCREEN_THRESHOLD", "0.25"))
+PRESCREEN_SIMILARITY_THRESHOLD = float(os.environ.get("PRESCREEN_SIMILARITY_THRESHOLD", "0.45"))
+PRESCREEN_SMALL_MODEL = os.environ.get("PRESCREEN_SMALL_MODEL", CLAUDE_HAIKU_4_5)
+# each boilerplate marker removes this share of the score: legal text mentioning the Board or Directors has
+# plenty of keywords and names, but several markers (4 with the default) screen it out
+BOILERPLATE_PENALTY = float(os.environ.get("PRESCREEN_BOILERPLATE_PENALTY", "0.25"))
+
+RELATIONSHIP_KEYWORDS = re.compile(r"\b(?:" + "|".join([
+    r"customers?", r"clients?", r"purchasers?", r"distributors?", r"resellers?",
+    r"suppliers?", r"vendors?", r"partners?(?:hips?)?", r"alliances?", r"joint ventures?", r"collaborat\w+",
+    r"licens\w+", r"suppl(?:y|ies|ied)", r"contracts?(?:ed)?", r"agreements?", r"acqui\w+", r"subsidiar\w+",
+    r"competitors?", r"competition", r"compet\w+", r"rivals?", r"market share",
+    r"directors?", r"chairman", r"chairwoman", r"chair", r"board", r"officers?", r"executives?", r"appointed",
+    r"ceo", r"cfo", r"coo", r"cto", r"founders?", r"products?", r"services?", r"brands?", r"platforms?"
+]) + r")\b", re.IGNORECASE)
+BOILERPLATE_MARKERS = re.compile(r"\b(?:" + "|".join([
+    r"forward-looking statements?", r"incorporated (?:herein )?by reference", r"exhibit \d+", r"pursuant to",
+    r"hereinafter", r"notwithstanding", r"table of contents", r"in accordance with (?:ifrs|gaap|ias)",
+    r"private securities litigation reform act", r"securities exchange act", r"undertakes? no obligation",
+    r"risks and uncertainties", r"differ materially", r"duly (?:caused|authori[sz]ed)", r"hereby", r"thereunto",
+    r"safe harbou?r", r"certification of"
+]) + r")\b", re.IGNORECASE)
+
+CATEGORY_PROTOTYPES = {
+    "COMMERCIAL_PRODUCTS_OR_SERVICES": "The company sells the following products and services and brands to its customers.",
+    "CUSTOMERS": "Our major customers include the following companies, which purchase our products under long-term contracts.",
+    "SUPPLIERS_OR_PARTNERS": "We rely on suppliers and strategic partners, and entered a partnership and supply agreement with the following companies.",
+    "COMPETITORS": "We compete with the following companies in our markets, and our main competitors are.",
+    "DIRECTORS": "The board of directors, the chairman and the chief executive officer, their appointments and roles at other companies."
+}
+_prototype_embeddings = {}
+
+def screenFeatures(text):
+    words = text.split()
+    tokens = max(1, estimateTokens(text))
+    return {
+        "keywords": len(RELATIONSHIP_KEYWORDS.findall(text)),
+        "names_per_1k_tokens": 1000 * len(set(NAME_PATTERN.findall(text))) / tokens,
+        "numeric_ratio": sum(1 for word in words if NUMBER_PATTERN.match(word)) / max(1, len(words)),
+        "boilerplate": len(BOILERPLATE_MARKERS.findall(text))
+    }
+
+def heuristicScore(features):
+    """0 (nothing to extract) to 1: relationship keywords and name density, discounted for tables and boilerplate"""
+    score = 0.6 * min(1.0, features["keywords"] / 3) + 0.4 * min(1.0, features["names_per_1k_tokens"] / 10)
+    score *= 1 - min(0.8, max(0.0, features["numeric_ratio"] - 0.3) * 2)
+    score *= max(0.0, 1 - BOILERPLATE_PENALTY * features["boilerplate"])
+    return score
+
+def prototypeSimilarity(text):
+    if not _prototype_embeddings:
+        _prototype_embeddings.update({ category: generateEmbeddings(prototype) for category, prototype in CATEGORY_PROTOTYPES.items() })
+    embedding = generateEmbeddings(text)
+    return max(cosine_similarity(embedding, prototype) for prototype in _prototype_embeddings.values())
+
+def screenChunk(text, mode=None):
+    """
+    Returns (relevant, reason).  Chunks are relevant when their heuristic score reaches PRESCREEN_THRESHOLD or,
+    with the EMBEDDING mode, when they are similar enough to a category prototype.
+    """
+    mode = mode or PRESCREEN
+    if mode == PRESCREEN_OFF:
+        return True, "prescreen off"
+    features = screenFeatures(text)
+    score = heuristicScore(features)
+    reason = f"score {round(score, 2)} (keywords {features['keywords']}, names/1k {round(features['names_per_1k_tokens'], 1)}, numeric {round(features['numeric_ratio'], 2)}, boilerplate {features['boilerplate']})"
+    if score >= PRESCREEN_THRESHOLD:
+        return True, reason
+    if mode == PRESCREEN_EMBEDDING:
+        similarity = prototypeSimilarity(text)
+        reason += f", prototype similarity {round(similarity, 2)}"
+        if similarity >= PRESCREEN_SIMILARITY_THRESHOLD:
+            return True, reason
+    return False, reason
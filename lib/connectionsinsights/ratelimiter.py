@@ -0,0 +1,215 @@
+import os
+import abc
+import time
+import random
+import threading
+import boto3
+import botocore.exceptions
+from decimal import Decimal
+
+
+# ██████   █████  ████████ ███████     ██      ██ ███    ███ ██ ████████ ███████ ██████
+# ██   ██ ██   ██    ██    ██          ██      ██ ████  ████ ██    ██    ██      ██   ██
+# ██████  ███████    ██    █████       ██      ██ ██ ████ ██ ██    ██    █████   ██████
+# ██   ██ ██   ██    ██    ██          ██      ██ ██  ██  ██ ██    ██    ██      ██   ██
+# ██   ██ ██   ██    ██    ███████     ███████ ██ ██      ██ ██    ██    ███████ ██   ██
+
+# Token bucket limiter for the Bedrock requests-per-minute and tokens-per-minute quota, shared by every
+# Lambda / ECS task through a DynamoDB item per model.  Capacity is taken in small leases with a conditional
+# update and spent from a local lease cache, so most calls do not touch DynamoDB.
+#
+# BULK workloads (report ingestion) can only draw the bucket down to the INTERACTIVE reserve, which keeps
+# headroom for INTERACTIVE workloads (news processing).
+
+PRIORITY_INTERACTIVE = "INTERACTIVE"
+PRIORITY_BULK = "BULK"
+
+BACKEND_NONE = "NONE"
+BACKEND_LOCAL = "LOCAL"
+BACKEND_DYNAMODB = "DYNAMODB"
+
+BEDROCK_RPM = float(os.environ.get("BEDROCK_RPM", "200"))
+BEDROCK_TPM = float(os.environ.get("BEDROCK_TPM", "400000"))
+BEDROCK_INTERACTIVE_RESERVE = float(os.environ.get("BEDROCK_INTERACTIVE_RESERVE", "0.2")) # fraction of the bucket BULK cannot use
+BEDROCK_RATE_LIMITER_MAX_WAIT = float(os.environ.get("BEDROCK_RATE_LIMITER_MAX_WAIT", "300")) # seconds, then fail open
+BEDROCK_RATE_LIMITER_LEASE = int(os.environ.get("BEDROCK_RATE_LIMITER_LEASE", "3")) # requests taken per DynamoDB update
+LEASE_TTL_SECONDS = 30 # unused leased capacity is dropped, as the bucket keeps refilling regardless
+
+def getPriority():
+    priority = os.environ.get("BEDROCK_PRIORITY", PRIORITY_BULK).upper()
+    return priority if priority in [PRIORITY_INTERACTIVE, PRIORITY_BULK] else PRIORITY_BULK
+
+def estimateRequestTokens(body_length, max_tokens):
+    # Bedrock reserves input + max_tokens against the TPM quota when a request starts; ~4 characters per token
+    return int(body_length / 4) + max_tokens
+
+def refillBucket(state, now, rpm, tpm):
+    elapsed = max(0.0, now - state["updated_at"])
+    return {
+        "requests": min(rpm, state["requests"] + elapsed * rpm / 60.0),
+        "tokens": min(tpm, state["tokens"] + elapsed * tpm / 60.0),
+        "updated_at": now
+    }
+
+def takeFromBucket(state, requests, tokens, priority, rpm, tpm):
+    """
+    Returns (new_state, 0) if the bucket can spare the requests/tokens for this priority, otherwise
+    (None, seconds_to_wait) until it can.
+    """
+    reserve = 0 if priority == PRIORITY_INTERACTIVE else BEDROCK_INTERACTIVE_RESERVE
+    floor_requests = rpm * reserve
+    floor_tokens = tpm * reserve
+    # a single request can never need more than the usable part of the bucket
+    requests = min(requests, rpm - floor_requests)
+    tokens = min(tokens, tpm - floor_tokens)
+
+    missing_requests = requests + floor_requests - state["requests"]
+    missing_tokens = tokens + floor_tokens - state["tokens"]
+    if missing_requests <= 0 and missing_tokens <= 0:
+        return {
+            "requests": state["requests"] - requests,
+            "tokens": state["tokens"] - tokens,
+            "updated_at": state["updated_at"]
+        }, 0
+    wait = max(missing_requests / (rpm / 60.0), missing_tokens / (tpm / 60.0))
+    return None, max(0.05, wait)
+
+class RateLimiter(abc.ABC):
+    def __init__(self, rpm=BEDROCK_RPM, tpm=BEDROCK_TPM, max_wait=BEDROCK_RATE_LIMITER_MAX_WAIT):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+
+    @abc.abstractmethod
+    def tryAcquire(self, key, tokens, priority):
+        """Returns (True, 0) if one request of `tokens` tokens can start now, otherwise (False, seconds_to_wait)"""
+
+    def acquire(self, key, tokens, priority=None):
+        """Block until the bucket for key can serve one request of `tokens` tokens. Returns the seconds waited."""
+        priority = priority or getPriority()
+        start = time.time()
+        while True:
+            try:
+                acquired, wait = self.tryAcquire(key, tokens, priority)
+            except Exception as e:
+                # never let the limiter itself stop Bedrock calls
+                print(f"Rate limiter error, proceeding without limit: {str(e)}")
+                return time.time() - start
+            if acquired:
+                return time.time() - start
+            waited = time.time() - start
+            if waited + wait > self.max_wait:
+                print(f"Rate limiter wait exceeded {self.max_wait}s for {key} ({priority}), proceeding")
+                return waited
+            time.sleep(wait + random.uniform(0, wait * 0.1))
+
+class LocalRateLimiter(RateLimiter):
+    """In-memory backend, for tests and single-container use"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def tryAcquire(self, key, tokens, priority):
+        with self.lock:
+            now = time.time()
+            state = self.buckets.get(key, {"requests": self.rpm, "tokens": self.tpm, "updated_at": now})
+            state, wait = takeFromBucket(refillBucket(state, now, self.rpm, self.tpm), 1, tokens, priority, self.rpm, self.tpm)
+            if state is None:
+                return False, wait
+            self.buckets[key] = state
+            return True, 0
+
+class DynamoDBRateLimiter(RateLimiter):
+    """Shared backend: one item per bucket, updated with optimistic concurrency on a version attribute"""
+    def __init__(self, table_name, lease=BEDROCK_RATE_LIMITER_LEASE, **kwargs):
+        super().__init__(**kwargs)
+        self.table = boto3.resource('dynamodb').Table(table_name)
+        self.lease = max(1, lease)
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def _takeLocal(self, key, tokens):
+        lease = self.leases.get(key)
+        if lease is None or time.time() > lease["expires_at"]:
+            return False
+        if lease["requests"] >= 1 and lease["tokens"] >= tokens:
+            lease["requests"] -= 1
+            lease["tokens"] -= tokens
+            return True
+        return False
+
+    def _addLease(self, key, requests, tokens, now):
+        # threads of the container may lease concurrently: add to a lease that is still valid
+        lease = self.leases.get(key)
+        if lease is None or now > lease["expires_at"]:
+            self.leases[key] = {"requests": requests, "tokens": tokens, "expires_at": now + LEASE_TTL_SECONDS}
+        else:
+            lease["requests"] += requests
+            lease["tokens"] += tokens
+
+    def tryAcquire(self, key, tokens, priority):
+        # the lock only guards the local leases; the DynamoDB round-trips run outside it
+        with self.lock:
+            if self._takeLocal(key, tokens):
+                return True, 0
+
+        # lease enough for this request plus a few more of the same size
+        now = time.time()
+        response = self.table.get_item(Key={'id': key}, ConsistentRead=True)
+        item = response.get('Item')
+        if item is None:
+            state = {"requests": self.rpm, "tokens": self.tpm, "updated_at": now}
+            version = 0
+        else:
+            state = {"requests": float(item["requests"]), "tokens": float(item["tokens"]), "updated_at": float(item["updated_at"])}
+            version = int(item["version"])
+
+        state = refillBucket(state, now, self.rpm, self.tpm)
+        lease_requests = self.lease
+        new_state, wait = takeFromBucket(state, lease_requests, tokens * lease_requests, priority, self.rpm, self.tpm)
+        if new_state is None:
+            # not enough for a full lease, try for just this request
+            lease_requests = 1
+            new_state, wait = takeFromBucket(state, 1, tokens, priority, self.rpm, self.tpm)
+            if new_state is None:
+                return False, wait
+
+        try:
+            self.table.put_item(
+                Item={
+                    'id': key,
+                    'requests': Decimal(str(round(new_state["requests"], 3))),
+                    'tokens': Decimal(str(round(new_state["tokens"], 3))),
+                    'updated_at': Decimal(str(round(now, 3))),
+                    'version': version + 1
+                },
+                ConditionExpression="attribute_not_exists(id) OR version = :version",
+                ExpressionAttributeValues={':version': version}
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False, random.uniform(0.01, 0.1) # another caller updated the bucket first
+            raise e
+
+        if lease_requests > 1:
+            with self.lock:
+                self._addLease(key, lease_requests - 1, tokens * (lease_requests - 1), now)
+        return True, 0
+
+def createRateLimiter():
+    table_name = os.environ.get("DDBTBL_RATE_LIMITER")
+    backend = os.environ.get("BEDROCK_RATE_LIMITER_BACKEND", BACKEND_DYNAMODB if table_name else BACKEND_NONE).upper()
+    if backend == BACKEND_DYNAMODB and table_name:
+        return DynamoDBRateLimiter(table_name)
+    elif backend == BACKEND_LOCAL:
+        return LocalRateLimiter()
+    return None
+
+rate_limiter = createRateLimiter()
+
+def acquireBedrockCapacity(modelId, tokens, priority=None):
+    """Wait for Bedrock quota for one request to modelId; returns the seconds waited (0 when no limiter is configured)"""
+    if rate_limiter is None:
+        return 0
+    return rate_limiter.acquire("bucket#" + modelId, tokens, priority)
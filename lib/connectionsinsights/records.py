@@ -0,0 +1,98 @@
+import os
+import time
+import boto3
+from boto3.dynamodb.conditions import Key
+
+from connectionsinsights.dynamodb import (
+    batchGetItems
+)
+
+
+# ██████  ███████  ██████  ██████  ██████  ██████  ███████
+# ██   ██ ██      ██      ██    ██ ██   ██ ██   ██ ██
+# ██████  █████   ██      ██    ██ ██████  ██   ██ ███████
+# ██   ██ ██      ██      ██    ██ ██   ██ ██   ██      ██
+# ██   ██ ███████  ██████  ██████  ██   ██ ██████  ███████
+
+# Records of the documents being ingested (DDBTBL_INGESTION).  Every record of a document is stored under its
+# processing_id (partition key "pk") with a sort key of "<record type>#<id>", so a stage loads all the records
+# of a type - e.g. every chunk result - with one paginated Query instead of a get_item per id.
+
+RECORD_CHUNK = "chunk"                 # chunk text, from chunk-document
+RECORD_CHUNK_RESULT = "chunk_result"   # entities extracted from a chunk, keyed by the chunk id
+RECORD_RAW = "raw"                     # consolidated entities of a category, e.g. raw#raw_customers
+RECORD_FINAL = "final"                 # filtered entities of a category, e.g. final#finalCustomers
+RECORD_GROUP = "group"                 # alphabetical groups for insert-vertices-edges, e.g. group#A
+
+RECORD_TTL_SECONDS = 7200
+
+def get_ingestion_table():
+    """Get the ingestion DynamoDB table"""
+    dynamodb = boto3.resource('dynamodb')
+    table_name = os.environ.get("DDBTBL_INGESTION")
+    if not table_name:
+        raise ValueError("DDBTBL_INGESTION environment variable not set")
+    return dynamodb.Table(table_name)
+
+def recordKey(processing_id, record_type, id):
+    return {'pk': processing_id, 'sk': f"{record_type}#{id}"}
+
+def newRecord(processing_id, record_type, id, **attributes):
+    """Item of a document record; `id` is unique within the record type of the document"""
+    return {
+        **recordKey(processing_id, record_type, id),
+        'id': id,
+        **attributes,
+        'ttl_timestamp': int(time.time()) + RECORD_TTL_SECONDS
+    }
+
+def addConsumedCapacity(capacity, response, kind):
+    """Adds the CapacityUnits of a response made with ReturnConsumedCapacity='TOTAL' to capacity[kind]"""
+    if capacity is not None:
+        capacity[kind] = capacity.get(kind, 0) + response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+
+def putRecord(item, capacity=None):
+    """Pass a dict as capacity to add the consumed write capacity units to capacity['write']"""
+    kwargs = {'ReturnConsumedCapacity': 'TOTAL'} if capacity is not None else {}
+    response = get_ingestion_table().put_item(Item=item, **kwargs)
+    addConsumedCapacity(capacity, response, 'write')
+
+def putRecords(items):
+    with get_ingestion_table().batch_writer(overwrite_by_pkeys=['pk', 'sk']) as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+def getRecord(processing_id, record_type, id):
+    item = get_ingestion_table().get_item(Key=recordKey(processing_id, record_type, id)).get('Item')
+    if item is None:
+        raise Exception(f"Ingestion record {record_type}#{id} of {processing_id} not found")
+    return item
+
+def getRecords(processing_id, record_type, ids):
+    """Records of the given ids, in the order of ids"""
+    keys = [recordKey(processing_id, record_type, id) for id in dict.fromkeys(ids)]
+    items = { item['id']: item for item in batchGetItems(get_ingestion_table().name, keys) }
+    missing = [id for id in ids if id not in items]
+    if missing:
+        raise Exception(f"Ingestion records {record_type} of {processing_id} not found: {missing}")
+    return [items[id] for id in ids]
+
+def existingRecordIds(processing_id, record_type, ids):
+    """The ids that already have a record of the type, e.g. chunks whose results a failed attempt still saved"""
+    keys = [recordKey(processing_id, record_type, id) for id in dict.fromkeys(ids)]
+    prefix = record_type + "#"
+    return set(item['sk'][len(prefix):] for item in batchGetItems(get_ingestion_table().name, keys, projection="sk"))
+
+def queryRecords(processing_id, record_type, capacity=None, **kwargs):
+    """Yields every record of a type of a document, paginating the Query; capacity as in putRecord (capacity['read'])"""
+    table = get_ingestion_table()
+    query_kwargs = {'KeyConditionExpression': Key('pk').eq(processing_id) & Key('sk').begins_with(record_type + "#"), **kwargs}
+    if capacity is not None:
+        query_kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+    while True:
+        response = table.query(**query_kwargs)
+        addConsumedCapacity(capacity, response, 'read')
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import boto3
+import hashlib
+import botocore.exceptions
+from datetime import datetime, timedelta
+from boto3.dynamodb.types import TypeDeserializer
+
+from connectionsinsights.dynamodb import (
+    batchGetItems
+)
+
+
+# ██████  ███████  ██████  ██ ███████ ████████ ██████  ██    ██
+# ██   ██ ██      ██       ██ ██         ██    ██   ██  ██  ██
+# ██████  █████   ██   ███ ██ ███████    ██    ██████    ████
+# ██   ██ ██      ██    ██ ██      ██    ██    ██   ██    ██
+# ██   ██ ███████  ██████  ██ ███████    ██    ██   ██    ██
+
+# Document registry keyed by content hash, used to skip exact duplicate uploads
+# before any Textract or Bedrock spend.  It also holds the extraction results of each chunk, keyed by a hash of
+# the chunk text and main entity, so re-ingesting an amended document only processes its new or changed chunks.
+
+HASH_READ_CHUNK_SIZE = 1024 * 1024 # 1 MB
+
+CHUNK_RESULT_CACHE = os.environ.get("CHUNK_RESULT_CACHE", "true").lower() == "true"
+CHUNK_RESULT_VERSION = 1 # bump when the chunk extraction prompt or schema changes
+CHUNK_RESULT_PREFIX = "chunk#"
+CHUNK_RESULT_TTL_DAYS = int(os.environ.get("CHUNK_RESULT_TTL_DAYS", "90")) # expired by DynamoDB TTL
+FILE_TYPE_CHUNK_RESULT = "chunk_result"
+
+STATUS_PROCESSING = "PROCESSING"
+STATUS_COMPLETED = "COMPLETED"
+STATUS_FAILED = "FAILED"
+
+# longer than the state machine timeout plus the time a report can wait in the FIFO ingestion queue
+CLAIM_STALE_HOURS = float(os.environ.get("CLAIM_STALE_HOURS", "24"))
+MAX_DUPLICATE_KEYS = 100
+
+def get_document_registry_table():
+    """Get the document registry DynamoDB table"""
+    dynamodb = boto3.resource('dynamodb')
+    table_name = os.environ.get("DDBTBL_DOCUMENT_REGISTRY")
+    if not table_name:
+        raise ValueError("DDBTBL_DOCUMENT_REGISTRY environment variable not set")
+    return dynamodb.Table(table_name)
+
+def hashContent(content):
+    """Return the sha256 hex digest of a str/bytes payload"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def hashS3Object(s3_bucket, s3_key):
+    """Compute the sha256 of an S3 object by streaming its body, without buffering the whole file"""
+    s3 = boto3.client('s3')
+    response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
+    sha256 = hashlib.sha256()
+    for chunk in response['Body'].iter_chunks(chunk_size=HASH_READ_CHUNK_SIZE):
+        sha256.update(chunk)
+    return sha256.hexdigest(), response.get('Metadata', {})
+
+def isForceReingest(metadata):
+    """Uploads can opt into re-ingesting identical content via the force-reingest object metadata"""
+    return str(metadata.get('force-reingest', '')).strip().lower() in ["true", "yes", "1"]
+
+def claimDocument(content_hash, file_type, s3_key, force=False):
+    """
+    Register a document by content hash.  Returns (True, existing_item or None) if the caller should process it,
+    or (False, existing_item) if an identical document is already processing or completed.
+    A previously FAILED document, a redelivered event for the same s3_key and a PROCESSING claim older than
+    CLAIM_STALE_HOURS (the run crashed) can always be claimed again.
+    """
+    current_time = datetime.utcnow().isoformat() + 'Z'  # UTC ISO format
+    table = get_document_registry_table()
+    item = {
+        'id': content_hash,
+        'file_type': file_type,
+        's3_key': s3_key,
+        'status': STATUS_PROCESSING,
+        'datetime_registered': current_time
+    }
+
+    if force:
+        table.put_item(Item=item)
+        return True, None
+
+    try:
+        table.put_item(
+            Item=item,
+            ConditionExpression="attribute_not_exists(id) OR #status = :failed",
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':failed': STATUS_FAILED},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return True, None
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        existing = e.response.get('Item')
+    if existing is None:
+        existing = table.get_item(Key={'id': content_hash}, ConsistentRead=True).get('Item')
+    else:
+        existing = { key: TypeDeserializer().deserialize(value) for key, value in existing.items() }
+
+    # S3 and SQS deliver events at least once: the same key is a retry of the claim, not a duplicate
+    if existing is None or existing.get('s3_key') == s3_key:
+        return True, existing
+
+    if isStaleClaim(existing):
+        try:
+            table.put_item(
+                Item=item,
+                ConditionExpression="#status = :processing AND datetime_registered = :registered",
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':processing': STATUS_PROCESSING, ':registered': existing['datetime_registered']}
+            )
+            print(f"Reclaimed stale claim of {existing['s3_key']} registered at {existing['datetime_registered']}")
+            return True, existing
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+
+    # Duplicate - record the skipped key against the original document (each key once, up to MAX_DUPLICATE_KEYS)
+    try:
+        response = table.update_item(
+            Key={'id': content_hash},
+            UpdateExpression="SET duplicate_keys = list_append(if_not_exists(duplicate_keys, :empty), :key)",
+            ConditionExpression="attribute_not_exists(duplicate_keys) OR (size(duplicate_keys) < :max AND NOT contains(duplicate_keys, :s3_key))",
+            ExpressionAttributeValues={':key': [s3_key], ':empty': [], ':max': MAX_DUPLICATE_KEYS, ':s3_key': s3_key},
+            ReturnValues="ALL_NEW"
+        )
+        return False, response.get('Attributes')
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        return False, existing
+
+def isStaleClaim(item):
+    """PROCESSING claims older than CLAIM_STALE_HOURS belong to a run that crashed or timed out"""
+    if item.get('status') != STATUS_PROCESSING or 'datetime_registered' not in item:
+        return False
+    registered = datetime.fromisoformat(item['datetime_registered'].rstrip('Z'))
+    return datetime.utcnow() - registered > timedelta(hours=CLAIM_STALE_HOURS)
+
+def updateDocumentStatus(content_hash, status, **attributes):
+    """Set the status (and optionally any extra attributes) of a registered document"""
+    if not content_hash:
+        return
+    current_time = datetime.utcnow().isoformat() + 'Z'  # UTC ISO format
+
+    update_expression = "SET #status = :status, datetime_updated = :updated"
+    expression_names = {'#status': 'status'}
+    expression_values = {':status': status, ':updated': current_time}
+    for index, (key, value) in enumerate(attributes.items()):
+        update_expression += f", #attr{index} = :attr{index}"
+        expression_names[f"#attr{index}"] = key
+        expression_values[f":attr{index}"] = value
+
+    table = get_document_registry_table()
+    table.update_item(
+        Key={'id': content_hash},
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames=expression_names,
+        ExpressionAttributeValues=expression_values
+    )
+
+def hashChunk(text, main_entity_name):
+    """Identity of a chunk's extraction result: its text, the main entity it was read for and the prompt version"""
+    return hashContent(json.dumps([CHUNK_RESULT_VERSION, main_entity_name.strip().upper(), text]))
+
+def getChunkResults(chunk_hashes):
+    """Cached extraction results of the given chunk hashes, as {chunk_hash: results}"""
+    if not CHUNK_RESULT_CACHE:
+        return {}
+    table = get_document_registry_table()
+    keys = [{'id': CHUNK_RESULT_PREFIX + chunk_hash} for chunk_hash in dict.fromkeys(chunk_hashes)]
+    results = {}
+    for item in batchGetItems(table.name, keys, projection="id, results"):
+        results[item['id'][len(CHUNK_RESULT_PREFIX):]] = json.loads(item['results'])
+    return results
+
+def putChunkResults(chunk_hash, results):
+    """Save the extraction results of a chunk (without per-document attributes such as SOURCE)"""
+    if not CHUNK_RESULT_CACHE or not chunk_hash:
+        return
+    current_time = datetime.utcnow().isoformat() + 'Z'  # UTC ISO format
+    table = get_document_registry_table()
+    table.put_item(Item={
+        'id': CHUNK_RESULT_PREFIX + chunk_hash,
+        'file_type': FILE_TYPE_CHUNK_RESULT,
+        'results': json.dumps(results),
+        'datetime_registered': current_time,
+        'ttl_timestamp': int(time.time()) + CHUNK_RESULT_TTL_DAYS * 86400
+    })
+
+def chunkResultsWithSource(results, source):
+    """Extraction results of a chunk of the document `source`, as stored for consolidate-chunks"""
+    return { key: [ {**x, "SOURCE": source} for x in entries ] for key, entries in results.items() }
+
+def purgeDocuments(file_type):
+    """Remove all registry entries of a file type, e.g. after the news or the knowledge graph is purged"""
+    table = get_document_registry_table()
+    scan_kwargs = {
+        'FilterExpression': "file_type = :file_type",
+        'ExpressionAttributeValues': {':file_type': file_type},
+        'ProjectionExpression': "id"
+    }
+    items = []
+    response = table.scan(**scan_kwargs)
+    items.extend(response.get('Items', []))
+    while 'LastEvaluatedKey' in response:
+        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_kwargs)
+        items.extend(response.get('Items', []))
+
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.delete_item(Key={'id': item['id']})
+    return len(items)
@@ -0,0 +1,140 @@
+import os
+import re
+import hashlib
+import random
+import botocore.exceptions
+from decimal import Decimal
+
+from connectionsinsights.registry import (
+    get_document_registry_table
+)
+from connectionsinsights.dynamodb import (
+    batchGetItems
+)
+
+
+# ███████ ██ ███    ███ ██ ██       █████  ██████  ██ ████████ ██    ██
+# ██      ██ ████  ████ ██ ██      ██   ██ ██   ██ ██    ██     ██  ██
+# ███████ ██ ██ ████ ██ ██ ██      ███████ ██████  ██    ██      ████
+#      ██ ██ ██  ██  ██ ██ ██      ██   ██ ██   ██ ██    ██       ██
+# ███████ ██ ██      ██ ██ ███████ ██   ██ ██   ██ ██    ██       ██
+
+# MinHash signatures + LSH banding index (stored in the document registry table) used to detect
+# near-duplicate news articles, e.g. wire stories republished with small edits.
+
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 16 # 16 bands x 8 rows; candidate pairs start to appear around ~0.7 jaccard similarity
+SHINGLE_SIZE = 5 # words
+SIGNATURE_FILE_TYPE = "news_signature"
+# articles kept per LSH band (~40 bytes each), well under the 400 KB item limit; a band shared by that many
+# articles (e.g. boilerplate) no longer tells near-duplicates apart
+LSH_BAND_MAX_IDS = int(os.environ.get("LSH_BAND_MAX_IDS", "1000"))
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# fixed seed so signatures are comparable across invocations and containers
+_random = random.Random(20240229)
+_PERMUTATIONS = [
+    (_random.randint(1, _MERSENNE_PRIME - 1), _random.randint(0, _MERSENNE_PRIME - 1))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+def getNearDuplicateThreshold():
+    # estimated jaccard similarity above which an article is considered a near-duplicate; 0 disables detection
+    return float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+
+def shingles(text, size=SHINGLE_SIZE):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return set([" ".join(words)]) if words else set()
+    return set(" ".join(words[i:i+size]) for i in range(len(words) - size + 1))
+
+def minhashSignature(text):
+    """MinHash signature of the shingles of text, or None for text without words (nothing to compare)"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+        for shingle in shingles(text)
+    ]
+    if not hashes:
+        return None
+    return [
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+def estimateSimilarity(signature1, signature2):
+    # fraction of matching minhash values estimates the jaccard similarity of the shingle sets
+    matches = sum(1 for x, y in zip(signature1, signature2) if int(x) == int(y))
+    return matches / float(NUM_PERMUTATIONS)
+
+def lshBandKeys(signature):
+    rows = NUM_PERMUTATIONS // LSH_BANDS
+    keys = []
+    for band in range(LSH_BANDS):
+        band_values = ",".join(str(int(x)) for x in signature[band*rows:(band+1)*rows])
+        keys.append(f"lsh#{band}#" + hashlib.sha1(band_values.encode('utf-8')).hexdigest())
+    return keys
+
+def _batchGetItems(table_name, keys):
+    return batchGetItems(table_name, [{'id': key} for key in keys])
+
+def findNearDuplicate(signature, threshold=None):
+    """
+    Returns (news_id, similarity) of the most similar indexed article at or above the threshold,
+    or (None, 0) if there is none.
+    """
+    threshold = getNearDuplicateThreshold() if threshold is None else threshold
+    if threshold <= 0 or signature is None:
+        return None, 0
+
+    table_name = get_document_registry_table().name
+    candidates = set()
+    for band in _batchGetItems(table_name, lshBandKeys(signature)):
+        candidates |= set(band.get('news_ids', []))
+    if not candidates:
+        return None, 0
+
+    best_id, best_similarity = None, 0
+    for item in _batchGetItems(table_name, ["minhash#" + news_id for news_id in candidates]):
+        similarity = estimateSimilarity(signature, item['signature'])
+        if similarity >= threshold and similarity > best_similarity:
+            best_id, best_similarity = item['news_id'], similarity
+    return best_id, best_similarity
+
+def indexSignature(news_id, signature):
+    if signature is None:
+        return
+    table = get_document_registry_table()
+    table.put_item(Item={
+        'id': "minhash#" + news_id,
+        'news_id': news_id,
+        'file_type': SIGNATURE_FILE_TYPE,
+        'signature': [Decimal(x) for x in signature]
+    })
+    for key in lshBandKeys(signature):
+        try:
+            table.update_item(
+                Key={'id': key},
+                UpdateExpression="ADD news_ids :news_id SET file_type = :file_type",
+                ConditionExpression="attribute_not_exists(news_ids) OR size(news_ids) < :max_ids",
+                ExpressionAttributeValues={':news_id': set([news_id]), ':file_type': SIGNATURE_FILE_TYPE, ':max_ids': LSH_BAND_MAX_IDS}
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise e
+            print(f"LSH band {key} is full ({LSH_BAND_MAX_IDS} articles), not indexing news {news_id} in it")
+
+def removeSignature(news_id):
+    """Remove an article from the index, e.g. when it is reprocessed or deleted"""
+    table = get_document_registry_table()
+    item = table.get_item(Key={'id': "minhash#" + news_id}).get('Item')
+    if item is None:
+        return
+    for key in lshBandKeys(item['signature']):
+        table.update_item(
+            Key={'id': key},
+            UpdateExpression="DELETE news_ids :news_id",
+            ExpressionAttributeValues={':news_id': set([news_id])}
+        )
+    table.delete_item(Key={'id': "minhash#" + news_id})
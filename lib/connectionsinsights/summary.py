@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import operator
+import concurrent.futures
+
+from connectionsinsights.bedrock import (
+    queryBedrockJSON,
+    resultSchema,
+    uppercase,
+    savePrompt,
+    convertMessagesToTextCompletion,
+    generateEmbeddings
+)
+
+
+# ███████ ██    ██ ███    ███ ███    ███  █████  ██████  ██    ██
+# ██      ██    ██ ████  ████ ████  ████ ██   ██ ██   ██  ██  ██
+# ███████ ██    ██ ██ ████ ██ ██ ████ ██ ███████ ██████    ████
+#      ██ ██    ██ ██  ██  ██ ██  ██  ██ ██   ██ ██   ██    ██
+# ███████  ██████  ██      ██ ██      ██ ██   ██ ██   ██    ██
+
+# Document summary (MAIN_ENTITY) used by every chunk extraction.  SINGLE sends the selected chunks in one
+# request; MAP_REDUCE summarizes groups of about SUMMARY_GROUP_TOKENS in parallel and merges the partial
+# summaries in a short final request.  Chunks are selected either as the FIRST chunks of the document, or as
+# the chunks nearest the centres of k-means CLUSTERs of their embeddings, to cover the whole document.
+# Chunk extraction only needs the main entity, so it is first identified from the opening pages in a small
+# request, and the full summary is generated while the chunks are processed.
+
+SUMMARY_MODE_SINGLE = "SINGLE"
+SUMMARY_MODE_MAP_REDUCE = "MAP_REDUCE"
+SUMMARY_SELECTION_FIRST = "FIRST"
+SUMMARY_SELECTION_CLUSTER = "CLUSTER"
+
+SUMMARY_MODE = os.environ.get("SUMMARY_MODE", SUMMARY_MODE_SINGLE).upper()
+SUMMARY_SELECTION = os.environ.get("SUMMARY_SELECTION", SUMMARY_SELECTION_FIRST).upper()
+SUMMARY_GROUP_TOKENS = int(os.environ.get("SUMMARY_GROUP_TOKENS", "6000"))
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "8"))
+KMEANS_ITERATIONS = 5
+MAIN_ENTITY_TOKENS = int(os.environ.get("MAIN_ENTITY_TOKENS", "4000")) # opening pages read to identify the main entity
+
+SUMMARY_SCHEMA = resultSchema("results", {
+    "type": "object",
+    "properties": {
+        "MAIN_ENTITY": {
+            "type": "object",
+            "properties": {
+                "NAME": {"type": "string"},
+                "ATTRIBUTES": {"type": "array", "items": {"type": "object"}}
+            },
+            "required": ["NAME", "ATTRIBUTES"]
+        }
+    },
+    "required": ["MAIN_ENTITY"]
+})
+
+SUMMARY_SAMPLE_JSON = """
+    {
+        "MAIN_ENTITY": {
+            "NAME": "<FULL_NAME>",
+            "ATTRIBUTES" : [
+                { "INDUSTRY": "<ATTRIBUTE_VALUE>" },
+                { "FOCUS_AREA": ["<ATTRIBUTE_VALUE>"] },
+                { "REVENUE_GENERATING_INDUSTRIES": ["<ATTRIBUTE_VALUE>"] },
+                { "SUMMARY_OF_BUSINESS_PERFORMANCE": "<ATTRIBUTE_VALUE>" },
+                { "SUMMARY_OF_BUSINESS_STRATEGY": "<ATTRIBUTE_VALUE>" },
+            ]
+        }
+    }
+    """
+
+def qb_generateSummary(text, prompt_id="qb_generateDocumentSummary"):
+    messages = [
+        {"role": "user", "content": """
+    I will provide you with a document that which is a subset of a larger document.  Read it carefully as I will be asking you questions about it.
+
+    Here is the document:
+    <document>
+    {text}
+    </document>
+
+    1) Identify the full name of the main entity discussed in <document> and any key qualitative attributes mentioned.  Leave array empty if you cannot identify any.
+
+    2) Identify the industry that the main entity is operating in.  Leave string value empty if you cannot identify any.
+
+    3) Identity the focus area that the main entity is focusing on.  Leave array empty if you cannot identify any.
+
+    4) Identify the revenue generating industries that the main entity is operating in.  Leave array empty if you cannot identify any.
+
+    5) Summarize the business performance of the main entity.  Leave string value empty if you cannot identify any.
+
+    6) Summarize the business strategy of the main entity.  Leave string value empty if you cannot identify any.
+
+    7) It is important that you print out the output within <results></results> xml tag using the following JSON format and ensure that the output is a valid JSON format.
+    {sampleJSON}
+    """.format(text=text, sampleJSON=SUMMARY_SAMPLE_JSON)},
+        {"role":"assistant", "content": ""}
+    ]
+
+    results, completion = queryBedrockJSON(messages, "results", schema=SUMMARY_SCHEMA)
+    results = uppercase(results)
+    savePrompt(convertMessagesToTextCompletion(messages) + "\n\n" + completion, id=results["MAIN_ENTITY"]["NAME"]+"->"+prompt_id)
+    return results
+
+MAIN_ENTITY_SAMPLE_JSON = """
+    {
+        "MAIN_ENTITY": {
+            "NAME": "<FULL_NAME>",
+            "ATTRIBUTES" : [
+                { "INDUSTRY": "<ATTRIBUTE_VALUE>" },
+                { "FOCUS_AREA": ["<ATTRIBUTE_VALUE>"] },
+                { "REVENUE_GENERATING_INDUSTRIES": ["<ATTRIBUTE_VALUE>"] }
+            ]
+        }
+    }
+    """
+
+def qb_identifyMainEntity(text):
+    messages = [
+        {"role": "user", "content": """
+    I will provide you with the opening pages of a document.
+
+    Here is the document:
+    <document>
+    {text}
+    </document>
+
+    1) Identify the full name of the main entity discussed in <document>.
+
+    2) Identify the industry that the main entity is operating in.  Leave string value empty if you cannot identify any.
+
+    3) Identity the focus area that the main entity is focusing on.  Leave array empty if you cannot identify any.
+
+    4) Identify the revenue generating industries that the main entity is operating in.  Leave array empty if you cannot identify any.
+
+    5) It is important that you print out the output within <results></results> xml tag using the following JSON format and ensure that the output is a valid JSON format.
+    {sampleJSON}
+    """.format(text=text, sampleJSON=MAIN_ENTITY_SAMPLE_JSON)},
+        {"role":"assistant", "content": ""}
+    ]
+
+    results, completion = queryBedrockJSON(messages, "results", schema=SUMMARY_SCHEMA)
+    results = uppercase(results)
+    savePrompt(convertMessagesToTextCompletion(messages) + "\n\n" + completion, id=results["MAIN_ENTITY"]["NAME"]+"->qb_identifyMainEntity")
+    return results
+
+def identifyMainEntity(chunks, maxTokens=MAIN_ENTITY_TOKENS):
+    """Main entity (name, industry and focus areas, without the long summaries) from the opening chunks"""
+    start_time = time.time()
+    results = qb_identifyMainEntity(" ".join(chunk["text"] for chunk in groupChunks(chunks, maxTokens)[0]) if chunks else "")
+    print(f"Main entity identification took {round(time.time() - start_time, 1)}s")
+    return results
+
+def qb_mergeSummaries(partials):
+    messages = [
+        {"role": "user", "content": """
+    I will provide you with summaries of consecutive parts of one document, in document order, within <summaries></summaries> tags.  Each was written from its part only.
+
+    <summaries>
+    {summaries}
+    </summaries>
+
+    Combine them into a single summary of the main entity of the whole document:
+
+    1) Identify the full name of the main entity that the document is about.  Most parts discuss it; prefer its full legal name.
+
+    2) Combine the industry, focus areas and revenue generating industries of the main entity, without duplicates.  Ignore attributes of other entities.
+
+    3) Combine the summaries of the business performance and of the business strategy of the main entity.
+
+    4) It is important that you print out the output within <results></results> xml tag using the following JSON format and ensure that the output is a valid JSON format.
+    {sampleJSON}
+    """.format(summaries="\n".join(json.dumps(partial) for partial in partials), sampleJSON=SUMMARY_SAMPLE_JSON)},
+        {"role":"assistant", "content": ""}
+    ]
+
+    results, completion = queryBedrockJSON(messages, "results", schema=SUMMARY_SCHEMA)
+    results = uppercase(results)
+    savePrompt(convertMessagesToTextCompletion(messages) + "\n\n" + completion, id=results["MAIN_ENTITY"]["NAME"]+"->qb_mergeSummaries")
+    return results
+
+def groupChunks(chunks, groupTokens):
+    """Consecutive groups of chunks of up to groupTokens each"""
+    groups = []
+    tokens = 0
+    for chunk in chunks:
+        if groups and tokens + chunk["tokens"] <= groupTokens:
+            groups[-1].append(chunk)
+            tokens += chunk["tokens"]
+        else:
+            groups.append([chunk])
+            tokens = chunk["tokens"]
+    return groups
+
+def dot(vector1, vector2):
+    return sum(map(operator.mul, vector1, vector2))
+
+def normalize(vector):
+    magnitude = dot(vector, vector) ** 0.5 or 1.0
+    return [value / magnitude for value in vector]
+
+def kmeansRepresentatives(vectors, k, iterations=KMEANS_ITERATIONS):
+    """
+    Indexes of the vectors nearest the centres of k clusters (cosine k-means of normalized vectors, seeded from
+    the first vector by farthest-point selection so the result is deterministic), in index order.  The first
+    vector represents its own cluster.
+    """
+    if k >= len(vectors):
+        return list(range(len(vectors)))
+    centres = [vectors[0]]
+    nearest = [dot(vector, centres[0]) for vector in vectors]
+    while len(centres) < k:
+        farthest = min(range(len(vectors)), key=lambda index: nearest[index])
+        centres.append(vectors[farthest])
+        nearest = [max(similarity, dot(vector, centres[-1])) for similarity, vector in zip(nearest, vectors)]
+
+    for _ in range(iterations):
+        assignments = [max(range(k), key=lambda c: dot(vector, centres[c])) for vector in vectors]
+        moved = False
+        for c in range(k):
+            members = [vector for vector, assigned in zip(vectors, assignments) if assigned == c]
+            if not members:
+                continue
+            centre = normalize([sum(values) for values in zip(*members)])
+            moved = moved or centre != centres[c]
+            centres[c] = centre
+        if not moved:
+            break
+
+    assignments = [max(range(k), key=lambda c: dot(vector, centres[c])) for vector in vectors]
+    representatives = {0}
+    for c, centre in enumerate(centres):
+        if c == assignments[0]:
+            continue
+        candidates = [index for index in range(len(vectors)) if index not in representatives]
+        representatives.add(max(candidates, key=lambda index: dot(vectors[index], centre)))
+    return sorted(representatives)
+
+def selectSummaryChunks(chunks, summaryChunkCount, selection=None):
+    """The chunks to summarize: the first summaryChunkCount, or as many representatives of the whole document"""
+    summaryChunkCount = int(summaryChunkCount)
+    if (selection or SUMMARY_SELECTION) != SUMMARY_SELECTION_CLUSTER or summaryChunkCount >= len(chunks):
+        return chunks[:summaryChunkCount]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as executor:
+        vectors = [normalize(embedding) for embedding in executor.map(lambda chunk: generateEmbeddings(chunk["text"]), chunks)]
+    # the opening pages name the main entity, so the first chunk is always a representative
+    return [chunks[index] for index in kmeansRepresentatives(vectors, summaryChunkCount)]
+
+def generateDocumentSummary(chunks, summaryChunkCount, mode=None, selection=None):
+    """Summary of the main entity of a document from up to summaryChunkCount of its chunks"""
+    start_time = time.time()
+    selected = selectSummaryChunks(chunks, summaryChunkCount, selection)
+    if (mode or SUMMARY_MODE) != SUMMARY_MODE_MAP_REDUCE:
+        results = generateSingleSummary(selected)
+    else:
+        groups = groupChunks(selected, SUMMARY_GROUP_TOKENS)
+        if len(groups) == 1:
+            results = qb_generateSummary(" ".join(chunk["text"] for chunk in groups[0]))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as executor:
+                partials = list(executor.map(
+                    lambda group: qb_generateSummary(" ".join(chunk["text"] for chunk in group), "qb_generatePartialSummary"),
+                    groups
+                ))
+            results = qb_mergeSummaries(partials)
+        print(f"Map-reduce summary of {len(selected)} chunks in {len(groups)} groups")
+    print(f"Document summary ({mode or SUMMARY_MODE}, {selection or SUMMARY_SELECTION}) took {round(time.time() - start_time, 1)}s")
+    return results
+
+def generateSingleSummary(chunks):
+    try:
+        return qb_generateSummary(" ".join(chunk["text"] for chunk in chunks))
+    except Exception as e:
+        if "validationException".upper() in str(e).upper() and "Input is too long".upper() in str(e).upper() and len(chunks) > 1:
+            return generateSingleSummary(chunks[:max(1, int(len(chunks) * 0.75))])
+        else:
+            raise Exception(e)
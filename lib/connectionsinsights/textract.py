@@ -3,47 +3,186 @@ import time
 import uuid
 import json
 import os
-import tempfile
+import threading
+import itertools
+import collections
+import concurrent.futures
 
 textract_client = boto3.client('textract')
 s3_client = boto3.client('s3')
+sfn_client = boto3.client('stepfunctions')
 
-def start_document_analysis(s3_bucket, s3_key):
-    id = str(uuid.uuid4())
+# Asynchronous mode: Textract publishes job completion to an SNS topic and the state machine waits on a task
+# token (stored here by job tag, before the job starts) instead of a Lambda polling get_document_analysis until the job is done
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get("TEXTRACT_SNS_TOPIC_ARN")
+TEXTRACT_SNS_ROLE_ARN = os.environ.get("TEXTRACT_SNS_ROLE_ARN")
+TASK_TOKEN_TTL_SECONDS = 86400
+POLL_SECONDS = 5
+
+def start_analysis_job(s3_bucket, s3_key, notification_channel=None, id=None):
+    id = id or str(uuid.uuid4())
     
     # Start the document analysis
-    response = textract_client.start_document_analysis(
-        DocumentLocation={
+    request = {
+        "DocumentLocation": {
             'S3Object': {
                 'Bucket': s3_bucket,
                 'Name': s3_key
             }
         },
-        OutputConfig={
+        "OutputConfig": {
             'S3Bucket': s3_bucket,
             'S3Prefix': f'textract_output/{id}'
         },
-        FeatureTypes=['LAYOUT']
-    )
+        "FeatureTypes": ['LAYOUT'],
+        "JobTag": id # returned in the completion notification
+    }
+    if notification_channel:
+        request["NotificationChannel"] = notification_channel
+    response = textract_client.start_document_analysis(**request)
 
     # Get the JobId from the response
     job_id = response['JobId']
     print(f'Started job with ID: {job_id}')
+    return job_id, id
 
-    # Wait for the job to complete
+def wait_for_job(job_id):
     while True:
-        response = textract_client.get_document_analysis(JobId=job_id)
+        response = textract_client.get_document_analysis(JobId=job_id, MaxResults=1)
         status = response['JobStatus']
         
-        if status in ['SUCCEEDED', 'FAILED']:
-            print(f'Textract Job status: {status}, {id}')
-            return status, id
+        if status in ['SUCCEEDED', 'FAILED', 'PARTIAL_SUCCESS']:
+            return status
         
         print('Waiting for job to complete...')
-        time.sleep(5)
+        time.sleep(POLL_SECONDS)
 
+def start_document_analysis(s3_bucket, s3_key):
+    job_id, id = start_analysis_job(s3_bucket, s3_key)
 
-def get_pages(id, s3_bucket):
+    # Wait for the job to complete
+    status = wait_for_job(job_id)
+    print(f'Textract Job status: {status}, {id}')
+    return status, id
+
+def get_task_table():
+    return boto3.resource('dynamodb').Table(os.environ["DDBTBL_INGESTION"])
+
+def task_token_key(job_tag):
+    # the ingestion table is keyed by document (see connectionsinsights.records); a job has its own partition
+    return {'pk': "textract-job#" + job_tag, 'sk': "task_token"}
+
+def save_task_token(job_tag, task_token):
+    get_task_table().put_item(Item={
+        **task_token_key(job_tag),
+        'task_token': task_token,
+        'ttl_timestamp': int(time.time()) + TASK_TOKEN_TTL_SECONDS
+    })
+
+def pop_task_token(job_tag):
+    response = get_task_table().delete_item(Key=task_token_key(job_tag), ReturnValues='ALL_OLD')
+    return response.get('Attributes', {}).get('task_token')
+
+def completion_message(job_id, status, job_tag=None):
+    # same shape as the message Textract publishes to the SNS topic
+    return {"JobId": job_id, "Status": status, "API": "StartDocumentAnalysis", "JobTag": job_tag, "Timestamp": int(time.time() * 1000)}
+
+def handle_completion_message(message):
+    """Resume the state machine execution waiting on the job in a Textract completion message"""
+    job_id = message["JobId"]
+    task_token = pop_task_token(message["JobTag"]) if message.get("JobTag") else None
+    if task_token is None:
+        print(f"No task waiting for Textract job {job_id} ({message.get('JobTag')})")
+        return
+    if message["Status"] in ['SUCCEEDED', 'PARTIAL_SUCCESS']:
+        sfn_client.send_task_success(taskToken=task_token, output=json.dumps({
+            "JobId": job_id,
+            "OutputId": message.get("JobTag"),
+            "Status": message["Status"]
+        }))
+    else:
+        sfn_client.send_task_failure(taskToken=task_token, error="TextractJobFailed", cause=f"Textract job {job_id} {message['Status']}")
+
+class SNSNotifier:
+    """Textract publishes completion to the SNS topic, which invokes the completion Lambda"""
+    def __init__(self, topic_arn, role_arn):
+        self.topic_arn = topic_arn
+        self.role_arn = role_arn
+
+    def channel(self):
+        return {"SNSTopicArn": self.topic_arn, "RoleArn": self.role_arn}
+
+    def watch(self, job_id, job_tag):
+        pass
+
+def in_lambda():
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+class LocalNotifier:
+    """
+    In-process stand-in for the SNS topic, to run the asynchronous flow offline or without a topic.  Messages
+    passed to publish() (or, with poll=True, the job completion seen by polling) go to the subscribed callbacks.
+    Polling runs in a background thread offline; in Lambda, which freezes the container (and the thread) once
+    the handler returns, watch() blocks until the job completes instead.
+    """
+    def __init__(self, poll=True, background=None):
+        self.poll = poll
+        self.background = not in_lambda() if background is None else background
+        self.subscribers = []
+
+    def channel(self):
+        return None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, job_id, status, job_tag=None):
+        message = completion_message(job_id, status, job_tag)
+        for callback in self.subscribers:
+            callback(message)
+
+    def watch(self, job_id, job_tag):
+        if not self.poll:
+            return
+        if self.background:
+            self.thread = threading.Thread(target=lambda: self.publish(job_id, wait_for_job(job_id), job_tag), daemon=True)
+            self.thread.start()
+        else:
+            self.publish(job_id, wait_for_job(job_id), job_tag)
+
+def create_notifier():
+    if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_SNS_ROLE_ARN:
+        return SNSNotifier(TEXTRACT_SNS_TOPIC_ARN, TEXTRACT_SNS_ROLE_ARN)
+    notifier = LocalNotifier()
+    notifier.subscribe(handle_completion_message)
+    return notifier
+
+def start_async_analysis(s3_bucket, s3_key, task_token, notifier=None):
+    """
+    Start a Textract job that resumes the execution waiting on task_token when it completes; returns
+    immediately.  Pass the task output to extract_job_text to read the pages.
+    """
+    notifier = notifier or create_notifier()
+    # the token is saved under the job tag before the job starts, so even a job completing (or a notification
+    # delivered) before start_document_analysis returns finds it
+    id = str(uuid.uuid4())
+    save_task_token(id, task_token)
+    try:
+        job_id, id = start_analysis_job(s3_bucket, s3_key, notifier.channel(), id=id)
+    except Exception:
+        pop_task_token(id)
+        raise
+    notifier.watch(job_id, id)
+    return {"JobId": job_id, "OutputId": id}
+
+def complete_task(task_token, output):
+    sfn_client.send_task_success(taskToken=task_token, output=json.dumps(output))
+
+
+TEXTRACT_DOWNLOAD_WORKERS = int(os.environ.get("TEXTRACT_DOWNLOAD_WORKERS", "8"))
+LAYOUT_BLOCK_TYPES = ["LAYOUT_TITLE", "LAYOUT_TEXT", "LAYOUT_SECTION_HEADER", "LAYOUT_FOOTER", "LAYOUT_TABLE", "LAYOUT_FIGURE"]
+
+def list_output_files(id, s3_bucket):
     s3_prefix = f"textract_output/{id}"
     paginator = s3_client.get_paginator('list_objects_v2')
     files = []
@@ -51,46 +190,90 @@ def get_pages(id, s3_bucket):
         for obj in page.get('Contents', []):
             files.append(obj['Key'])
 
-    files = sorted( files, key=lambda x: ((int(x.split("/")[-1]) if x.split("/")[-1].isdigit() else 9999),x) )
-    
-    blocks = []
-
-    # Download each file from S3 and save it as the file name without prefix
-    for file in files:
-        if not file.endswith('.s3_access_check'):
-            local_filename = os.path.join(tempfile.gettempdir(), file.split("/")[-1])            
-            s3_client.download_file(s3_bucket, file, local_filename)
-            with open(local_filename, 'r') as myfile:
-                data=myfile.read()
-                obj = json.loads(data)
-                blocks = blocks + obj["Blocks"]
-            os.remove(local_filename) # Remove files from local file system
-
-    lines = {}
-    for block in blocks:
-        if block["BlockType"] == "LINE":
-            lines[block["Id"]] = block["Text"]
-
-    pages = {}
-    for block in blocks:
-        if block["BlockType"] in ["LAYOUT_TITLE", "LAYOUT_TEXT", "LAYOUT_SECTION_HEADER", "LAYOUT_FOOTER", "LAYOUT_TABLE", "LAYOUT_FIGURE"]:
+    return sorted( files, key=lambda x: ((int(x.split("/")[-1]) if x.split("/")[-1].isdigit() else 9999),x) )
+
+def read_output_file(s3_bucket, key):
+    # parse straight from the response body, keeping only what is needed to rebuild the page text
+    obj = json.load(s3_client.get_object(Bucket=s3_bucket, Key=key)['Body'])
+    return [
+        {
+            "BlockType": block["BlockType"],
+            "Id": block["Id"],
+            "Page": block.get("Page", 1),
+            "Text": block.get("Text"),
+            "Children": [child for relationship in (block.get("Relationships") or []) if relationship["Type"] == "CHILD" for child in relationship["Ids"]]
+        }
+        for block in obj["Blocks"] if block["BlockType"] == "LINE" or block["BlockType"] in LAYOUT_BLOCK_TYPES
+    ]
+
+def iter_output_blocks(s3_bucket, files):
+    """Blocks of the output files in order, downloading up to TEXTRACT_DOWNLOAD_WORKERS files ahead"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=TEXTRACT_DOWNLOAD_WORKERS) as executor:
+        pending = collections.deque()
+        files = iter(files)
+        for file in itertools.islice(files, TEXTRACT_DOWNLOAD_WORKERS):
+            pending.append(executor.submit(read_output_file, s3_bucket, file))
+        while pending:
+            blocks = pending.popleft().result()
+            for file in itertools.islice(files, 1):
+                pending.append(executor.submit(read_output_file, s3_bucket, file))
+            yield from blocks
+
+def delete_output_files(s3_bucket, files):
+    for start in range(0, len(files), 1000):
+        response = s3_client.delete_objects(
+            Bucket=s3_bucket,
+            Delete={'Objects': [{'Key': file} for file in files[start:start+1000]], 'Quiet': True}
+        )
+        for error in response.get('Errors', []):
+            print(f"Error deleting {error['Key']}: {error['Message']}")
+
+def iter_pages(id, s3_bucket):
+    """
+    Yields (page number, text) in page order as each page's blocks are read, without holding the whole
+    Textract output in memory.  Output files are deleted once read.
+    """
+    files = list_output_files(id, s3_bucket)
+    lines = {}   # page -> {line id: text}
+    layouts = {} # page -> [child line ids of each layout block]
+
+    def build_page(page):
+        page_lines = lines.pop(page, {})
+        text = None
+        for children in layouts.pop(page, []):
             line = ""
-            if "Relationships" in block and block["Relationships"] is not None:
-                for relationship in block["Relationships"]:
-                    if relationship["Type"] == "CHILD":
-                        for child in relationship["Ids"]:
-                            if child in lines:
-                                line += lines[child] + " "
-                        if block["Page"] not in pages:
-                            pages[block["Page"]] = line
-                        else:
-                            pages[block["Page"]] += '\n' + line
-
-    # Delete all files under s3_prefix
-    for file in files:
-        s3_client.delete_object(Bucket=s3_bucket, Key=file)
-    
-    return pages
+            for child in children:
+                if child in page_lines:
+                    line += page_lines[child] + " "
+            text = line if text is None else text + '\n' + line
+        return text
+
+    try:
+        current_page = None
+        for block in iter_output_blocks(s3_bucket, [file for file in files if not file.endswith('.s3_access_check')]):
+            page = block["Page"]
+            if current_page is not None and page > current_page:
+                # blocks are ordered by page, so earlier pages are complete
+                for completed in sorted(p for p in set(lines) | set(layouts) if p < page):
+                    text = build_page(completed)
+                    if text is not None:
+                        yield completed, text
+            current_page = page if current_page is None else max(current_page, page)
+            if block["BlockType"] == "LINE":
+                lines.setdefault(page, {})[block["Id"]] = block["Text"]
+            elif block["Children"]:
+                layouts.setdefault(page, []).append(block["Children"])
+
+        for completed in sorted(set(lines) | set(layouts)):
+            text = build_page(completed)
+            if text is not None:
+                yield completed, text
+    finally:
+        # Delete all files under s3_prefix
+        delete_output_files(s3_bucket, files)
+
+def get_pages(id, s3_bucket):
+    return dict(iter_pages(id, s3_bucket))
 
 
 def extract_text(s3_bucket, s3_key):
@@ -100,10 +283,16 @@ def extract_text(s3_bucket, s3_key):
     duration = end_time - start_time
     print(f"Duration: {duration} seconds")
     if status == "SUCCEEDED":    
-        pages = get_pages(id, s3_bucket)
+        pages = [text for _, text in iter_pages(id, s3_bucket)]
         end_time = time.time()
         duration = end_time - start_time
         print(f"Duration: {duration} seconds")
-        return list(pages.values())
+        return pages
     else:
-        return None
\ No newline at end of file
+        return None
+
+def extract_job_text(extraction, s3_bucket):
+    """Pages of a job started by start_async_analysis, from the output of its completed task"""
+    if extraction["Status"] not in ['SUCCEEDED', 'PARTIAL_SUCCESS']:
+        raise Exception(f"Textract job {extraction['JobId']} {extraction['Status']}")
+    return [text for _, text in iter_pages(extraction["OutputId"], s3_bucket)]
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the Lambda functions import connectionsinsights from the layer; tests import it from lib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
@@ -0,0 +1,90 @@
+import time
+import threading
+
+import pytest
+
+from connectionsinsights import bedrock
+
+
+@pytest.fixture
+def quota(monkeypatch):
+    acquired = []
+    monkeypatch.setattr(bedrock, "acquireBedrockCapacity", lambda *args: acquired.append(args) or 0)
+    monkeypatch.setattr(bedrock, "bedrock_limiter", None)
+    monkeypatch.setattr(bedrock, "backoffSeconds", lambda attempt: 0)
+    return acquired
+
+
+def test_every_retry_takes_quota(quota):
+    responses = [Exception("ThrottlingException: Rate exceeded"), Exception("ThrottlingException: Rate exceeded"), "done"]
+
+    def invoke(cancel=None):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert bedrock.invokeWithRetry(invoke, quota=("model", 1500, "BULK")) == "done"
+    assert quota == [("model", 1500, "BULK")] * 3
+
+
+def test_no_quota_without_limit(quota):
+    assert bedrock.invokeWithRetry(lambda cancel=None: "done") == "done"
+    assert quota == []
+
+
+def test_hedge_usage_counted_for_winner(monkeypatch):
+    monkeypatch.setattr(bedrock, "BEDROCK_HEDGING", True)
+    monkeypatch.setattr(bedrock.bedrock_latencies, "percentile", lambda key, percentile: 0.05)
+    counters = dict(bedrock.bedrock_metrics.counters)
+    calls = []
+    loser_done = threading.Event()
+
+    def invoke(cancel=None):
+        calls.append(cancel)
+        if len(calls) == 1:
+            # slow first request, cancelled once the hedge completes
+            bedrock.addUsage("input_tokens", 100)
+            cancel.wait(5)
+            loser_done.set()
+            raise bedrock.StreamCancelled()
+        bedrock.addUsage("input_tokens", 40)
+        bedrock.addUsage("output_tokens", 10)
+        return "hedge"
+
+    def added(key):
+        return bedrock.bedrock_metrics.counters[key] - counters[key]
+
+    assert bedrock.invokeHedged(invoke, "model#text") == "hedge"
+    assert loser_done.wait(5)
+    # the cancelled request's usage is reported when it finishes
+    deadline = time.time() + 5
+    while added("hedge_input_tokens") == 0 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert added("input_tokens") == 40
+    assert added("output_tokens") == 10
+    assert added("hedge_input_tokens") == 100
+    assert added("hedge_wins") == 1
+
+
+def test_short_cache_checkpoints_dropped(monkeypatch):
+    monkeypatch.delenv("BEDROCK_PROMPT_CACHE_MIN_TOKENS", raising=False)
+    short = [{"role": "user", "content": [
+        {"type": "text", "text": "Short instructions.", "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": "Variable part."}
+    ]}]
+    long = [{"role": "user", "content": [
+        {"type": "text", "text": "instructions " * 1100, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": "Variable part."}
+    ]}]
+
+    assert "cache_control" not in bedrock.withoutShortCacheCheckpoints(short)[0]["content"][0]
+    assert "cache_control" in bedrock.withoutShortCacheCheckpoints(long)[0]["content"][0]
+    # tool schemas are part of the cached prefix
+    tools = [{"name": "result", "input_schema": {"type": "object", "description": "field " * 1100}}]
+    assert "cache_control" in bedrock.withoutShortCacheCheckpoints(short, tools)[0]["content"][0]
+    # the messages passed in are left unchanged
+    assert "cache_control" in short[0]["content"][0]
+    # Haiku 4.5 needs a longer prefix
+    assert "cache_control" not in bedrock.withoutShortCacheCheckpoints(long, modelId=bedrock.CLAUDE_HAIKU_4_5)[0]["content"][0]
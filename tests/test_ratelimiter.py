@@ -0,0 +1,59 @@
+from connectionsinsights.ratelimiter import (
+    LocalRateLimiter,
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    BEDROCK_INTERACTIVE_RESERVE
+)
+
+
+def drain(limiter, priority, tokens=1):
+    acquired = 0
+    while limiter.tryAcquire("bucket#model", tokens, priority)[0]:
+        acquired += 1
+    return acquired
+
+
+def test_bulk_leaves_interactive_reserve():
+    limiter = LocalRateLimiter(rpm=100, tpm=1000000)
+
+    bulk = drain(limiter, PRIORITY_BULK)
+    interactive = drain(limiter, PRIORITY_INTERACTIVE)
+
+    reserve = int(100 * BEDROCK_INTERACTIVE_RESERVE)
+    assert bulk == 100 - reserve
+    # refill while draining can add a fraction of a request
+    assert reserve <= interactive <= reserve + 1
+
+
+def test_interactive_uses_whole_bucket():
+    limiter = LocalRateLimiter(rpm=100, tpm=1000000)
+
+    assert drain(limiter, PRIORITY_INTERACTIVE) == 100
+    acquired, wait = limiter.tryAcquire("bucket#model", 1, PRIORITY_BULK)
+    assert not acquired
+    # bulk waits until the bucket refills past the reserve
+    assert wait >= 60 * BEDROCK_INTERACTIVE_RESERVE
+
+
+def test_tokens_limit_requests():
+    limiter = LocalRateLimiter(rpm=100, tpm=10000)
+
+    assert drain(limiter, PRIORITY_INTERACTIVE, tokens=2500) == 4
+    acquired, wait = limiter.tryAcquire("bucket#model", 2500, PRIORITY_INTERACTIVE)
+    assert not acquired and wait > 0
+
+
+def test_buckets_are_per_key():
+    limiter = LocalRateLimiter(rpm=1, tpm=1000)
+
+    assert limiter.tryAcquire("bucket#a", 10, PRIORITY_INTERACTIVE)[0]
+    assert not limiter.tryAcquire("bucket#a", 10, PRIORITY_INTERACTIVE)[0]
+    assert limiter.tryAcquire("bucket#b", 10, PRIORITY_INTERACTIVE)[0]
+
+
+def test_acquire_gives_up_after_max_wait():
+    limiter = LocalRateLimiter(rpm=1, tpm=1000, max_wait=0)
+
+    assert limiter.tryAcquire("bucket#model", 10, PRIORITY_INTERACTIVE)[0]
+    # proceeds (fails open) instead of waiting for the bucket to refill
+    assert limiter.acquire("bucket#model", 10, PRIORITY_INTERACTIVE) < 1
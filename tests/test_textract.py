@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from connectionsinsights import textract
+
+
+class FakeTextract:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.requests = []
+
+    def start_document_analysis(self, **request):
+        self.requests.append(request)
+        return {"JobId": "job-1"}
+
+    def get_document_analysis(self, JobId, MaxResults):
+        return {"JobStatus": self.statuses.pop(0)}
+
+
+class FakeStepFunctions:
+    def __init__(self):
+        self.success = []
+        self.failure = []
+
+    def send_task_success(self, taskToken, output):
+        self.success.append((taskToken, json.loads(output)))
+
+    def send_task_failure(self, taskToken, error, cause):
+        self.failure.append((taskToken, error))
+
+
+class FakeTable:
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, Item):
+        self.items[(Item["pk"], Item["sk"])] = Item
+
+    def delete_item(self, Key, ReturnValues):
+        item = self.items.pop((Key["pk"], Key["sk"]), None)
+        return {"Attributes": item} if item else {}
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    sfn = FakeStepFunctions()
+    table = FakeTable()
+    monkeypatch.setattr(textract, "sfn_client", sfn)
+    monkeypatch.setattr(textract, "get_task_table", lambda: table)
+    monkeypatch.setattr(textract, "POLL_SECONDS", 0)
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_NAME", raising=False)
+    return sfn, table
+
+
+def notifier(**kwargs):
+    notifier = textract.LocalNotifier(**kwargs)
+    notifier.subscribe(textract.handle_completion_message)
+    return notifier
+
+
+def test_local_notifier_resumes_task(offline, monkeypatch):
+    sfn, table = offline
+    fake = FakeTextract(["IN_PROGRESS", "SUCCEEDED"])
+    monkeypatch.setattr(textract, "textract_client", fake)
+
+    local = notifier()
+    output = textract.start_async_analysis("bucket", "doc.pdf", "token-1", notifier=local)
+    local.thread.join(timeout=5)
+
+    assert "NotificationChannel" not in fake.requests[0]
+    assert fake.requests[0]["JobTag"] == output["OutputId"]
+    assert sfn.success == [("token-1", {"JobId": "job-1", "OutputId": output["OutputId"], "Status": "SUCCEEDED"})]
+    assert table.items == {}
+
+
+def test_local_notifier_reports_failed_job(offline, monkeypatch):
+    sfn, table = offline
+    monkeypatch.setattr(textract, "textract_client", FakeTextract(["FAILED"]))
+
+    textract.start_async_analysis("bucket", "doc.pdf", "token-1", notifier=notifier(background=False))
+
+    assert sfn.success == []
+    assert sfn.failure == [("token-1", "TextractJobFailed")]
+
+
+def test_local_notifier_blocks_in_lambda(offline, monkeypatch):
+    sfn, table = offline
+    monkeypatch.setattr(textract, "textract_client", FakeTextract(["IN_PROGRESS", "SUCCEEDED"]))
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "chunk-document")
+
+    local = notifier()
+    textract.start_async_analysis("bucket", "doc.pdf", "token-1", notifier=local)
+
+    # no background thread for Lambda to freeze: the task is resumed before start_async_analysis returns
+    assert not local.background
+    assert [token for token, _ in sfn.success] == ["token-1"]